@@ -0,0 +1,772 @@
+#!/usr/bin/env python3
+"""Benchmarks for performance-critical parts of OrbitX.
+
+These aren't part of test.py, since they take a while to run and their results
+depend on what machine they're run on. Run one with, for example:
+
+    python benchmark.py gravity
+
+and `python benchmark.py --help` to see what benchmarks there are."""
+
+import argparse
+import logging
+import time
+from typing import Callable, List, Tuple
+
+import numba
+import numpy as np
+
+from orbitx.physics import barnes_hut, broad_phase, calc, dynamics, encke, \
+    engine, integrators, interactions, multirate, packed, regularized, \
+    relative, rk, symplectic, tolerances
+from orbitx import common
+from orbitx import logs
+from orbitx import network
+from orbitx.data_structures import PhysicsState
+
+log = logging.getLogger()
+
+
+def _time_per_call(func: Callable[[], object], min_seconds=0.5) -> float:
+    """Returns the best-case wall-clock time of a single call to func, after
+    calling it enough times to warm up caches and JIT compilation."""
+    func()
+    best = np.inf
+    end_time = time.perf_counter() + min_seconds
+    calls = 0
+    while calls < 3 or time.perf_counter() < end_time:
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+        calls += 1
+    return best
+
+
+def _print_table(header: List[str], rows: List[List[str]]):
+    widths = [max(len(row[col]) for row in [header] + rows)
+              for col in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def random_system(n: int, seed=0) -> Tuple[np.ndarray, ...]:
+    """Returns X, Y, M, Fuel for a Sun-like body with n-1 smaller bodies
+    scattered around it, out to about the orbit of Neptune."""
+    rng = np.random.default_rng(seed)
+    radius = rng.uniform(5e10, 4.5e12, n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    X = radius * np.cos(angle)
+    Y = radius * np.sin(angle)
+    M = 10 ** rng.uniform(15, 27, n)
+    X[0] = Y[0] = 0
+    M[0] = 1.989e30
+    return X, Y, M, np.zeros(n)
+
+
+def ocess_system() -> Tuple[np.ndarray, ...]:
+    state = common.load_savefile(common.savefile('OCESS.json'))
+    return (state.X, state.Y, np.array([entity.mass for entity in state]),
+            state.Fuel)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _dense_grav_acc(X, Y, M, Fuel):
+    # The old implementation of calc.grav_acc, for comparison. It builds
+    # several N*N intermediate matrices on every call.
+    N = len(X)
+    M = M + Fuel
+    GMm = common.G * M.reshape((1, -1, 1)) * M.reshape((-1, 1, 1))
+    posns = np.column_stack((X, Y))
+    displacements = posns.reshape((1, -1, 2)) - posns.reshape((-1, 1, 2))
+    dist_matrix = np.empty((N, N), dtype=np.float64)
+    for i in range(N):
+        for j in range(N):
+            Xd = X[i] - X[j]
+            Yd = Y[i] - Y[j]
+            dist_matrix[i, j] = np.sqrt(Xd*Xd + Yd*Yd)
+    np.fill_diagonal(dist_matrix, np.inf)
+    forces = GMm * displacements / np.expand_dims(dist_matrix, 2)**3
+
+    return forces.sum(axis=1) / M.reshape(-1, 1)
+
+
+def benchmark_gravity(args: argparse.Namespace):
+    """Compares calc.grav_acc to the old dense N*N implementation, and to the
+    approximate Barnes-Hut solver."""
+    rows = []
+    for n in args.n:
+        if n == 35:
+            X, Y, M, Fuel = ocess_system()
+        else:
+            X, Y, M, Fuel = random_system(n)
+        GM = common.G * (M + Fuel)
+        AX = np.empty(n)
+        AY = np.empty(n)
+
+        fused_time = _time_per_call(
+            lambda: calc.grav_acc_into(X, Y, GM, AX, AY))
+        if n <= args.max_dense_n:
+            dense_time = _time_per_call(
+                lambda: _dense_grav_acc(X, Y, M, Fuel))
+            dense_acc = _dense_grav_acc(X, Y, M, Fuel)
+            calc.grav_acc_into(X, Y, GM, AX, AY)
+            max_error = np.max(
+                np.abs(np.column_stack((AX, AY)) - dense_acc) /
+                np.linalg.norm(dense_acc, axis=1, keepdims=True))
+            dense_column = f'{dense_time * 1e6:,.1f}'
+            speedup_column = f'{dense_time / fused_time:,.1f}x'
+            error_column = f'{max_error:.1e}'
+        else:
+            # The dense implementation needs more than a gigabyte here.
+            dense_column = speedup_column = error_column = '-'
+
+        BX = np.empty(n)
+        BY = np.empty(n)
+        tree_time = _time_per_call(lambda: barnes_hut.grav_acc_into(
+            X, Y, GM, BX, BY, args.opening_angle))
+        calc.grav_acc_into(X, Y, GM, AX, AY)
+        tree_error = (np.hypot(BX - AX, BY - AY) / np.hypot(AX, AY))
+
+        rows.append([f'{n:,}', dense_column, f'{fused_time * 1e6:,.1f}',
+                     speedup_column, error_column,
+                     f'{tree_time * 1e6:,.1f}',
+                     f'{np.median(tree_error):.1e}',
+                     f'{np.max(tree_error):.1e}'])
+
+    _print_table(['N', 'dense (us)', 'fused (us)', 'speedup', 'max rel err',
+                  'tree (us)', 'tree median err', 'tree max err'], rows)
+
+
+def benchmark_interactions(args: argparse.Namespace):
+    """Compares calc.grav_acc to the interaction list solver at a range of
+    thresholds. The bound is the error that interactions.build reports, and
+    the error is the actual largest difference in acceleration, both in
+    m/s^2."""
+    rows = []
+    for n in args.n:
+        if n == 35:
+            X, Y, M, Fuel = ocess_system()
+        else:
+            X, Y, M, Fuel = random_system(n)
+        GM = common.G * (M + Fuel)
+        AX = np.empty(n)
+        AY = np.empty(n)
+        LX = np.empty(n)
+        LY = np.empty(n)
+        direct_time = _time_per_call(
+            lambda: calc.grav_acc_into(X, Y, GM, AX, AY))
+
+        for threshold in args.thresholds:
+            start, interaction_list, bound = interactions.build(
+                X, Y, GM, threshold)
+            build_time = _time_per_call(
+                lambda: interactions.build(X, Y, GM, threshold))
+            listed_time = _time_per_call(lambda: interactions.grav_acc_into(
+                X, Y, GM, start, interaction_list, LX, LY))
+            error = np.max(np.hypot(LX - AX, LY - AY))
+            rows.append([
+                f'{n:,}', f'{threshold:.0e}',
+                f'{len(interaction_list) / (n * (n - 1)):.0%}',
+                f'{direct_time * 1e6:,.1f}', f'{listed_time * 1e6:,.1f}',
+                f'{direct_time / listed_time:.1f}x',
+                f'{build_time * 1e6:,.1f}', f'{bound:.1e}', f'{error:.1e}'])
+
+    _print_table(['N', 'threshold', 'kept', 'direct (us)', 'listed (us)',
+                  'speedup', 'build (us)', 'bound', 'error'], rows)
+
+
+def benchmark_threads(args: argparse.Namespace):
+    """Measures how the parallel gravity and collision kernels scale with the
+    number of threads, in calls per second. The 'serial' rows use the
+    single-threaded kernels."""
+    rows = []
+    for n in args.n:
+        if n == 35:
+            X, Y, M, Fuel = ocess_system()
+        else:
+            X, Y, M, Fuel = random_system(n)
+        GM = common.G * (M + Fuel)
+        R = np.full(n, 1e3)
+        landed_on = np.full(n, PhysicsState.NO_INDEX)
+        groups = np.full(n, PhysicsState.NO_INDEX)
+        sources = np.arange(n)
+        particles = np.empty(0, dtype=np.int64)
+        AX = np.empty(n)
+        AY = np.empty(n)
+
+        serial_times = [
+            _time_per_call(lambda: calc.grav_acc_into(X, Y, GM, AX, AY)),
+            _time_per_call(lambda: barnes_hut.grav_acc_into(
+                X, Y, GM, AX, AY, barnes_hut.DEFAULT_OPENING_ANGLE)),
+            _time_per_call(lambda: calc.closest_approach(
+                X, Y, R, landed_on, groups, sources, particles))
+        ]
+        rows.append([f'{n:,}', 'serial'] +
+                    [f'{1 / time:,.0f}' for time in serial_times] +
+                    ['1.0x'] * len(serial_times))
+
+        for threads in args.threads:
+            numba.set_num_threads(threads)
+            times = [
+                _time_per_call(lambda: calc.grav_acc_into_parallel(
+                    X, Y, GM, AX, AY)),
+                _time_per_call(lambda: barnes_hut.grav_acc_into_parallel(
+                    X, Y, GM, AX, AY, barnes_hut.DEFAULT_OPENING_ANGLE)),
+                _time_per_call(lambda: calc.closest_approach_parallel(
+                    X, Y, R, landed_on, groups, sources, particles))
+            ]
+            rows.append(
+                [f'{n:,}', str(threads)] +
+                [f'{1 / time:,.0f}' for time in times] +
+                [f'{serial / time:.1f}x'
+                 for serial, time in zip(serial_times, times)])
+
+    _print_table(['N', 'threads', 'direct (/s)', 'tree (/s)',
+                  'collision (/s)', 'direct speedup', 'tree speedup',
+                  'collision speedup'], rows)
+
+
+def benchmark_collisions(args: argparse.Namespace):
+    """Measures calc.closest_approach against the sweep-and-prune
+    broad_phase.closest_approach, in microseconds per call, to pick
+    broad_phase.MIN_ENTITIES. Entities move a little between calls, like they
+    do between evaluations of the collision event."""
+    rows = []
+    for n in args.n:
+        if n == 35:
+            X, Y, _, _ = ocess_system()
+        else:
+            X, Y, _, _ = random_system(n)
+        R = np.full(n, 1e3)
+        landed_on = np.full(n, PhysicsState.NO_INDEX)
+        groups = np.full(n, PhysicsState.NO_INDEX)
+        sources = np.arange(n)
+        particles = np.empty(0, dtype=np.int64)
+        particle = np.zeros(n, dtype=bool)
+        order = broad_phase.sweep_order(X, R)
+        rng = np.random.default_rng(0)
+        steps = [(X + rng.normal(0, 1e4, n), Y + rng.normal(0, 1e4, n))
+                 for _ in range(8)]
+        step = 0
+
+        def next_step():
+            nonlocal step
+            step = (step + 1) % len(steps)
+            return steps[step]
+
+        exact_time = _time_per_call(lambda: calc.closest_approach(
+            *next_step(), R, landed_on, groups, sources, particles))
+        sweep_time = _time_per_call(lambda: broad_phase.closest_approach(
+            *next_step(), R, landed_on, groups, particle, order))
+        rows.append([f'{n:,}', f'{exact_time * 1e6:,.1f}',
+                     f'{sweep_time * 1e6:,.1f}',
+                     f'{exact_time / sweep_time:.1f}x'])
+
+    _print_table(['N', 'all pairs (us)', 'sweep (us)', 'speedup'], rows)
+
+
+def _integrate(state: PhysicsState, integrator: integrators.Integrator,
+               time_acc: float, duration: float,
+               profile: tolerances.Profile = tolerances.PROFILES[
+                   tolerances.DEFAULT_PROFILE]
+               ) -> Tuple[PhysicsState, int]:
+    """Integrates state for duration simulated seconds, in chunks like
+    PhysicsEngine._run_simulation does, and returns the final state and how
+    many times the derivative was evaluated.
+    Collisions are handled like the physics engine does, but there are no
+    other events."""
+    y = state
+    t = 0.0
+    radii = np.array([entity.r for entity in state])
+    evaluations = 0
+    stopped_before_event = False
+    while t < duration:
+        collision = engine.CollisionEvent(y, radii)
+        params = dynamics.build_params(y)
+        ivp_out = None
+        method = integrator
+        if integrator.backend in [integrators.SYMPLECTIC,
+                                  integrators.MULTIRATE] and \
+                not stopped_before_event:
+            orbits = symplectic.hierarchy(y, params)
+            if symplectic.coasting(y, params, orbits):
+                if integrator.rails_threshold > 0:
+                    orbits = symplectic.put_on_rails(
+                        y, params, orbits, integrator.rails_threshold)
+                max_step = symplectic.step_limit(
+                    orbits, integrators.max_step(integrator, time_acc))
+                t_end = t + min(time_acc, 10 * max_step, duration - t)
+                if integrator.backend == integrators.MULTIRATE:
+                    ivp_out = multirate.solve_ivp(
+                        params, [t, t_end], y.y0(), [collision], max_step)
+                    evaluations += ivp_out.nfev
+                else:
+                    ivp_out = symplectic.solve_ivp(
+                        params, orbits, [t, t_end], y.y0(), [collision],
+                        max_step)
+                    # One evaluation per step, plus one to get started.
+                    evaluations += len(ivp_out.t)
+                stopped_before_event = ivp_out.t[-1] < t_end
+                if len(ivp_out.t) == 1:
+                    ivp_out = None
+        if ivp_out is None:
+            regularize = integrator.backend == integrators.REGULARIZED and \
+                regularized.applies(params)
+            perturb = integrator.backend == integrators.PERTURBED and \
+                encke.applies(params)
+            if integrator.fallback is not None and \
+                    not (regularize or perturb):
+                method = integrators.INTEGRATORS[integrator.fallback]
+            stopped_before_event = False
+            max_step = integrators.max_step(method, time_acc)
+            t_span = [t, t + min(time_acc, 10 * max_step, duration - t)]
+            if regularize:
+                ivp_out = regularized.solve_ivp(
+                    params, t_span, y.y0(), [collision],
+                    integrators.fallback(integrator).method,
+                    max_step, profile, relative.orbits(y, params))
+            elif perturb:
+                ivp_out = encke.solve_ivp(
+                    params, t_span, y.y0(), [collision],
+                    integrators.fallback(integrator).method,
+                    max_step, profile, relative.orbits(y, params))
+            elif method.backend == integrators.COMPILED:
+                # This also checks the engine's other events, which we
+                # ignore like the other integrators do.
+                ivp_out = rk.solve_ivp(
+                    params, dynamics.build_event_params(y, np.inf),
+                    t_span, y.y0(), max_step, profile)
+            else:
+                ivp_out = packed.solve_ivp(
+                    params, t_span, y.y0(), [collision], method.method,
+                    max_step, profile, orbits=relative.orbits(y, params))
+            assert ivp_out.success, ivp_out.message
+            evaluations += ivp_out.nfev
+        y = PhysicsState(ivp_out.y[:, -1], state._proto_state)
+        t = ivp_out.t[-1]
+        if len(ivp_out.t_events[dynamics.COLLISION_EVENT]) > 0:
+            y = engine._collision_decision(t, y, collision)
+            y = engine._reconcile_entity_dynamics(y)
+    return y, evaluations
+
+
+def _prepare(savefile: str) -> PhysicsState:
+    """Loads a savefile, puts landed entities where they should be, like
+    PhysicsEngine.set_state does, and warms up the JIT."""
+    state = common.load_savefile(common.savefile(savefile))
+    state = engine._reconcile_entity_dynamics(state)
+    params = dynamics.build_params(state)
+    dynamics.derive(0, state.y0(), params)
+    symplectic.solve_ivp(params, symplectic.hierarchy(state, params),
+                         [0, 1], state.y0(), [], max_step=1)
+    rk.solve_ivp(params, dynamics.build_event_params(state, np.inf),
+                 [0, 1], state.y0(), max_step=1)
+    multirate.solve_ivp(params, [0, 1], state.y0(), [], max_step=1)
+    packed.solve_ivp(params, [0, 1], state.y0(), [], 'RK45', max_step=1,
+                     orbits=symplectic.hierarchy(state, params))
+    if regularized.applies(params):
+        regularized.solve_ivp(params, [0, 1], state.y0(), [], 'RK45',
+                              max_step=1)
+    if encke.applies(params):
+        encke.solve_ivp(params, [0, 1], state.y0(), [], 'RK45', max_step=1)
+    return state
+
+
+def _reference(state: PhysicsState, duration: float) -> PhysicsState:
+    """Integrates state very accurately for duration simulated seconds."""
+    reference, _ = _integrate(
+        state, integrators.INTEGRATORS['DOP853']._replace(
+            max_step=100, fast_max_step=100),
+        duration, duration, tolerances.REFERENCE)
+    return reference
+
+
+def _drift_columns(state: PhysicsState, result: PhysicsState,
+                   reference: PhysicsState) -> List[str]:
+    """How far the furthest entity, and the craft, ended up from the
+    reference, formatted for a table."""
+    drift = np.hypot(result.X - reference.X, result.Y - reference.Y)
+    craft_column = '-'
+    if state.craft is not None:
+        craft_column = f'{drift[state._name_to_index(state.craft)]:.1e}'
+    return [f'{np.max(drift):.1e}', craft_column]
+
+
+def benchmark_integrators(args: argparse.Namespace):
+    """Compares each integrator in physics/integrators.py on the standard
+    savefiles. Drift is how far each entity ends up from where a very
+    accurate reference integration puts it."""
+    rows = []
+    for savefile in args.savefiles:
+        state = _prepare(savefile)
+        reference = _reference(state, args.duration)
+
+        for time_acc in args.time_acc:
+            for integrator in integrators.INTEGRATORS.values():
+                max_step = integrators.max_step(integrator, time_acc)
+                start = time.perf_counter()
+                result, evaluations = _integrate(
+                    state, integrator, time_acc, args.duration)
+                wall_time = time.perf_counter() - start
+                rows.append([
+                    savefile, f'{len(state)}', f'{time_acc:,}',
+                    integrator.method, f'{max_step:g}',
+                    f'{args.duration / wall_time:,.0f}', f'{evaluations:,}'] +
+                    _drift_columns(state, result, reference))
+
+    _print_table(['savefile', 'N', 'time acc', 'integrator', 'max step (s)',
+                  'sim s/wall s', 'derivatives', 'max drift (m)',
+                  'craft drift (m)'], rows)
+
+
+def benchmark_relative(args: argparse.Namespace):
+    """Compares integrating everything relative to the Sun with integrating
+    everything relative to what it orbits (see physics/relative.py), at a
+    range of max step sizes. Drift is how far each entity ends up from where
+    a very accurate reference integration puts it."""
+    rows = []
+    for savefile in args.savefiles:
+        state = _prepare(savefile)
+        reference = _reference(state, args.duration)
+        relative_state = PhysicsState(None, state.as_proto())
+        relative_state.engine_settings.relative_coordinates = True
+
+        for method in args.integrators:
+            for max_step in args.max_steps:
+                integrator = integrators.INTEGRATORS[method]._replace(
+                    max_step=max_step, fast_max_step=max_step)
+                for coordinates, start_state in [('absolute', state),
+                                                 ('relative', relative_state)]:
+                    start = time.perf_counter()
+                    result, evaluations = _integrate(
+                        start_state, integrator, args.duration,
+                        args.duration)
+                    wall_time = time.perf_counter() - start
+                    rows.append([
+                        savefile, method, f'{max_step:g}', coordinates,
+                        f'{args.duration / wall_time:,.0f}',
+                        f'{evaluations:,}'] +
+                        _drift_columns(state, result, reference))
+
+    _print_table(['savefile', 'integrator', 'max step (s)', 'coordinates',
+                  'sim s/wall s', 'derivatives', 'max drift (m)',
+                  'craft drift (m)'], rows)
+
+
+def _against_fallback(args: argparse.Namespace, method: str):
+    """Compares an integrator with the integrator it falls back to, at each
+    of args.max_steps on each of args.savefiles."""
+    rows = []
+    integrator = integrators.INTEGRATORS[method]
+    for savefile in args.savefiles:
+        state = _prepare(savefile)
+        reference = _reference(state, args.duration)
+
+        for max_step in args.max_steps:
+            for compared in [integrators.fallback(integrator), integrator]:
+                compared = compared._replace(
+                    max_step=max_step, fast_max_step=max_step)
+                start = time.perf_counter()
+                result, evaluations = _integrate(
+                    state, compared, args.duration, args.duration)
+                wall_time = time.perf_counter() - start
+                rows.append([
+                    savefile, compared.method, f'{max_step:g}',
+                    f'{args.duration / wall_time:,.0f}',
+                    f'{evaluations:,}'] +
+                    _drift_columns(state, result, reference))
+
+    _print_table(['savefile', 'integrator', 'max step (s)', 'sim s/wall s',
+                  'derivatives', 'max drift (m)', 'craft drift (m)'], rows)
+
+
+def benchmark_regularized(args: argparse.Namespace):
+    """Compares the Sundman integrator (see physics/regularized.py) with the
+    integrator it falls back to, on savefiles where the craft is on an
+    eccentric orbit or a flyby, at a range of max step sizes. Drift is how far
+    each entity ends up from where a very accurate reference integration puts
+    it."""
+    _against_fallback(args, 'Sundman')
+
+
+def benchmark_encke(args: argparse.Namespace):
+    """Compares the Encke integrator (see physics/encke.py) with the
+    integrator it falls back to, on savefiles with a craft in orbit, at a
+    range of max step sizes. Drift is how far each entity ends up from where
+    a very accurate reference integration puts it."""
+    _against_fallback(args, 'Encke')
+
+
+def _command(kind: str, state: PhysicsState, i: int) -> network.Request:
+    """Returns the i'th command of the given kind."""
+    if kind == 'spin':
+        # Alternate, so the craft doesn't end up spinning too fast.
+        return network.Request(ident=network.Request.HAB_SPIN_CHANGE,
+                               spin_change=1e-3 * (-1) ** i)
+    # Sets the throttle to what it already is, which changes nothing.
+    return network.Request(ident=network.Request.HAB_THROTTLE_SET,
+                           throttle_set=state.craft_entity().throttle)
+
+
+def benchmark_commands(args: argparse.Namespace):
+    """Measures how long a command takes to show up in the simulation, in
+    milliseconds, like a flight commanding the craft every few frames. That's
+    from PhysicsEngine.handle_requests being called to the next frame's
+    get_state returning. 'Unchanged' is how many commands didn't change
+    anything, so the simthread kept simulating what it was, and 'kept' is
+    how many commands left the simulation of the time before them in place
+    for get_state to look up."""
+    rows = []
+    for savefile in args.savefiles:
+        for time_acc in args.time_accs:
+            for kind in args.kinds:
+                state = common.load_savefile(common.savefile(savefile))
+                state.time_acc = time_acc
+                physics_engine = engine.PhysicsEngine(state)
+                frame = time_acc / args.fps
+                t = state.timestamp
+                physics_engine.get_state(t)
+                latencies = []
+                unchanged = 0
+                kept = 0
+                for i in range(args.commands + 1):
+                    for _ in range(args.frames_per_command - 1):
+                        t += frame
+                        physics_engine.get_state(t)
+                    t += frame
+                    command = _command(kind, physics_engine.get_state(t), i)
+                    generation = physics_engine._generation
+                    start = time.perf_counter()
+                    physics_engine.handle_requests([command], requested_t=t)
+                    solutions = len(physics_engine._solutions)
+                    physics_engine.get_state(t + frame)
+                    if i == 0:
+                        # The first command can compile what it needs.
+                        continue
+                    latencies.append(time.perf_counter() - start)
+                    unchanged += generation == physics_engine._generation
+                    kept += solutions != 0
+                physics_engine._stop_simthread()
+                latencies_ms = np.array(latencies) * 1000
+                rows.append([
+                    savefile, f'{time_acc:g}', kind,
+                    f'{latencies_ms.mean():.2f}',
+                    f'{np.median(latencies_ms):.2f}',
+                    f'{latencies_ms.max():.2f}',
+                    f'{unchanged / args.commands:.0%}',
+                    f'{kept / args.commands:.0%}'])
+
+    _print_table(['savefile', 'time acc', 'command', 'mean (ms)',
+                  'median (ms)', 'max (ms)', 'unchanged', 'kept'], rows)
+
+
+def benchmark_tolerances(args: argparse.Namespace):
+    """Compares each tolerance profile in physics/tolerances.py on the
+    standard savefiles, with the adaptive integrators. Drift is how far each
+    entity ends up from where a very accurate reference integration puts
+    it."""
+    rows = []
+    for savefile in args.savefiles:
+        state = _prepare(savefile)
+        reference = _reference(state, args.duration)
+
+        for method in args.integrators:
+            integrator = integrators.INTEGRATORS[method]
+            if args.max_step is not None:
+                integrator = integrator._replace(
+                    max_step=args.max_step, fast_max_step=args.max_step)
+            for profile in tolerances.PROFILES.values():
+                start = time.perf_counter()
+                result, evaluations = _integrate(
+                    state, integrator, args.time_acc, args.duration, profile)
+                wall_time = time.perf_counter() - start
+                rows.append([
+                    savefile, method,
+                    f'{integrators.max_step(integrator, args.time_acc):g}',
+                    profile.name, f'{args.duration / wall_time:,.0f}',
+                    f'{evaluations:,}'] +
+                    _drift_columns(state, result, reference))
+
+    _print_table(['savefile', 'integrator', 'max step (s)', 'profile',
+                  'sim s/wall s', 'derivatives', 'max drift (m)',
+                  'craft drift (m)'], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Logs everything to both logfile and output.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    gravity = subparsers.add_parser(
+        'gravity', help=benchmark_gravity.__doc__)
+    gravity.add_argument(
+        '--n', type=int, nargs='+', default=[35, 100, 500, 1000, 2000, 5000],
+        help='Numbers of entities to benchmark. 35 uses OCESS.json.')
+    gravity.add_argument(
+        '--max-dense-n', type=int, default=2000,
+        help='Skip the memory-hungry dense implementation above this N.')
+    gravity.add_argument(
+        '--opening-angle', type=float,
+        default=barnes_hut.DEFAULT_OPENING_ANGLE,
+        help='Opening angle of the Barnes-Hut solver.')
+    gravity.set_defaults(func=benchmark_gravity)
+
+    interaction_parser = subparsers.add_parser(
+        'interactions', help=benchmark_interactions.__doc__)
+    interaction_parser.add_argument(
+        '--n', type=int, nargs='+', default=[35, 500, 5000],
+        help='Numbers of entities to benchmark. 35 uses OCESS.json.')
+    interaction_parser.add_argument(
+        '--thresholds', type=float, nargs='+',
+        default=[1e-14, 1e-12, interactions.DEFAULT_THRESHOLD, 1e-8],
+        help='Interaction thresholds to benchmark, in m/s^2.')
+    interaction_parser.set_defaults(func=benchmark_interactions)
+
+    threads = subparsers.add_parser(
+        'threads', help=benchmark_threads.__doc__)
+    threads.add_argument(
+        '--n', type=int, nargs='+', default=[35, 500, 5000],
+        help='Numbers of entities to benchmark. 35 uses OCESS.json.')
+    threads.add_argument(
+        '--threads', type=int, nargs='+',
+        default=sorted({1, 2, 4, 8, 16, numba.config.NUMBA_NUM_THREADS} &
+                       set(range(1, numba.config.NUMBA_NUM_THREADS + 1))),
+        help='Thread counts to benchmark. Set the NUMBA_NUM_THREADS '
+             'environment variable to allow more threads than CPU cores.')
+    threads.set_defaults(func=benchmark_threads)
+
+    collisions = subparsers.add_parser(
+        'collisions', help=benchmark_collisions.__doc__)
+    collisions.add_argument(
+        '--n', type=int, nargs='+',
+        default=[35, 100, 500, 1000, 5000, 20000],
+        help='Numbers of entities to benchmark. 35 uses OCESS.json.')
+    collisions.set_defaults(func=benchmark_collisions)
+
+    integrator_parser = subparsers.add_parser(
+        'integrators', help=benchmark_integrators.__doc__)
+    integrator_parser.add_argument(
+        '--savefiles', nargs='+',
+        default=['OCESS.json', 'LEO.json', 'HEO.json', 'AYSE.json'],
+        help=f'Savefiles to benchmark, relative to {common.savefile(".")}.')
+    integrator_parser.add_argument(
+        '--time-acc', type=int, nargs='+',
+        default=[1_000, integrators.FAST_TIME_ACC, 100_000, 1_000_000],
+        help='Time accs to benchmark. These only change the max step size '
+             'and how long each chunk of simulation is.')
+    integrator_parser.add_argument(
+        '--duration', type=float, default=10_000,
+        help='How many seconds to simulate.')
+    integrator_parser.set_defaults(func=benchmark_integrators)
+
+    tolerance_parser = subparsers.add_parser(
+        'tolerances', help=benchmark_tolerances.__doc__)
+    tolerance_parser.add_argument(
+        '--savefiles', nargs='+',
+        default=['OCESS.json', 'LEO.json', 'HEO.json', 'AYSE.json'],
+        help=f'Savefiles to benchmark, relative to {common.savefile(".")}.')
+    tolerance_parser.add_argument(
+        '--integrators', nargs='+', choices=[
+            integrator.method for integrator in
+            integrators.INTEGRATORS.values()
+            if integrator.backend in [integrators.SCIPY,
+                                      integrators.COMPILED]],
+        default=['RK45', 'DOP853'],
+        help='Integrators to benchmark each profile with.')
+    tolerance_parser.add_argument(
+        '--time-acc', type=int, default=1_000,
+        help='Time acc to benchmark. This only changes the max step size and '
+             'how long each chunk of simulation is.')
+    tolerance_parser.add_argument(
+        '--max-step', type=float,
+        help="Max step size, instead of the integrator's. With a big enough "
+             'max step, only the tolerances limit how long steps are.')
+    tolerance_parser.add_argument(
+        '--duration', type=float, default=10_000,
+        help='How many seconds to simulate.')
+    tolerance_parser.set_defaults(func=benchmark_tolerances)
+
+    relative_parser = subparsers.add_parser(
+        'relative', help=benchmark_relative.__doc__)
+    relative_parser.add_argument(
+        '--savefiles', nargs='+',
+        default=['OCESS.json', 'LEO.json', 'AYSE.json'],
+        help=f'Savefiles to benchmark, relative to {common.savefile(".")}.')
+    relative_parser.add_argument(
+        '--integrators', nargs='+', choices=[
+            integrator.method for integrator in
+            integrators.INTEGRATORS.values()
+            if integrator.backend == integrators.SCIPY],
+        default=['RK45', 'DOP853'],
+        help='Integrators to benchmark.')
+    relative_parser.add_argument(
+        '--max-steps', type=float, nargs='+', default=[100, 500, 2000],
+        help='Max step sizes to benchmark, in simulated seconds.')
+    relative_parser.add_argument(
+        '--duration', type=float, default=10_000,
+        help='How many seconds to simulate.')
+    relative_parser.set_defaults(func=benchmark_relative)
+
+    regularized_parser = subparsers.add_parser(
+        'regularized', help=benchmark_regularized.__doc__)
+    regularized_parser.add_argument(
+        '--savefiles', nargs='+',
+        default=['earth-flyby.json', 'HEO.json', 'LEO.json'],
+        help=f'Savefiles to benchmark, relative to {common.savefile(".")}.')
+    regularized_parser.add_argument(
+        '--max-steps', type=float, nargs='+', default=[100, 1000, np.inf],
+        help='Max step sizes to benchmark, in simulated seconds.')
+    regularized_parser.add_argument(
+        '--duration', type=float, default=100_000,
+        help='How many seconds to simulate.')
+    regularized_parser.set_defaults(func=benchmark_regularized)
+
+    encke_parser = subparsers.add_parser(
+        'encke', help=benchmark_encke.__doc__)
+    encke_parser.add_argument(
+        '--savefiles', nargs='+',
+        default=['LEO.json', 'HEO.json', 'earth-flyby.json'],
+        help=f'Savefiles to benchmark, relative to {common.savefile(".")}.')
+    encke_parser.add_argument(
+        '--max-steps', type=float, nargs='+', default=[100, 1000, np.inf],
+        help='Max step sizes to benchmark, in simulated seconds.')
+    encke_parser.add_argument(
+        '--duration', type=float, default=20_000,
+        help='How many seconds to simulate.')
+    encke_parser.set_defaults(func=benchmark_encke)
+
+    commands_parser = subparsers.add_parser(
+        'commands', help=benchmark_commands.__doc__)
+    commands_parser.add_argument(
+        '--savefiles', nargs='+', default=['LEO.json', 'OCESS.json'],
+        help=f'Savefiles to benchmark, relative to {common.savefile(".")}.')
+    commands_parser.add_argument(
+        '--time-accs', type=float, nargs='+', default=[1, 1000],
+        help='Time accelerations to benchmark.')
+    commands_parser.add_argument(
+        '--kinds', nargs='+', default=['spin', 'throttle'],
+        choices=['spin', 'throttle'],
+        help="Commands to send. 'throttle' sets the throttle to what it "
+        'already is.')
+    commands_parser.add_argument(
+        '--commands', type=int, default=60,
+        help='How many commands to send.')
+    commands_parser.add_argument(
+        '--frames-per-command', type=int, default=5,
+        help='How many frames there are for each command.')
+    commands_parser.add_argument(
+        '--fps', type=float, default=60,
+        help='Frames per second of wall-clock time.')
+    commands_parser.set_defaults(func=benchmark_commands)
+
+    args = parser.parse_args()
+    logs.make_program_logfile('benchmark')
+    if args.verbose:
+        logs.enable_verbose_logging()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
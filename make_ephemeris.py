@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Makes an ephemeris of the natural bodies in a savefile.
+
+The physics engine can look natural bodies up in an ephemeris instead of
+integrating them, see orbitx/physics/ephemeris.py. For example,
+
+    python make_ephemeris.py OCESS.json --duration 31557600
+
+integrates the natural bodies of OCESS.json for a year, and writes
+data/ephemerides/OCESS.npz. To use it, add
+"engineSettings": {"ephemeris": "OCESS.npz"} to the savefile, or run e.g.
+`python orbitx.py flight_training --ephemeris OCESS.npz`.
+
+Ephemerides aren't checked in, since they're big and quick enough to remake.
+Remake one whenever the savefile's natural bodies change."""
+
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from orbitx import common
+from orbitx import logs
+from orbitx.physics import ephemeris
+
+log = logging.getLogger()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Logs everything to both logfile and output.')
+    parser.add_argument(
+        'savefile',
+        help=f'Savefile to start from, relative to {common.savefile(".")}.')
+    parser.add_argument(
+        '--duration', type=float, default=30 * 24 * 60 * 60,
+        help='How many seconds after the savefile the ephemeris covers.')
+    parser.add_argument(
+        '--degree', type=int, default=ephemeris.DEFAULT_DEGREE,
+        help='Degree of the Chebyshev polynomial of each segment.')
+    parser.add_argument(
+        '--position-tolerance', type=float,
+        default=ephemeris.DEFAULT_POSITION_TOLERANCE,
+        help='Largest position error allowed, in metres.')
+    parser.add_argument(
+        '--velocity-tolerance', type=float,
+        default=ephemeris.DEFAULT_VELOCITY_TOLERANCE,
+        help='Largest velocity error allowed, in metres per second.')
+    parser.add_argument(
+        '--output',
+        help='File to write, relative to data/ephemerides/. Defaults to the '
+             'name of the savefile, ending in .npz.')
+    args = parser.parse_args()
+
+    logs.make_program_logfile('make_ephemeris')
+    if args.verbose:
+        logs.enable_verbose_logging()
+
+    state = common.load_savefile(common.savefile(args.savefile))
+    output = ephemeris.path(args.output or Path(args.savefile).stem + '.npz')
+
+    start = time.perf_counter()
+    table = ephemeris.build(
+        state, args.duration, args.degree, args.position_tolerance,
+        args.velocity_tolerance)
+    elapsed = time.perf_counter() - start
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    ephemeris.save(table, output)
+    print(f'Wrote {output} in {elapsed:.1f} s, '
+          f'{output.stat().st_size / 1e6:.1f} MB.')
+    for name, segments, length in zip(
+            table.names, table.n_segments, table.segment_length):
+        print(f'{name}: {segments} segments of {length:,.0f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,7 @@ log = logging.getLogger()
 # store them in a big 1D numpy array for use in scipy.solve_ivp.
 _PER_ENTITY_UNCHANGING_FIELDS = [
     'name', 'mass', 'r', 'artificial', 'atmosphere_thickness',
-    'atmosphere_scaling'
+    'atmosphere_scaling', 'test_particle', 'collision_group'
 ]
 
 _PER_ENTITY_MUTABLE_FIELDS = [field.name for
@@ -81,6 +81,8 @@ class Entity:
     artificial: bool
     atmosphere_thickness: float
     atmosphere_scaling: float
+    test_particle: bool
+    collision_group: str
 
     def screen_pos(self, origin: 'Entity') -> vpython.vector:
         """The on-screen position of this entity, relative to the origin."""
@@ -550,6 +552,25 @@ class PhysicsState:
                     self._entities_with_atmospheres.append(index)
         return self._entities_with_atmospheres
 
+    @property
+    def TestParticles(self) -> np.ndarray:
+        """Returns a boolean array, True for entities that are test particles.
+        See the test_particle field in orbitx.proto."""
+        return np.array([entity.test_particle
+                         for entity in self._proto_state.entities],
+                        dtype=bool)
+
+    @property
+    def CollisionGroups(self) -> np.ndarray:
+        """Returns the collision group of each entity, numbered in order of
+        first appearance, or NO_INDEX for entities without one. See the
+        collision_group field in orbitx.proto."""
+        numbers: Dict[str, int] = {}
+        return np.array([
+            numbers.setdefault(entity.collision_group, len(numbers))
+            if entity.collision_group else self.NO_INDEX
+            for entity in self._proto_state.entities], dtype=np.int64)
+
     @property
     def time_acc(self) -> float:
         """Returns the time acceleration, e.g. 1x or 50x."""
@@ -615,3 +636,9 @@ class PhysicsState:
     @navmode.setter
     def navmode(self, navmode: Navmode):
         self._proto_state.navmode = navmode.value
+
+    @property
+    def engine_settings(self) -> protos.EngineSettings:
+        """Returns settings for how this state should be simulated. Modifying
+        the returned protobuf will modify this PhysicsState."""
+        return self._proto_state.engine_settings
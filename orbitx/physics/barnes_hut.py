@@ -0,0 +1,260 @@
+"""A Barnes-Hut gravity solver, for scenarios with lots of entities.
+
+calc.grav_acc_into is exact, but looks at every pair of entities. That's the
+best choice for the few dozen entities in a normal savefile, but it scales
+quadratically. A savefile with thousands of asteroids would spend all its time
+calculating the pull of one asteroid on another asteroid on the other side of
+the solar system.
+
+Instead, this module puts every entity into a quadtree (OrbitX is 2D, so a
+quadtree instead of the usual octree) and approximates far-away groups of
+entities as a single point mass at their centre of mass. How far away a group
+has to be before it's approximated is set by the opening angle: a node of the
+quadtree is approximated when
+
+    node side length / distance to node centre of mass < opening angle
+
+so an opening angle of 0 is exact, and bigger opening angles are faster and
+less accurate. See https://en.wikipedia.org/wiki/Barnes%E2%80%93Hut_simulation
+
+The quadtree is built by sorting entities along a Z-order curve
+(https://en.wikipedia.org/wiki/Z-order_curve), so that every node of the tree
+is a contiguous range of the sorted entities."""
+
+import math
+
+import numba
+import numpy as np
+
+# Used when the savefile doesn't specify an opening angle. This is a common
+# choice in the literature, and is accurate to well under a percent.
+DEFAULT_OPENING_ANGLE = 0.5
+
+# Nodes with this many or fewer entities aren't split any further, and their
+# entities are summed directly.
+LEAF_SIZE = 8
+
+# Bits of precision per axis of each entity's position along the Z-order
+# curve. Two bits per level of the quadtree, so this is also the maximum depth
+# of the quadtree. The keys have to fit into an int64.
+_BITS = 31
+
+_NO_NODE = -1
+
+
+@numba.jit(nopython=True, nogil=True)
+def grav_acc_into(X, Y, GM, AX, AY, opening_angle):
+    """Writes approximate gravitational accelerations into AX and AY.
+
+    Arguments are the same as calc.grav_acc_into, plus the opening angle."""
+    N = len(X)
+    if N == 0:
+        return
+    order, start, end, side, children, gm, cx, cy = _build_tree(X, Y, GM)
+    stack = np.empty(4 * _BITS + 8, dtype=np.int64)
+    for position in range(N):
+        AX[order[position]], AY[order[position]] = _walk(
+            position, X, Y, GM, opening_angle, stack,
+            order, start, end, side, children, gm, cx, cy)
+
+
+@numba.jit(nopython=True, nogil=True, parallel=True)
+def grav_acc_into_parallel(X, Y, GM, AX, AY, opening_angle):
+    """Same as grav_acc_into, but split between numba's threads.
+
+    Only walking the tree is done in parallel, building it isn't."""
+    N = len(X)
+    if N == 0:
+        return
+    order, start, end, side, children, gm, cx, cy = _build_tree(X, Y, GM)
+    n_blocks = min(N, numba.get_num_threads())
+    for block in numba.prange(n_blocks):
+        stack = np.empty(4 * _BITS + 8, dtype=np.int64)
+        for position in range(block * N // n_blocks,
+                              (block + 1) * N // n_blocks):
+            AX[order[position]], AY[order[position]] = _walk(
+                position, X, Y, GM, opening_angle, stack,
+                order, start, end, side, children, gm, cx, cy)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _spread_bits(v):
+    """Moves the bottom 32 bits of v to every second bit of the result."""
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+@numba.jit(nopython=True, nogil=True)
+def _grow(array, capacity):
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+@numba.jit(nopython=True, nogil=True)
+def _build_tree(X, Y, GM):
+    """Builds the quadtree. Returns a tuple of arrays:
+    order: the indices of the entities, sorted along the Z-order curve
+    start, end: the range of order that each node contains
+    side: the side length of each node
+    children: the child node in each quadrant of each node, or _NO_NODE
+    gm, cx, cy: the total G*mass and centre of mass of each node
+    Node 0 is the root, and children always come after their parents."""
+    N = len(X)
+    x_min = X.min()
+    y_min = Y.min()
+    size = max(X.max() - x_min, Y.max() - y_min)
+    if size == 0:
+        size = 1.0
+    # Make sure the largest coordinates still fit in _BITS bits.
+    size *= 1 + 1e-9
+    scale = (1 << _BITS) / size
+
+    keys = np.empty(N, dtype=np.int64)
+    for i in range(N):
+        ix = min(np.int64((X[i] - x_min) * scale), (1 << _BITS) - 1)
+        iy = min(np.int64((Y[i] - y_min) * scale), (1 << _BITS) - 1)
+        keys[i] = _spread_bits(ix) | (_spread_bits(iy) << 1)
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+
+    capacity = 2 * N + 16
+    start = np.empty(capacity, dtype=np.int64)
+    end = np.empty(capacity, dtype=np.int64)
+    level = np.empty(capacity, dtype=np.int64)
+    children = np.full((capacity, 4), _NO_NODE, dtype=np.int64)
+    start[0] = 0
+    end[0] = N
+    level[0] = 0
+    n_nodes = 1
+
+    stack = np.empty(capacity, dtype=np.int64)
+    stack[0] = 0
+    stack_size = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node = stack[stack_size]
+        if end[node] - start[node] <= LEAF_SIZE or level[node] == _BITS:
+            continue
+
+        # All keys in this node share the bits above `shift`, so the two
+        # bits at `shift` (the quadrant) are sorted within this node.
+        shift = 2 * (_BITS - 1 - level[node])
+        lo = start[node]
+        for quadrant in range(4):
+            # Binary search for the end of this quadrant.
+            hi_lo = lo
+            hi_hi = end[node]
+            while hi_lo < hi_hi:
+                mid = (hi_lo + hi_hi) // 2
+                if (keys[mid] >> shift) & 3 <= quadrant:
+                    hi_lo = mid + 1
+                else:
+                    hi_hi = mid
+            if hi_lo > lo:
+                if n_nodes == capacity:
+                    capacity *= 2
+                    start = _grow(start, capacity)
+                    end = _grow(end, capacity)
+                    level = _grow(level, capacity)
+                    children = _grow(children, capacity)
+                    children[n_nodes:] = _NO_NODE
+                    stack = _grow(stack, capacity)
+                start[n_nodes] = lo
+                end[n_nodes] = hi_lo
+                level[n_nodes] = level[node] + 1
+                children[node, quadrant] = n_nodes
+                stack[stack_size] = n_nodes
+                stack_size += 1
+                n_nodes += 1
+            lo = hi_lo
+
+    # Sum up masses from the leaves upwards. Summing ranges directly would be
+    # simpler, but the Sun's mass would drown out the asteroids'.
+    gm = np.zeros(n_nodes)
+    cx = np.zeros(n_nodes)
+    cy = np.zeros(n_nodes)
+    for node in range(n_nodes - 1, -1, -1):
+        leaf = True
+        for quadrant in range(4):
+            child = children[node, quadrant]
+            if child != _NO_NODE:
+                leaf = False
+                gm[node] += gm[child]
+                cx[node] += gm[child] * cx[child]
+                cy[node] += gm[child] * cy[child]
+        if leaf:
+            for position in range(start[node], end[node]):
+                i = order[position]
+                gm[node] += GM[i]
+                cx[node] += GM[i] * X[i]
+                cy[node] += GM[i] * Y[i]
+        if gm[node] != 0:
+            cx[node] /= gm[node]
+            cy[node] /= gm[node]
+
+    side = np.empty(n_nodes)
+    for node in range(n_nodes):
+        side[node] = size / (1 << level[node])
+
+    return (order, start[:n_nodes], end[:n_nodes], side,
+            children[:n_nodes], gm, cx, cy)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _walk(position, X, Y, GM, opening_angle, stack,
+          order, start, end, side, children, gm, cx, cy):
+    """Returns the acceleration of the entity at `position` in `order`."""
+    i = order[position]
+    Xi = X[i]
+    Yi = Y[i]
+    AXi = 0.0
+    AYi = 0.0
+    opening_angle_squared = opening_angle * opening_angle
+
+    stack[0] = 0
+    stack_size = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node = stack[stack_size]
+        if gm[node] == 0:
+            continue
+
+        # Never approximate a node that contains the entity itself, or the
+        # entity would be attracted to itself.
+        if not start[node] <= position < end[node]:
+            Xd = cx[node] - Xi
+            Yd = cy[node] - Yi
+            dist_squared = Xd * Xd + Yd * Yd
+            if side[node] * side[node] < \
+                    opening_angle_squared * dist_squared:
+                inv_dist_cubed = 1 / (dist_squared * math.sqrt(dist_squared))
+                AXi += gm[node] * Xd * inv_dist_cubed
+                AYi += gm[node] * Yd * inv_dist_cubed
+                continue
+
+        leaf = True
+        for quadrant in range(4):
+            child = children[node, quadrant]
+            if child != _NO_NODE:
+                leaf = False
+                stack[stack_size] = child
+                stack_size += 1
+
+        if leaf:
+            for other_position in range(start[node], end[node]):
+                j = order[other_position]
+                if j == i:
+                    continue
+                Xd = X[j] - Xi
+                Yd = Y[j] - Yi
+                dist_squared = Xd * Xd + Yd * Yd
+                inv_dist_cubed = 1 / (dist_squared * math.sqrt(dist_squared))
+                AXi += GM[j] * Xd * inv_dist_cubed
+                AYi += GM[j] * Yd * inv_dist_cubed
+
+    return AXi, AYi
@@ -0,0 +1,102 @@
+"""Collision detection that scales to lots of entities.
+
+calc.closest_approach finds the pair of entities closest to touching by
+looking at every pair, and the collision event does that after every step,
+and many more times while solve_ivp is finding exactly when a collision
+happens. Like calc.grav_acc_into, that's best for a few dozen entities, but
+scales quadratically.
+
+The collision event doesn't need to know how far apart entities that are
+nowhere near each other are, though, only when two entities touch. So
+closest_approach here returns the smallest altitude of any pair, like
+calc.closest_approach, but never more than CUTOFF. That's still continuous,
+and still zero exactly when two entities touch, so it works just as well as
+an event. And the only pairs it has to look at are pairs whose extents along
+the x axis are within CUTOFF of each other: it keeps the entities sorted by
+where they start along the x axis, and sweeps through them in that order,
+which finds every such pair (https://en.wikipedia.org/wiki/Sweep_and_prune).
+Entities barely move between two evaluations of the event, so re-sorting
+them with an insertion sort is about linear.
+
+Pairs of test particles, landed entities and what they're landed on, and
+entities in the same collision group (see the collision_group field in
+orbitx.proto) never collide, here and in calc.closest_approach."""
+
+import math
+
+import numba
+import numpy as np
+
+from orbitx.data_structures import PhysicsState
+
+# States with at least this many entities use closest_approach here, instead
+# of calc.closest_approach. Run `python benchmark.py collisions` to see where
+# the crossover is on your machine.
+MIN_ENTITIES = 20
+
+# The most that closest_approach ever returns, in metres. Smaller is faster,
+# since fewer pairs are close enough to need looking at.
+CUTOFF = 1e3
+
+_NO_INDEX = PhysicsState.NO_INDEX
+
+
+def worthwhile(n_entities: int) -> bool:
+    return n_entities >= MIN_ENTITIES
+
+
+def sweep_order(X: np.ndarray, R: np.ndarray) -> np.ndarray:
+    """An order to pass to closest_approach, sorted already."""
+    return np.argsort(X - R, kind='stable')
+
+
+@numba.jit(nopython=True, nogil=True)
+def closest_approach(X, Y, R, LandedOn, groups, particle, order):
+    """Returns (altitude, i, j) of the pair of entities i < j that are
+    closest to touching, like calc.closest_approach, except that if no pair
+    is within CUTOFF of touching, returns (CUTOFF, 0, 0).
+
+    groups[i] is the collision group of entity i, or NO_INDEX, and
+    particle[i] is True if entity i is a test particle. order is a
+    permutation of the entities, which is sorted in place by X - R. Pass the
+    same one every time for the same entities, so it stays nearly sorted."""
+    _insertion_sort(order, X, R)
+    min_altitude = CUTOFF
+    min_i = 0
+    min_j = 0
+    for a in range(len(order)):
+        i = order[a]
+        for b in range(a + 1, len(order)):
+            j = order[b]
+            # Everything from here on starts too far along the x axis to be
+            # closer than what we've already found.
+            if X[j] - R[j] > X[i] + R[i] + min_altitude:
+                break
+            if particle[i] and particle[j]:
+                continue
+            if LandedOn[i] == j or LandedOn[j] == i:
+                continue
+            if groups[i] != _NO_INDEX and groups[i] == groups[j]:
+                continue
+            Yd = Y[j] - Y[i]
+            if abs(Yd) - R[i] - R[j] >= min_altitude:
+                continue
+            Xd = X[j] - X[i]
+            altitude = math.sqrt(Xd * Xd + Yd * Yd) - R[i] - R[j]
+            if altitude < min_altitude:
+                min_altitude = altitude
+                min_i = min(i, j)
+                min_j = max(i, j)
+    return min_altitude, min_i, min_j
+
+
+@numba.jit(nopython=True, nogil=True)
+def _insertion_sort(order, X, R):
+    for a in range(1, len(order)):
+        entity = order[a]
+        start = X[entity] - R[entity]
+        b = a - 1
+        while b >= 0 and X[order[b]] - R[order[b]] > start:
+            order[b + 1] = order[b]
+            b -= 1
+        order[b + 1] = entity
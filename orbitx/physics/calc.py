@@ -13,6 +13,9 @@ from orbitx.data_structures import Entity, Navmode, PhysicsState
 
 log = logging.getLogger()
 
+# A global, so that numba treats it as a compile-time constant.
+_NO_INDEX = PhysicsState.NO_INDEX
+
 Point = collections.namedtuple('Point', ['x', 'y', 'z'])
 OrbitCoords = collections.namedtuple(
     'OrbitCoords',
@@ -313,29 +316,215 @@ def _build_sphere_segment_vertices(
 
 @numba.jit(nopython=True, nogil=True)
 def grav_acc(X, Y, M, Fuel):
-    # This code taken from https://stackoverflow.com/a/52562874/1333978
-    # and the nested loop from
-    # https://jakevdp.github.io/blog/2013/06/15/numba-vs-cython-take-2/
-    # This make look slow and unoptimized, but the numba.jit decorator
-    # makes this code marginally more efficient and optimized than even
-    # *Cython* (which is basically as efficient as you can get in Python,
-    # and even C.) This is good because this function is very performance-
-    # critical, and is called by scipy.solve_ivp hundreds of times a second.
+    """Returns an N*2 array of the gravitational acceleration of each entity,
+    towards every other entity."""
+    N = len(X)
+    GM = common.G * (M + Fuel)
+    acc = np.empty((N, 2), dtype=np.float64)
+    AX = np.empty(N, dtype=np.float64)
+    AY = np.empty(N, dtype=np.float64)
+    grav_acc_into(X, Y, GM, AX, AY)
+    acc[:, 0] = AX
+    acc[:, 1] = AY
+    return acc
+
+
+@numba.jit(nopython=True, nogil=True)
+def total_energy(X, Y, VX, VY, M, Fuel):
+    """Returns the kinetic plus gravitational potential energy of every
+    entity, in joules. Integrators should keep this constant while nothing
+    is thrusting, colliding, or in an atmosphere."""
     N = len(X)
-    M = M + Fuel
-    GMm = common.G * M.reshape((1, -1, 1)) * M.reshape((-1, 1, 1))
-    posns = np.column_stack((X, Y))
-    displacements = posns.reshape((1, -1, 2)) - posns.reshape((-1, 1, 2))
-    dist_matrix = np.empty((N, N), dtype=np.float64)
+    mass = M + Fuel
+    energy = 0.0
     for i in range(N):
+        energy += mass[i] * (VX[i] ** 2 + VY[i] ** 2) / 2
+        for j in range(i + 1, N):
+            energy -= common.G * mass[i] * mass[j] / math.sqrt(
+                (X[j] - X[i]) ** 2 + (Y[j] - Y[i]) ** 2)
+    return energy
+
+
+@numba.jit(nopython=True, nogil=True)
+def grav_acc_into(X, Y, GM, AX, AY):
+    """Writes gravitational accelerations into AX and AY.
+
+    GM is G * (mass + fuel) of each entity. Pass this in instead of masses so
+    that callers can keep it around between calls, since it only changes
+    when fuel does.
+
+    This visits every pair of entities once, and uses Newton's third law to
+    apply the pair's force to both entities. Nothing is allocated, unlike the
+    older version of this function that built several N*N matrices on every
+    call. This function is very performance-critical, since it's called by
+    scipy.solve_ivp hundreds of times a second."""
+    N = len(X)
+    for i in range(N):
+        AX[i] = 0
+        AY[i] = 0
+
+    for i in range(N):
+        Xi = X[i]
+        Yi = Y[i]
+        GMi = GM[i]
+        AXi = 0.0
+        AYi = 0.0
+        for j in range(i + 1, N):
+            Xd = X[j] - Xi
+            Yd = Y[j] - Yi
+            dist_squared = Xd * Xd + Yd * Yd
+            inv_dist_cubed = 1 / (dist_squared * math.sqrt(dist_squared))
+            # i is pulled towards j, and j is pulled towards i.
+            AXi += GM[j] * Xd * inv_dist_cubed
+            AYi += GM[j] * Yd * inv_dist_cubed
+            AX[j] -= GMi * Xd * inv_dist_cubed
+            AY[j] -= GMi * Yd * inv_dist_cubed
+        AX[i] += AXi
+        AY[i] += AYi
+
+
+@numba.jit(nopython=True, nogil=True, parallel=True)
+def grav_acc_into_parallel(X, Y, GM, AX, AY):
+    """Same as grav_acc_into, but split between numba's threads.
+
+    Each thread sums up the accelerations of its own entities, so unlike
+    grav_acc_into the force between each pair is calculated twice. This only
+    pays off for a few hundred entities or more, and with more than one
+    thread. Set the number of threads with numba.set_num_threads."""
+    N = len(X)
+    for i in numba.prange(N):
+        Xi = X[i]
+        Yi = Y[i]
+        AXi = 0.0
+        AYi = 0.0
         for j in range(N):
-            Xd = X[i] - X[j]
-            Yd = Y[i] - Y[j]
-            dist_matrix[i, j] = np.sqrt(Xd*Xd + Yd*Yd)
-    np.fill_diagonal(dist_matrix, np.inf)
-    forces = GMm * displacements / np.expand_dims(dist_matrix, 2)**3
+            if j == i:
+                continue
+            Xd = X[j] - Xi
+            Yd = Y[j] - Yi
+            dist_squared = Xd * Xd + Yd * Yd
+            inv_dist_cubed = 1 / (dist_squared * math.sqrt(dist_squared))
+            AXi += GM[j] * Xd * inv_dist_cubed
+            AYi += GM[j] * Yd * inv_dist_cubed
+        AX[i] = AXi
+        AY[i] = AYi
+
+
+@numba.jit(nopython=True, nogil=True)
+def test_particle_acc_into(X, Y, GM, sources, particles, AX, AY):
+    """Writes the gravitational acceleration of each test particle into AX
+    and AY. sources and particles are arrays of entity indices.
+
+    Test particles are only pulled on by sources, never by each other, so
+    this only takes time proportional to len(sources) * len(particles)."""
+    for k in range(len(particles)):
+        AX[particles[k]], AY[particles[k]] = _test_particle_acc(
+            X, Y, GM, sources, particles[k])
+
+
+@numba.jit(nopython=True, nogil=True, parallel=True)
+def test_particle_acc_into_parallel(X, Y, GM, sources, particles, AX, AY):
+    """Same as test_particle_acc_into, but split between numba's threads."""
+    for k in numba.prange(len(particles)):
+        AX[particles[k]], AY[particles[k]] = _test_particle_acc(
+            X, Y, GM, sources, particles[k])
+
+
+@numba.jit(nopython=True, nogil=True)
+def grav_acc_on_into(X, Y, GM, sources, targets, AX, AY):
+    """Like test_particle_acc_into, but targets can also be sources, and
+    aren't pulled on by themselves."""
+    for k in range(len(targets)):
+        AX[targets[k]], AY[targets[k]] = _test_particle_acc(
+            X, Y, GM, sources, targets[k])
+
 
-    return forces.sum(axis=1) / M.reshape(-1, 1)
+@numba.jit(nopython=True, nogil=True)
+def _test_particle_acc(X, Y, GM, sources, i):
+    Xi = X[i]
+    Yi = Y[i]
+    AXi = 0.0
+    AYi = 0.0
+    for k in range(len(sources)):
+        j = sources[k]
+        if j == i:
+            continue
+        Xd = X[j] - Xi
+        Yd = Y[j] - Yi
+        dist_squared = Xd * Xd + Yd * Yd
+        inv_dist_cubed = 1 / (dist_squared * math.sqrt(dist_squared))
+        AXi += GM[j] * Xd * inv_dist_cubed
+        AYi += GM[j] * Yd * inv_dist_cubed
+    return AXi, AYi
+
+
+@numba.jit(nopython=True, nogil=True)
+def closest_approach(X, Y, R, LandedOn, groups, sources, particles):
+    """Returns (altitude, i, j) of the pair of entities i < j that are closest
+    to touching. The altitude is the distance between the two entities'
+    surfaces, and is negative if they overlap.
+
+    LandedOn[i] is the index of the entity that entity i is landed on, or
+    PhysicsState.NO_INDEX. Landed pairs are already touching, so they're
+    ignored. So are pairs in the same collision group, where groups[i] is
+    the collision group of entity i or NO_INDEX. sources and particles are
+    the indices of entities that are and aren't test particles, since pairs
+    of test particles are also ignored. If there are no pairs, returns
+    (inf, 0, 0). For lots of entities, see broad_phase.py."""
+    min_altitude = np.inf
+    min_i = 0
+    min_j = 0
+    for k in range(len(sources)):
+        altitude, j = _closest_approach_row(
+            X, Y, R, LandedOn, groups, sources, particles, k)
+        if altitude < min_altitude:
+            min_altitude = altitude
+            min_i = min(sources[k], j)
+            min_j = max(sources[k], j)
+    return min_altitude, min_i, min_j
+
+
+@numba.jit(nopython=True, nogil=True, parallel=True)
+def closest_approach_parallel(X, Y, R, LandedOn, groups, sources,
+                              particles):
+    """Same as closest_approach, but split between numba's threads."""
+    row_altitude = np.full(len(sources), np.inf)
+    row_j = np.zeros(len(sources), dtype=np.int64)
+    for k in numba.prange(len(sources)):
+        row_altitude[k], row_j[k] = _closest_approach_row(
+            X, Y, R, LandedOn, groups, sources, particles, k)
+
+    min_altitude = np.inf
+    min_i = 0
+    min_j = 0
+    for k in range(len(sources)):
+        if row_altitude[k] < min_altitude:
+            min_altitude = row_altitude[k]
+            min_i = min(sources[k], row_j[k])
+            min_j = max(sources[k], row_j[k])
+    return min_altitude, min_i, min_j
+
+
+@numba.jit(nopython=True, nogil=True)
+def _closest_approach_row(X, Y, R, LandedOn, groups, sources, particles, k):
+    # Every pair of sources is only looked at once, but every pair of a
+    # source and a test particle has to be looked at from the source's side.
+    i = sources[k]
+    min_altitude = np.inf
+    min_j = 0
+    for others, first in ((sources, k + 1), (particles, 0)):
+        for j in others[first:]:
+            if LandedOn[i] == j or LandedOn[j] == i:
+                continue
+            if groups[i] != _NO_INDEX and groups[i] == groups[j]:
+                continue
+            Xd = X[j] - X[i]
+            Yd = Y[j] - Y[i]
+            altitude = math.sqrt(Xd * Xd + Yd * Yd) - R[i] - R[j]
+            if altitude < min_altitude:
+                min_altitude = altitude
+                min_j = j
+    return min_altitude, min_j
 
 
 def navmode_heading(flight_state: PhysicsState) -> float:
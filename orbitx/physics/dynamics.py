@@ -0,0 +1,862 @@
+"""Compiled equations of motion, used by the physics engine.
+
+scipy.integrate.solve_ivp calls the derivative of our system hundreds of times
+per second, and at high time accelerations almost all of that time used to be
+spent in Python overhead: building PhysicsStates, copying protobufs, and
+creating _EntityViews. Here, everything that stays constant during a chunk of
+simulation (masses, radii, which entities have engines or atmospheres, who is
+landed on who, etc.) is gathered once into a DeriveParams. The derivative
+itself is then a numba kernel that only ever looks at the flat y-vector.
+
+If you change how things move in engine.py, you'll probably have to change
+something here too. The layout of the y-vector is described in
+PhysicsEngine._derive."""
+
+import math
+from typing import Dict, NamedTuple, Optional
+
+import numba
+import numpy as np
+
+from orbitx import common
+from orbitx import orbitx_pb2 as protos
+from orbitx.physics import barnes_hut, broad_phase, calc, interactions
+from orbitx.data_structures import Navmode, PhysicsState, _FIELD_ORDERING
+
+# Offsets of each field in the y-vector, in units of "number of entities".
+# These are globals so that numba treats them as compile-time constants.
+_X = _FIELD_ORDERING['x']
+_Y = _FIELD_ORDERING['y']
+_VX = _FIELD_ORDERING['vx']
+_VY = _FIELD_ORDERING['vy']
+_HEADING = _FIELD_ORDERING['heading']
+_SPIN = _FIELD_ORDERING['spin']
+_FUEL = _FIELD_ORDERING['fuel']
+_THROTTLE = _FIELD_ORDERING['throttle']
+
+_SRB_TIME_INDEX = PhysicsState.SRB_TIME_INDEX
+_NO_INDEX = PhysicsState.NO_INDEX
+
+_MANUAL = Navmode['Manual'].value
+_CCW_PROGRADE = Navmode['CCW Prograde'].value
+_CW_RETROGRADE = Navmode['CW Retrograde'].value
+_DEPART_REFERENCE = Navmode['Depart Reference'].value
+_APPROACH_TARGET = Navmode['Approach Target'].value
+_PRO_TARG_VELOCITY = Navmode['Pro Targ Velocity'].value
+_ANTI_TARG_VELOCITY = Navmode['Anti Targ Velocity'].value
+
+_DIRECT = protos.EngineSettings.DIRECT
+_BARNES_HUT = protos.EngineSettings.BARNES_HUT
+_INTERACTION_LIST = protos.EngineSettings.INTERACTION_LIST
+
+# With the AUTO gravity solver, states with at least this many entities use
+# the Barnes-Hut solver. Below this, the exact solver is about as fast. Run
+# `python benchmark.py gravity` to see where the crossover is on your machine.
+BARNES_HUT_MIN_ENTITIES = 1000
+
+# Indices of the values that event_value computes. PhysicsEngine makes its
+# list of events in the same order.
+COLLISION_EVENT = 0
+HAB_FUEL_EVENT = 1
+LIFTOFF_EVENT = 2
+SRB_FUEL_EVENT = 3
+HIGH_ACC_EVENT = 4
+ATMOSPHERE_EVENT = 5
+N_EVENTS = 6
+
+# Flags of DeriveParams.regime, for what derive_into has to work out on top
+# of gravity. A chunk with none of them set is a vacuum coast.
+POWERED = 1  # An engine or the SRBs are firing.
+ATMOSPHERIC = 2  # The craft is in an atmosphere.
+
+# If numba has more than one thread to work with (see numba.set_num_threads),
+# states with at least this many entities use the parallel gravity and
+# collision kernels. With fewer entities, starting up the threads takes longer
+# than the calculation itself. `python benchmark.py threads` measures this.
+PARALLEL_MIN_ENTITIES = 200
+
+
+class DeriveParams(NamedTuple):
+    """Everything the derivative needs that doesn't change during a chunk of
+    simulation. Build one of these with build_params.
+
+    Arrays named after a subset of entities (e.g. thrust, fuel_cons) are
+    indexed the same as the index array of that subset (e.g. artificials)."""
+    M: np.ndarray  # Mass of each entity.
+    R: np.ndarray  # Radius of each entity.
+    # G * (mass + fuel) of each entity. Only artificials ever burn fuel, so
+    # derive_into only refreshes their entries of this array.
+    GM: np.ndarray
+
+    # Entities that can have engines, and their engine capabilities.
+    artificials: np.ndarray
+    thrust: np.ndarray
+    fuel_cons: np.ndarray
+    # If another entity's mass is pushed around by this engine (i.e. the
+    # Habitat docked to AYSE), its index. Otherwise NO_INDEX.
+    docked_mass: np.ndarray
+
+    # Landed pairs, in the same order that PhysicsState.LandedOn returns them,
+    # except that a lander that something else is landed on comes first.
+    landers: np.ndarray
+    grounds: np.ndarray
+    # True if the lander should be put at the ground's docking port.
+    docked: np.ndarray
+    # Which direction each lander is from its ground, and which way it's
+    # pointing, both relative to the ground's heading. See place_landers.
+    lander_angle: np.ndarray
+    lander_heading: np.ndarray
+
+    # Entities with atmospheres, and their atmosphere characteristics.
+    atmospheres: np.ndarray
+    atmosphere_thickness: np.ndarray
+    atmosphere_scaling: np.ndarray
+
+    craft: int
+    habitat: int
+    reference: int
+    target: int
+    navmode: int
+    drag_profile: float
+    # POWERED and ATMOSPHERIC, if they apply at the start of the chunk. See
+    # flight_regime.
+    regime: int
+
+    # One of the protos.EngineSettings.GravitySolver values, never AUTO.
+    gravity_solver: int
+    opening_angle: float
+    # Only used by the interaction list solver, see interactions.build. These
+    # are indexed like sources. interaction_error is the error bound, in m/s^2.
+    interaction_start: np.ndarray
+    interactions: np.ndarray
+    interaction_error: float
+    # True if the parallel kernels should be used, see use_parallel_kernels.
+    parallel: bool
+    # Entities that aren't test particles, and entities that are.
+    sources: np.ndarray
+    test_particles: np.ndarray
+
+    # Scratch space, so that derive_into doesn't allocate on every call. So
+    # only one thread at a time can work out a derivative with these params.
+    # GM_scratch is like GM. source_scratch has a row each for the X, Y, GM,
+    # AX and AY of the sources, when there are test particles.
+    GM_scratch: np.ndarray
+    source_scratch: np.ndarray
+
+
+class EventParams(NamedTuple):
+    """Everything the compiled events need that isn't in the DeriveParams,
+    and doesn't change during a chunk of simulation. Build one of these with
+    build_event_params."""
+    # The index of the entity each entity is landed on, or NO_INDEX.
+    landed_on: np.ndarray
+    # See PhysicsState.CollisionGroups.
+    collision_groups: np.ndarray
+    # True if collisions are found with broad_phase.closest_approach, and
+    # what it needs. sweep_order is sorted in place by every call.
+    broad_phase: bool
+    test_particle: np.ndarray
+    sweep_order: np.ndarray
+    # The current time acc, and the acceleration above which it's too fast.
+    # See HIGH_ACC_EVENT in event_value.
+    time_acc: int
+    acc_bound: float
+
+
+def _index_or_none(state: PhysicsState, name: str) -> int:
+    try:
+        return state._name_to_index(name)
+    except PhysicsState.NoEntityError:
+        return _NO_INDEX
+
+
+def gravity_solver(state: PhysicsState) -> int:
+    """Returns the gravity solver the engine should use for this state, as a
+    protos.EngineSettings.GravitySolver value other than AUTO."""
+    solver = state.engine_settings.gravity_solver
+    if solver == protos.EngineSettings.AUTO:
+        # Test particles don't go in the Barnes-Hut tree, so don't count them.
+        if np.count_nonzero(~state.TestParticles) >= \
+                BARNES_HUT_MIN_ENTITIES:
+            solver = _BARNES_HUT
+        else:
+            solver = _DIRECT
+    return solver
+
+
+def use_parallel_kernels(n_entities: int) -> bool:
+    """Returns True if the calling thread should use the parallel gravity and
+    collision kernels for this many entities.
+
+    numba.set_num_threads only affects the thread that calls it, so this
+    has to be called from the thread that will be doing the calculations."""
+    return (numba.get_num_threads() > 1 and
+            n_entities >= PARALLEL_MIN_ENTITIES)
+
+
+def build_params(state: PhysicsState) -> DeriveParams:
+    """Precomputes everything the derivative of this state will need.
+
+    This has to be called again whenever anything other than the y-vector
+    changes, e.g. after a collision, a liftoff, or an engineering update."""
+    artificials = []
+    thrust = []
+    fuel_cons = []
+    docked_mass = []
+    atmosphere_thickness = []
+    atmosphere_scaling = []
+
+    landed_on = state.LandedOn
+    habitat = _index_or_none(state, common.HABITAT)
+    ayse = _index_or_none(state, common.AYSE)
+
+    for index, entity in enumerate(state._proto_state.entities):
+        if entity.artificial:
+            # Artificial entities without an entry in craft_capabilities
+            # (e.g. the Module) don't have engines.
+            capability = common.craft_capabilities.get(
+                entity.name, common.Spacecraft(0, 0, 0))
+            artificials.append(index)
+            thrust.append(capability.thrust)
+            fuel_cons.append(capability.fuel_cons)
+            if index == ayse and habitat != _NO_INDEX and \
+                    landed_on.get(habitat) == ayse:
+                docked_mass.append(habitat)
+            else:
+                docked_mass.append(_NO_INDEX)
+
+    for index in state.Atmospheres:
+        entity = state._proto_state.entities[index]
+        atmosphere_thickness.append(entity.atmosphere_thickness)
+        atmosphere_scaling.append(entity.atmosphere_scaling)
+
+    # place_landers has to place whatever a lander is landed on before
+    # placing the lander.
+    landers = sorted(landed_on.keys(),
+                     key=lambda lander: -_n_landed_on(lander, landed_on))
+    grounds = [landed_on[lander] for lander in landers]
+    docked = [lander == habitat and ground == ayse
+              for lander, ground in zip(landers, grounds)]
+    lander_angle = []
+    lander_heading = []
+    for lander, ground, at_port in zip(landers, grounds, docked):
+        if at_port:
+            lander_angle.append(math.pi)
+        else:
+            lander_angle.append(math.atan2(
+                state.Y[lander] - state.Y[ground],
+                state.X[lander] - state.X[ground]) - state.Heading[ground])
+        lander_heading.append(state.Heading[lander] - state.Heading[ground])
+
+    drag_profile = common.HAB_DRAG_PROFILE
+    if state.parachute_deployed:
+        drag_profile += common.PARACHUTE_DRAG_PROFILE
+
+    craft = state.craft
+    M = np.array([entity.mass for entity in state._proto_state.entities],
+                 dtype=PhysicsState.DTYPE)
+    GM = common.G * (M + state.Fuel)
+    sources = np.flatnonzero(~state.TestParticles)
+    solver = gravity_solver(state)
+    if solver == _INTERACTION_LIST:
+        interaction_start, interaction_list, interaction_error = \
+            interactions.build(
+                state.X[sources], state.Y[sources], GM[sources],
+                state.engine_settings.interaction_threshold or
+                interactions.DEFAULT_THRESHOLD)
+    else:
+        interaction_start = np.zeros(1, dtype=np.int64)
+        interaction_list = np.empty(0, dtype=np.int64)
+        interaction_error = 0.0
+    params = DeriveParams(
+        M=M,
+        R=np.array([entity.r for entity in state._proto_state.entities],
+                   dtype=PhysicsState.DTYPE),
+        GM=GM,
+        artificials=np.array(artificials, dtype=np.int64),
+        thrust=np.array(thrust, dtype=PhysicsState.DTYPE),
+        fuel_cons=np.array(fuel_cons, dtype=PhysicsState.DTYPE),
+        docked_mass=np.array(docked_mass, dtype=np.int64),
+        landers=np.array(landers, dtype=np.int64),
+        grounds=np.array(grounds, dtype=np.int64),
+        docked=np.array(docked, dtype=np.bool_),
+        lander_angle=np.array(lander_angle, dtype=PhysicsState.DTYPE),
+        lander_heading=np.array(lander_heading, dtype=PhysicsState.DTYPE),
+        atmospheres=np.array(state.Atmospheres, dtype=np.int64),
+        atmosphere_thickness=np.array(
+            atmosphere_thickness, dtype=PhysicsState.DTYPE),
+        atmosphere_scaling=np.array(
+            atmosphere_scaling, dtype=PhysicsState.DTYPE),
+        craft=_NO_INDEX if craft is None else state._name_to_index(craft),
+        habitat=habitat,
+        reference=_index_or_none(state, state.reference),
+        target=_index_or_none(state, state.target),
+        navmode=state.navmode.value,
+        drag_profile=drag_profile,
+        regime=0,
+        gravity_solver=solver,
+        opening_angle=(state.engine_settings.opening_angle or
+                       barnes_hut.DEFAULT_OPENING_ANGLE),
+        interaction_start=interaction_start,
+        interactions=interaction_list,
+        interaction_error=interaction_error,
+        parallel=use_parallel_kernels(len(state)),
+        sources=sources,
+        test_particles=np.flatnonzero(state.TestParticles),
+        GM_scratch=np.empty_like(GM),
+        source_scratch=np.empty((5, len(sources)), dtype=PhysicsState.DTYPE)
+    )
+    return params._replace(regime=flight_regime(state, params))
+
+
+def flight_regime(state: PhysicsState, params: DeriveParams) -> int:
+    """Returns the DeriveParams.regime flags that apply to this state.
+
+    Throttles and SRBs only ever change between chunks of simulation, and
+    fuel and SRB time only ever run out (which HAB_FUEL_EVENT and
+    SRB_FUEL_EVENT end the chunk for), so nothing starts thrusting during a
+    chunk that isn't POWERED. ATMOSPHERE_EVENT ends a chunk that isn't
+    ATMOSPHERIC when the craft gets to an atmosphere. A craft that leaves an
+    atmosphere is only moved out of the ATMOSPHERIC regime in the next
+    chunk, since derive_into works out zero drag for it anyway."""
+    regime = 0
+    for k in range(len(params.artificials)):
+        index = params.artificials[k]
+        if state.Fuel[index] > 0 and state.Throttle[index] > 0:
+            regime |= POWERED
+    if state.srb_time >= 0 and params.habitat != _NO_INDEX:
+        regime |= POWERED
+    if params.craft != _NO_INDEX and \
+            atmosphere_margin(state.X, state.Y, params) < 1:
+        regime |= ATMOSPHERIC
+    return regime
+
+
+def _n_landed_on(entity: int, landed_on: Dict[int, int]) -> int:
+    """How many entities are landed on this entity, directly or not."""
+    count = 0
+    for lander in landed_on:
+        ground = landed_on[lander]
+        # Stop at cycles, which there shouldn't be anyway.
+        for _ in range(len(landed_on)):
+            if ground == entity:
+                count += 1
+                break
+            if ground not in landed_on:
+                break
+            ground = landed_on[ground]
+    return count
+
+
+def build_event_params(state: PhysicsState,
+                       acc_bound: float) -> EventParams:
+    """Precomputes everything the compiled events will need, along with
+    build_params(state). acc_bound is the HIGH_ACC_EVENT bound of the
+    state's time acc, see engine.TIME_ACC_TO_BOUND."""
+    landed_on = np.full(len(state), _NO_INDEX, dtype=np.int64)
+    for lander, ground in state.LandedOn.items():
+        landed_on[lander] = ground
+    R = np.array([entity.r for entity in state._proto_state.entities],
+                 dtype=PhysicsState.DTYPE)
+    return EventParams(
+        landed_on=landed_on, collision_groups=state.CollisionGroups,
+        broad_phase=broad_phase.worthwhile(len(state)),
+        test_particle=state.TestParticles,
+        sweep_order=broad_phase.sweep_order(state.X, R),
+        time_acc=round(state.time_acc), acc_bound=acc_bound)
+
+
+def derive(t: float, y_1d: np.ndarray, params: DeriveParams) -> np.ndarray:
+    """The derivative of y_1d, for use as the `fun` of solve_ivp.
+
+    See PhysicsEngine._derive for a description of the y-vector."""
+    # solve_ivp holds on to the arrays we return (e.g. as the derivative at
+    # the start of the next step), so a single output buffer can't be shared
+    # between calls here. Callers that manage their own stage buffers can
+    # call derive_into instead.
+    out = np.empty_like(y_1d)
+    derive_into(y_1d, out, params, *gravity_kernels(params))
+    return out
+
+
+class DerivativeCache:
+    """The last derivative an integrator worked out, and the t and y-vector
+    it's the derivative of, so that HIGH_ACC_EVENT can use it instead of
+    working it out again.
+
+    The Runge-Kutta methods work out the derivative at the end of every step
+    as part of the step, and then call the events at exactly that t and
+    y-vector, so with those this always has the derivative that the events
+    need."""
+
+    def __init__(self):
+        self.t: Optional[float] = None
+        self.y_1d = np.empty(0)
+        self.dy = np.empty(0)
+
+    def store(self, t: float, y_1d: np.ndarray, dy: np.ndarray):
+        """Remembers that dy is the derivative of y_1d. Both are copied, so
+        the caller can reuse its arrays."""
+        if len(self.y_1d) != len(y_1d):
+            self.y_1d = np.empty_like(y_1d)
+            self.dy = np.empty_like(dy)
+        np.copyto(self.y_1d, y_1d)
+        np.copyto(self.dy, dy)
+        self.t = t
+
+    def lookup(self, t: float, y_1d: np.ndarray) -> Optional[np.ndarray]:
+        """Returns the derivative of y_1d at t, if it's the last one stored,
+        or None."""
+        if t == self.t and np.array_equal(y_1d, self.y_1d):
+            return self.dy
+        return None
+
+
+def continuous(params: DeriveParams) -> np.ndarray:
+    """Sorted indices of the elements of the y-vector that have to be
+    integrated: the position, velocity, and heading of every entity that
+    isn't landed, the fuel of artificials, and the SRB time.
+
+    Everything else (spins, throttles, landed_on, broken, the fuel of natural
+    bodies, and time_acc) stays the same for a whole chunk of simulation, and
+    only changes when the engine handles an event or a command. Landed
+    entities move, but only with what they're landed on, so place_landers
+    works out where they are instead."""
+    n = len(params.M)
+    y_size = len(_FIELD_ORDERING) * n + PhysicsState.N_SINGULAR_ELEMENTS
+    free = np.setdiff1d(np.arange(n), params.landers)
+    indices = [field * n + free for field in [_X, _Y, _VX, _VY, _HEADING]]
+    indices.append(_FUEL * n + params.artificials)
+    indices.append(np.array([y_size + _SRB_TIME_INDEX]))
+    return np.sort(np.concatenate(indices)).astype(np.int64)
+
+
+def reconcile(state: PhysicsState, params: DeriveParams) -> None:
+    """In-place version of the reconciliation that derive_into does to its
+    copy of the velocities and spins. See _reconcile_entity_dynamics."""
+    _reconcile(state.X, state.Y, state.VX, state.VY, state.Heading,
+               state.Spin, params)
+
+
+@numba.jit(nopython=True, nogil=True)
+def place_landers(y_1d, params):
+    """Moves every landed entity in y_1d to where it is on what it's landed
+    on, in place. Landers stay at the same place on their ground's surface
+    that they were when params was built, and turn with it.
+
+    Solvers that leave landers out of the integration (see continuous) call
+    this on every y-vector, before the derivative or events see it."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    VX = y_1d[_VX * n:(_VX + 1) * n]
+    VY = y_1d[_VY * n:(_VY + 1) * n]
+    Heading = y_1d[_HEADING * n:(_HEADING + 1) * n]
+    Spin = y_1d[_SPIN * n:(_SPIN + 1) * n]
+    for k in range(len(params.landers)):
+        lander = params.landers[k]
+        ground = params.grounds[k]
+        angle = Heading[ground] + params.lander_angle[k]
+        X[lander] = X[ground] + math.cos(angle) * (
+            params.R[ground] + params.R[lander])
+        Y[lander] = Y[ground] + math.sin(angle) * (
+            params.R[ground] + params.R[lander])
+        Heading[lander] = Heading[ground] + params.lander_heading[k]
+        Spin[lander] = Spin[ground]
+        # Same as _reconcile.
+        VX[lander] = VX[ground] - (Y[lander] - Y[ground]) * Spin[ground]
+        VY[lander] = VY[ground] + (X[lander] - X[ground]) * Spin[ground]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _direct_gravity(X, Y, GM, params, AX, AY):
+    calc.grav_acc_into(X, Y, GM, AX, AY)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _parallel_direct_gravity(X, Y, GM, params, AX, AY):
+    calc.grav_acc_into_parallel(X, Y, GM, AX, AY)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _barnes_hut_gravity(X, Y, GM, params, AX, AY):
+    barnes_hut.grav_acc_into(X, Y, GM, AX, AY, params.opening_angle)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _parallel_barnes_hut_gravity(X, Y, GM, params, AX, AY):
+    barnes_hut.grav_acc_into_parallel(X, Y, GM, AX, AY, params.opening_angle)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _interaction_list_gravity(X, Y, GM, params, AX, AY):
+    interactions.grav_acc_into(X, Y, GM, params.interaction_start,
+                               params.interactions, AX, AY)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _parallel_interaction_list_gravity(X, Y, GM, params, AX, AY):
+    interactions.grav_acc_into_parallel(X, Y, GM, params.interaction_start,
+                                        params.interactions, AX, AY)
+
+
+def gravity_kernels(params: DeriveParams) -> tuple:
+    """Returns the gravity kernels to pass to derive_into: one for how
+    sources pull on each other, and one for how they pull on test particles.
+
+    The kernels are arguments of derive_into, instead of being chosen inside
+    it, so that numba only compiles the gravity solvers that are used."""
+    if params.gravity_solver == _BARNES_HUT:
+        if params.parallel:
+            gravity = _parallel_barnes_hut_gravity
+        else:
+            gravity = _barnes_hut_gravity
+    elif params.gravity_solver == _INTERACTION_LIST:
+        if params.parallel:
+            gravity = _parallel_interaction_list_gravity
+        else:
+            gravity = _interaction_list_gravity
+    elif params.parallel:
+        gravity = _parallel_direct_gravity
+    else:
+        gravity = _direct_gravity
+
+    if params.parallel:
+        return gravity, calc.test_particle_acc_into_parallel
+    return gravity, calc.test_particle_acc_into
+
+
+@numba.jit(nopython=True, nogil=True)
+def derive_into(y_1d, out, params, gravity, test_particle_gravity):
+    """Writes the derivative of y_1d into out, which must be the same shape.
+    Pass gravity_kernels(params) as the last two arguments.
+
+    Thrust and fuel use are only worked out if params.regime is POWERED, and
+    drag only if it's ATMOSPHERIC, see flight_regime. Otherwise, this does
+    the same work that PhysicsEngine._derive used to do in Python, in the
+    same order."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    VX = y_1d[_VX * n:(_VX + 1) * n]
+    VY = y_1d[_VY * n:(_VY + 1) * n]
+    Heading = y_1d[_HEADING * n:(_HEADING + 1) * n]
+    Spin = y_1d[_SPIN * n:(_SPIN + 1) * n]
+    Fuel = y_1d[_FUEL * n:(_FUEL + 1) * n]
+    Throttle = y_1d[_THROTTLE * n:(_THROTTLE + 1) * n]
+
+    # The derivative of position and heading are velocity and spin, after
+    # they've been reconciled (see _reconcile_entity_dynamics). Reconcile
+    # copies that live in the output buffer. The acceleration slots are used
+    # as scratch space for the reconciled positions, since they get
+    # overwritten below anyway.
+    out[:] = 0
+    dX = out[_X * n:(_X + 1) * n]
+    dY = out[_Y * n:(_Y + 1) * n]
+    AX = out[_VX * n:(_VX + 1) * n]
+    AY = out[_VY * n:(_VY + 1) * n]
+    dHeading = out[_HEADING * n:(_HEADING + 1) * n]
+    dFuel = out[_FUEL * n:(_FUEL + 1) * n]
+    dX[:] = VX
+    dY[:] = VY
+    dHeading[:] = Spin
+    AX[:] = X
+    AY[:] = Y
+    _reconcile(AX, AY, dX, dY, Heading, dHeading, params)
+
+    GM = params.GM
+    if params.regime & POWERED:
+        # Otherwise, no fuel is being used, and GM is already up to date.
+        # params.GM is shared by everything simulating this chunk, so don't
+        # change it.
+        GM = params.GM_scratch
+        GM[:] = params.GM
+        for k in range(len(params.artificials)):
+            i = params.artificials[k]
+            GM[i] = common.G * (params.M[i] + Fuel[i])
+    if len(params.test_particles) == 0:
+        gravity(X, Y, GM, params, AX, AY)
+    else:
+        sources = params.sources
+        X_sources = params.source_scratch[0]
+        Y_sources = params.source_scratch[1]
+        GM_sources = params.source_scratch[2]
+        AX_sources = params.source_scratch[3]
+        AY_sources = params.source_scratch[4]
+        for k in range(len(sources)):
+            X_sources[k] = X[sources[k]]
+            Y_sources[k] = Y[sources[k]]
+            GM_sources[k] = GM[sources[k]]
+        gravity(X_sources, Y_sources, GM_sources, params,
+                AX_sources, AY_sources)
+        for k in range(len(sources)):
+            AX[sources[k]] = AX_sources[k]
+            AY[sources[k]] = AY_sources[k]
+        test_particle_gravity(X, Y, GM, sources,
+                              params.test_particles, AX, AY)
+
+    if params.regime & POWERED:
+        # Engine thrust and fuel consumption
+        for k in range(len(params.artificials)):
+            i = params.artificials[k]
+            if Fuel[i] > 0 and Throttle[i] > 0:
+                dFuel[i] = -abs(params.fuel_cons[k] * Throttle[i])
+                mass = params.M[i] + Fuel[i]
+                docked = params.docked_mass[k]
+                if docked != _NO_INDEX:
+                    mass += params.M[docked] + Fuel[docked]
+                eng_acc = params.thrust[k] * Throttle[i] / mass
+                AX[i] += eng_acc * math.cos(Heading[i])
+                AY[i] += eng_acc * math.sin(Heading[i])
+
+        # And SRB thrust
+        if y_1d[_SRB_TIME_INDEX] >= 0 and params.habitat != _NO_INDEX:
+            hab = params.habitat
+            srb_acc = common.SRB_THRUST / (params.M[hab] + Fuel[hab])
+            AX[hab] += srb_acc * math.cos(Heading[hab])
+            AY[hab] += srb_acc * math.sin(Heading[hab])
+            out[_SRB_TIME_INDEX] = -1
+
+    # Drag effects
+    if params.regime & ATMOSPHERIC:
+        drag_x, drag_y = drag(X, Y, VX, VY, Spin, params)
+        AX[params.craft] -= drag_x
+        AY[params.craft] -= drag_y
+
+    # Centripetal acceleration to keep landed entities glued to each other.
+    for k in range(len(params.landers)):
+        lander = params.landers[k]
+        ground = params.grounds[k]
+        AX[lander] = AX[ground] - (X[lander] - X[ground]) * Spin[ground] ** 2
+        AY[lander] = AY[ground] - (Y[lander] - Y[ground]) * Spin[ground] ** 2
+
+
+@numba.jit(nopython=True, nogil=True)
+def drag(X, Y, VX, VY, Spin, params):
+    """Returns the atmospheric drag on the craft, as an acceleration opposite
+    to the direction of the returned vector. Zero if there's no drag.
+    Compiled equivalent of calc.drag and calc.relevant_atmosphere."""
+    craft = params.craft
+    closest = _NO_INDEX
+    closest_k = 0
+    closest_distance = np.inf
+    for k in range(len(params.atmospheres)):
+        atmosphere = params.atmospheres[k]
+        dist = math.sqrt((X[atmosphere] - X[craft]) ** 2 +
+                         (Y[atmosphere] - Y[craft]) ** 2)
+        if dist < closest_distance:
+            exponential = (
+                -(dist - params.R[craft] - params.R[atmosphere]) / 1000 /
+                params.atmosphere_scaling[k])
+            if exponential > -20:
+                closest_distance = dist
+                closest = atmosphere
+                closest_k = k
+
+    if closest == _NO_INDEX:
+        return 0.0, 0.0
+
+    # This is calc.rotational_speed, with |norm| * unit_tang == tang.
+    norm_x = X[craft] - X[closest]
+    norm_y = Y[craft] - Y[closest]
+    wind_x = VX[craft] - (VX[closest] - norm_y * Spin[closest])
+    wind_y = VY[craft] - (VY[closest] + norm_x * Spin[closest])
+    wind_squared = wind_x * wind_x + wind_y * wind_y
+    if wind_squared < 0.01:
+        # The craft is stationary
+        return 0.0, 0.0
+
+    pressure = params.atmosphere_thickness[closest_k] * math.exp(
+        -(closest_distance - params.R[craft] - params.R[closest]) / 1000 /
+        params.atmosphere_scaling[closest_k])
+    wind_mag = math.sqrt(wind_squared)
+    drag_acc = pressure * wind_squared * params.drag_profile
+    return drag_acc * wind_x / wind_mag, drag_acc * wind_y / wind_mag
+
+
+@numba.jit(nopython=True, nogil=True)
+def atmosphere_margin(X, Y, params):
+    """Returns how far the craft is from having any drag on it, in the
+    number of times the pressure of the closest atmosphere would have to
+    grow by a factor of e. This is zero where drag first applies, and
+    negative inside an atmosphere, or infinite if there are no
+    atmospheres."""
+    craft = params.craft
+    margin = np.inf
+    for k in range(len(params.atmospheres)):
+        atmosphere = params.atmospheres[k]
+        dist = math.sqrt((X[atmosphere] - X[craft]) ** 2 +
+                         (Y[atmosphere] - Y[craft]) ** 2)
+        # Same as the exponential in drag.
+        margin = min(margin, (dist - params.R[craft] - params.R[atmosphere])
+                     / 1000 / params.atmosphere_scaling[k] - 20)
+    return margin
+
+
+@numba.jit(nopython=True, nogil=True)
+def event_value(event, y_1d, dy, params, event_params):
+    """Returns the value of one of the events in engine.py at y_1d, where
+    event is COLLISION_EVENT, HAB_FUEL_EVENT, etc. dy is the derivative of
+    y_1d, and is only used by HIGH_ACC_EVENT.
+
+    test.py checks these against reference implementations in Python."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    Fuel = y_1d[_FUEL * n:(_FUEL + 1) * n]
+    Throttle = y_1d[_THROTTLE * n:(_THROTTLE + 1) * n]
+
+    if event == COLLISION_EVENT:
+        if event_params.broad_phase:
+            altitude, _, _ = broad_phase.closest_approach(
+                X, Y, params.R, event_params.landed_on,
+                event_params.collision_groups, event_params.test_particle,
+                event_params.sweep_order)
+        elif params.parallel:
+            altitude, _, _ = calc.closest_approach_parallel(
+                X, Y, params.R, event_params.landed_on,
+                event_params.collision_groups, params.sources,
+                params.test_particles)
+        else:
+            altitude, _, _ = calc.closest_approach(
+                X, Y, params.R, event_params.landed_on,
+                event_params.collision_groups, params.sources,
+                params.test_particles)
+        return altitude
+
+    elif event == HAB_FUEL_EVENT:
+        for k in range(len(params.artificials)):
+            i = params.artificials[k]
+            if Throttle[i] != 0:
+                return Fuel[i]
+        return np.inf
+
+    elif event == LIFTOFF_EVENT:
+        craft = params.craft
+        if craft == _NO_INDEX:
+            return np.inf
+        ground = event_params.landed_on[craft]
+        if ground == _NO_INDEX:
+            return np.inf
+        thrust = 0.0
+        for k in range(len(params.artificials)):
+            if params.artificials[k] == ground:
+                # Undocking is handled elsewhere.
+                return np.inf
+            if params.artificials[k] == craft:
+                thrust = params.thrust[k] * Throttle[craft]
+        if y_1d[_SRB_TIME_INDEX] > 0 and craft == params.habitat:
+            thrust += common.SRB_THRUST
+        weight = common.G * params.M[craft] * params.M[ground] / (
+            (X[craft] - X[ground]) ** 2 + (Y[craft] - Y[ground]) ** 2)
+        return max(0.0, common.LAUNCH_TWR - thrust / weight)
+
+    elif event == SRB_FUEL_EVENT:
+        return y_1d[_SRB_TIME_INDEX]
+
+    elif event == ATMOSPHERE_EVENT:
+        if params.craft == _NO_INDEX or params.regime & ATMOSPHERIC:
+            return np.inf
+        return atmosphere_margin(X, Y, params)
+
+    else:
+        if params.craft == _NO_INDEX or event_params.time_acc == 1:
+            return np.inf
+        # Zero once any artificial entity accelerates faster than the
+        # time acc can accurately simulate.
+        max_acc_mag = 0.0005  # A small nonzero value.
+        for k in range(len(params.artificials)):
+            i = params.artificials[k]
+            acc_mag = math.sqrt(dy[_VX * n + i] ** 2 + dy[_VY * n + i] ** 2)
+            if acc_mag > max_acc_mag:
+                max_acc_mag = acc_mag
+        return max(event_params.acc_bound - max_acc_mag, 0.0)
+
+
+@numba.jit(nopython=True, nogil=True)
+def event_values(y_1d, dy, params, event_params, out):
+    """Puts the value of every event at y_1d into out, in one compiled call.
+    out[COLLISION_EVENT] is the value of the collision event, and so on."""
+    for event in range(N_EVENTS):
+        out[event] = event_value(event, y_1d, dy, params, event_params)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _reconcile(X, Y, VX, VY, Heading, Spin, params):
+    """Sets velocities and spins of some entities, in place.
+    Compiled equivalent of what _reconcile_entity_dynamics used to do."""
+    # Navmode auto-rotation
+    if params.navmode != _MANUAL and params.craft != _NO_INDEX:
+        Spin[params.craft] = _navmode_spin(X, Y, VX, VY, Heading, params)
+
+    # Keep landed entities glued together
+    for k in range(len(params.landers)):
+        lander = params.landers[k]
+        ground = params.grounds[k]
+        if params.docked[k]:
+            # Always put the Habitat at the docking port.
+            X[lander] = X[ground] - math.cos(Heading[ground]) * (
+                params.R[lander] + params.R[ground])
+            Y[lander] = Y[ground] - math.sin(Heading[ground]) * (
+                params.R[lander] + params.R[ground])
+        else:
+            norm_x = X[lander] - X[ground]
+            norm_y = Y[lander] - Y[ground]
+            norm = math.sqrt(norm_x * norm_x + norm_y * norm_y)
+            X[lander] = X[ground] + norm_x / norm * (
+                params.R[ground] + params.R[lander])
+            Y[lander] = Y[ground] + norm_y / norm * (
+                params.R[ground] + params.R[lander])
+
+        Spin[lander] = Spin[ground]
+        # This is calc.rotational_speed, with |norm| * unit_tang == tang.
+        VX[lander] = VX[ground] - (Y[lander] - Y[ground]) * Spin[ground]
+        VY[lander] = VY[ground] + (X[lander] - X[ground]) * Spin[ground]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _navmode_heading(X, Y, VX, VY, Heading, params):
+    """Compiled equivalent of calc.navmode_heading."""
+    craft = params.craft
+    ref = params.reference
+    targ = params.target
+    navmode = params.navmode
+
+    if navmode == _CCW_PROGRADE or navmode == _CW_RETROGRADE or \
+            navmode == _DEPART_REFERENCE:
+        if ref == craft or ref == _NO_INDEX:
+            return Heading[craft]
+        normal_x = X[craft] - X[ref]
+        normal_y = Y[craft] - Y[ref]
+        if navmode == _CCW_PROGRADE:
+            return math.atan2(normal_x, -normal_y)
+        elif navmode == _CW_RETROGRADE:
+            return math.atan2(-normal_x, normal_y)
+        else:
+            return math.atan2(normal_y, normal_x)
+    else:
+        if targ == craft or targ == _NO_INDEX:
+            return Heading[craft]
+        if navmode == _APPROACH_TARGET:
+            return math.atan2(Y[targ] - Y[craft], X[targ] - X[craft])
+        elif navmode == _PRO_TARG_VELOCITY:
+            return math.atan2(VY[craft] - VY[targ], VX[craft] - VX[targ])
+        else:
+            return math.atan2(VY[targ] - VY[craft], VX[targ] - VX[craft])
+
+
+@numba.jit(nopython=True, nogil=True)
+def _navmode_spin(X, Y, VX, VY, Heading, params):
+    """Compiled equivalent of calc.navmode_spin."""
+    heading = Heading[params.craft]
+    requested_heading = _navmode_heading(X, Y, VX, VY, Heading, params)
+    ccw_distance = (requested_heading - heading) % (2 * np.pi)
+    cw_distance = (heading - requested_heading) % (2 * np.pi)
+    if ccw_distance < cw_distance:
+        heading_difference = ccw_distance
+    else:
+        heading_difference = -cw_distance
+    if abs(heading_difference) < common.AUTOPILOT_FINE_CONTROL_RADIUS:
+        return heading_difference
+    else:
+        return np.sign(heading_difference) * common.AUTOPILOT_SPEED
@@ -0,0 +1,274 @@
+"""Integrating the craft with Encke's method.
+
+A craft orbiting its reference is pulled almost entirely by the reference,
+and everything else (the other bodies, drag) only nudges it off the conic
+that the reference alone would have it follow. The integrator doesn't know
+that, and resolves the whole of the craft's motion step by step.
+
+solve_ivp here integrates the craft's position and velocity as how far it is
+off that conic instead, like packed.solve_ivp integrates everything else.
+At the start of every chunk, the osculating conic is the one the craft would
+follow if only the reference pulled on it, and kepler.drift says exactly
+where on it the craft would be at any time. The deviation from the conic
+starts at zero, and its derivative is only the difference between the
+craft's actual acceleration relative to the reference and the acceleration
+on the conic, which is small and smooth. When the deviation grows to more
+than RECTIFY of the craft's distance from the reference, the conic is
+rectified: it's worked out again from where the craft actually is, and the
+deviation starts at zero again.
+
+The craft's deviation gets the tolerances that the craft would get in
+relative coordinates (see relative.py), relative to its distance from the
+reference and its speed relative to it at the start of the chunk. Like
+regularized.py, this only changes how the craft is integrated, and max_step
+still limits every step, since fast moons need that. So this mostly makes the
+craft more accurate for the same steps: in LEO.json with a max step of 1000
+s, the craft ends up centimetres from where it should be after 20,000 s,
+instead of tens of kilometres. `python benchmark.py encke` measures this."""
+
+import math
+from typing import Callable, List, Optional
+
+import numba
+import numpy as np
+import scipy.integrate
+
+from orbitx.physics import dynamics, integrators, kepler, packed, \
+    relative, symplectic, tolerances
+
+_NO_INDEX = dynamics._NO_INDEX
+_X = dynamics._X
+_Y = dynamics._Y
+_VX = dynamics._VX
+_VY = dynamics._VY
+
+# The conic is rectified once the craft is this far off it, as a fraction of
+# its distance from the reference.
+RECTIFY = 1e-2
+
+
+def applies(params: dynamics.DeriveParams) -> bool:
+    """Returns True if there's a craft in flight and a reference that isn't
+    landed on anything, which solve_ivp needs, and no engines or SRBs are
+    firing. Thrust pushes the craft off its conic so fast that the conic
+    would need rectifying every few steps. Use the Encke integrator's
+    fallback otherwise."""
+    return not params.regime & dynamics.POWERED and \
+        params.craft != _NO_INDEX and \
+        params.reference != _NO_INDEX and \
+        params.craft != params.reference and \
+        params.craft not in params.landers and \
+        params.reference not in params.landers
+
+
+def solve_ivp(params: dynamics.DeriveParams, t_span: List[float],
+              y0: np.ndarray, events: list, method: str, max_step: float,
+              profile: tolerances.Profile = tolerances.PROFILES[
+                  tolerances.DEFAULT_PROFILE],
+              orbits: Optional[symplectic.Hierarchy] = None
+              ) -> integrators.Result:
+    """Like packed.solve_ivp, but integrates the craft as its deviation from
+    an osculating conic around its reference.
+
+    Only call this if applies(params) is True."""
+    n = len(params.M)
+    craft = params.craft
+    integrated = dynamics.continuous(params)
+    rtol, atol = tolerances.packed(profile, params, integrated, method)
+    gravity, test_particle_gravity = dynamics.gravity_kernels(params)
+    if orbits is None:
+        primary = np.full(n, _NO_INDEX, dtype=np.int64)
+        order = np.empty(0, dtype=np.int64)
+    else:
+        # The craft's deviation isn't relative to anything, and neither is
+        # anything that would otherwise be relative to the craft.
+        primary = orbits.primary.copy()
+        primary[(primary == craft) | (np.arange(n) == craft)] = _NO_INDEX
+        order = orbits.order
+    # Where the craft's fields are in the packed y-vector.
+    deviation = np.searchsorted(
+        integrated, np.array([_X, _Y, _VX, _VY]) * n + craft)
+    y_1d = y0.copy()
+    dy = np.empty_like(y0)
+    dy_relative = np.empty_like(y0)
+
+    # The tolerances for the craft's deviation are added to these.
+    deviation_rtol = np.broadcast_to(rtol, atol.shape)[deviation]
+    deviation_atol = atol[deviation]
+
+    t, t_end = t_span
+    y_start = y0.copy()
+    dynamics.place_landers(y_start, params)
+    pieces: List[_Piece] = []
+    t_events: List[list] = [[] for _ in events]
+    nfev = 0
+    while True:
+        conic = _osculating(y_start, params, t)
+        atol[deviation] = deviation_atol + deviation_rtol * np.repeat(
+            [math.hypot(conic[0], conic[1]), math.hypot(conic[2], conic[3])],
+            2)
+
+        def fun(t: float, z: np.ndarray) -> np.ndarray:
+            return _derive(t, z, y_1d, dy, dy_relative, integrated, params,
+                           gravity, test_particle_gravity, primary, order,
+                           conic, deviation)
+
+        unpack = _unpacker(y0, integrated, params, primary, order, conic,
+                           deviation)
+
+        def rectify(t: float, z: np.ndarray) -> float:
+            return _rectify_margin(t, z, conic, deviation)
+        rectify.terminal = True
+        rectify.direction = -1
+
+        z0 = y_start.copy()
+        relative.to_relative(z0, primary, order)
+        z0 = z0[integrated]
+        z0[deviation] = 0
+        unpacked = packed._Unpacked(unpack)
+        ivp_out = scipy.integrate.solve_ivp(
+            fun=fun, t_span=[t, t_end], y0=z0,
+            events=[packed._UnpackedEvent(event, unpacked)
+                    for event in events] +
+            [rectify], dense_output=True, method=method, max_step=max_step,
+            rtol=rtol, atol=atol)
+        nfev += ivp_out.nfev
+        if not ivp_out.success:
+            return integrators.Result(
+                t=ivp_out.t, y=ivp_out.y, sol=None, t_events=[],
+                status=ivp_out.status, success=False,
+                message=ivp_out.message, nfev=nfev)
+        pieces.append(_Piece(ivp_out, unpack))
+        for event_t, found in zip(t_events, ivp_out.t_events):
+            event_t.extend(found)
+        t = ivp_out.t[-1]
+        if ivp_out.status == 0 or any(
+                len(found) for found in ivp_out.t_events[:-1]):
+            break
+        # Only the conic needs rectifying, which isn't a real event.
+        y_start = pieces[-1].y[:, -1]
+
+    return integrators.Result(
+        t=np.concatenate([pieces[0].t[:1]] +
+                         [piece.t[1:] for piece in pieces]),
+        y=np.concatenate([pieces[0].y[:, :1]] +
+                         [piece.y[:, 1:] for piece in pieces], axis=1),
+        sol=_Solution(pieces),
+        t_events=[np.array(event_t) for event_t in t_events],
+        status=ivp_out.status, message=ivp_out.message, nfev=nfev)
+
+
+def _osculating(y_1d: np.ndarray, params: dynamics.DeriveParams,
+                t: float) -> np.ndarray:
+    """Returns the conic that the craft would follow around its reference
+    from time t, if only its reference pulled on it, as its position and
+    velocity relative to its reference at t, mu, and t."""
+    n = len(params.M)
+    craft = params.craft
+    reference = params.reference
+    mu = params.GM[reference]
+    if craft not in params.test_particles:
+        mu += params.GM[craft]
+    return np.array([
+        y_1d[_X * n + craft] - y_1d[_X * n + reference],
+        y_1d[_Y * n + craft] - y_1d[_Y * n + reference],
+        y_1d[_VX * n + craft] - y_1d[_VX * n + reference],
+        y_1d[_VY * n + craft] - y_1d[_VY * n + reference],
+        mu, t])
+
+
+def _unpacker(y0: np.ndarray, integrated: np.ndarray,
+              params: dynamics.DeriveParams, primary: np.ndarray,
+              order: np.ndarray, conic: np.ndarray,
+              deviation: np.ndarray) -> Callable:
+    """Returns unpack(t, z), which returns the whole y-vector."""
+    def unpack(t: float, z: np.ndarray) -> np.ndarray:
+        y_full = y0.copy()
+        _fill(t, z, y_full, integrated, params, primary, order, conic,
+              deviation)
+        return y_full
+    return unpack
+
+
+class _Piece:
+    """What scipy integrated between two rectifications, as whole
+    y-vectors."""
+
+    def __init__(self, ivp_out, unpack: Callable):
+        self.t = ivp_out.t
+        self.y = np.array([unpack(t, z)
+                           for t, z in zip(ivp_out.t, ivp_out.y.T)]).T
+        self.sol = ivp_out.sol
+        self.unpack = unpack
+
+
+class _Solution:
+    """Dense output of solve_ivp, used like scipy's OdeSolution."""
+
+    def __init__(self, pieces: List[_Piece]):
+        self.pieces = pieces
+        self.t_min = pieces[0].t[0]
+        self.t_max = pieces[-1].t[-1]
+        # When each piece after the first starts.
+        self.starts = np.array([piece.t[0] for piece in pieces[1:]])
+
+    def __call__(self, t: float) -> np.ndarray:
+        piece = self.pieces[np.searchsorted(self.starts, t, side='right')]
+        return piece.unpack(t, piece.sol(t))
+
+
+@numba.jit(nopython=True, nogil=True)
+def _fill(t, z, y_1d, integrated, params, primary, order, conic, deviation):
+    """Fills in y_1d from z, the packed y-vector with the craft's deviation
+    from the conic in place of its position and velocity."""
+    n = len(params.M)
+    craft = params.craft
+    reference = params.reference
+    for k in range(len(integrated)):
+        y_1d[integrated[k]] = z[k]
+    relative.to_absolute(y_1d, primary, order)
+    x, y, vx, vy = kepler.drift(conic[0], conic[1], conic[2], conic[3],
+                                conic[4], t - conic[5])
+    y_1d[_X * n + craft] = y_1d[_X * n + reference] + x + z[deviation[0]]
+    y_1d[_Y * n + craft] = y_1d[_Y * n + reference] + y + z[deviation[1]]
+    y_1d[_VX * n + craft] = y_1d[_VX * n + reference] + vx + z[deviation[2]]
+    y_1d[_VY * n + craft] = y_1d[_VY * n + reference] + vy + z[deviation[3]]
+    # Anything landed on the craft goes where the craft is.
+    dynamics.place_landers(y_1d, params)
+    return x, y
+
+
+@numba.jit(nopython=True, nogil=True)
+def _derive(t, z, y_1d, dy, dy_relative, integrated, params, gravity,
+            test_particle_gravity, primary, order, conic, deviation):
+    """Returns the derivative of z, see _fill. The rest of the arguments are
+    the same as packed._derive_relative's."""
+    n = len(params.M)
+    craft = params.craft
+    reference = params.reference
+    x, y = _fill(t, z, y_1d, integrated, params, primary, order, conic,
+                 deviation)
+    dynamics.derive_into(y_1d, dy, params, gravity, test_particle_gravity)
+    dy_relative[:] = dy
+    relative.to_relative(dy_relative, primary, order)
+    dz = dy_relative[integrated]
+    # The acceleration on the conic is only from the reference.
+    r = math.sqrt(x * x + y * y)
+    conic_acc = conic[4] / (r * r * r)
+    dz[deviation[0]] = z[deviation[2]]
+    dz[deviation[1]] = z[deviation[3]]
+    dz[deviation[2]] = dy[_VX * n + craft] - dy[_VX * n + reference] + \
+        conic_acc * x
+    dz[deviation[3]] = dy[_VY * n + craft] - dy[_VY * n + reference] + \
+        conic_acc * y
+    return dz
+
+
+@numba.jit(nopython=True, nogil=True)
+def _rectify_margin(t, z, conic, deviation):
+    """Positive until the craft is RECTIFY of its distance from its
+    reference off the conic."""
+    x, y, _, _ = kepler.drift(conic[0], conic[1], conic[2], conic[3],
+                              conic[4], t - conic[5])
+    return RECTIFY * math.sqrt(x * x + y * y) - \
+        math.hypot(z[deviation[0]], z[deviation[1]])
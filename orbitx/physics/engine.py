@@ -12,20 +12,21 @@ Get in contact with me if you want to add new functionality! I'm more than
 happy to help :)"""
 
 import collections
-import functools
 import logging
 import threading
 import time
 import warnings
-from typing import Callable, List, Optional, Tuple, NamedTuple, Union
+from typing import Dict, List, Optional, Tuple, NamedTuple, Union
 
+import numba
 import numpy as np
-import scipy.integrate
-import scipy.spatial
 import scipy.special
 from google.protobuf.text_format import MessageToString
 
-from orbitx.physics import calc
+from orbitx.physics import (broad_phase, calc, dynamics, encke, ephemeris,
+                            integrators, multirate, packed, pacing,
+                            regularized, relative, rk, symplectic,
+                            tolerances, tuning)
 from orbitx import common
 from orbitx.network import Request
 from orbitx.orbitx_pb2 import PhysicalState
@@ -48,6 +49,17 @@ class TimeAccChange(NamedTuple):
     start_simtime: float
 
 
+class _Start(NamedTuple):
+    """Initial conditions that set_state hands the simthread, along with the
+    ephemeris and tuning tables that go with them."""
+    t: float
+    y: PhysicsState
+    # See PhysicsEngine._generation.
+    generation: int
+    ephemeris: Optional[ephemeris.Table]
+    tuning: Optional[tuning.Table]
+
+
 class PhysicsEngine:
     """Physics Engine class. Encapsulates simulating physical state.
 
@@ -61,7 +73,8 @@ class PhysicsEngine:
     state = pe.get_state(requested_t=20)
 
     This class will start a background thread to simulate physics when __init__
-    is called. This background thread may restart at arbitrary times.
+    is called. That thread lives as long as the PhysicsEngine does, and
+    set_state hands it new initial conditions to simulate from.
     This class is designed to be access from the main thread by methods that
     don't begin with an underscore, so thread synchronization between the main
     thread and the background solutions thread is done with this assumption in
@@ -69,25 +82,44 @@ class PhysicsEngine:
     deliberately and carefully! Specifically, if you're in spacesim, feel free
     to hit me (Patrick) up, and I can help.
     """
-    # Increasing this constant results in the simulation being faster to
-    # compute but less accurate of an approximation. If Phobos starts crashing
-    # into Mars, tweak this downwards.
-    MAX_STEP_SIZE = 100
+    def __init__(self, physical_state: PhysicsState, threads: int = 1,
+                 engine_settings: Optional[Dict[str, str]] = None):
+        # How many threads numba can use in the simthread, for scenarios with
+        # enough entities to make that worthwhile. See
+        # dynamics.use_parallel_kernels.
+        if not 1 <= threads <= numba.config.NUMBA_NUM_THREADS:
+            raise ValueError(
+                f'Can only use between 1 and '
+                f'{numba.config.NUMBA_NUM_THREADS} threads, not {threads}.')
+        self._threads = threads
+        # Fields of EngineSettings to use instead of what any state that
+        # set_state gets asks for, e.g. from the command line, so they
+        # still apply after loading another savefile.
+        self._engine_settings = dict(engine_settings or {})
 
-    def __init__(self, physical_state: PhysicsState):
         # Controls access to self._solutions. If anything changes that is
         # related to self._solutions, this condition variable should be
         # notified. Currently, that's just if self._solutions or
         # self._last_simtime changes.
         self._solutions_cond = threading.Condition()
-        self._solutions: collections.deque
+        self._solutions = collections.deque(maxlen=SOLUTION_CACHE_SIZE)
 
         self._simthread: Optional[threading.Thread] = None
+        self._stopping_simthread = False
         self._simthread_exception: Optional[Exception] = None
+        # Goes up every time set_state is called, so the simthread can tell
+        # when what it's simulating is out of date.
+        self._generation = 0
+        # The next initial conditions for the simthread to simulate from, or
+        # None if there's nothing new to simulate.
+        self._next_start: Optional[_Start] = None
         self._last_physical_state: PhysicalState
         self._last_monotime: float = time.monotonic()
         self._last_simtime: float
         self._time_acc_changes: collections.deque
+        # Picks how long each chunk of simulation is. Only the simthread
+        # uses this, see pacing.py.
+        self._pacer = pacing.Pacer(time_acc=0)
 
         self.set_state(physical_state)
 
@@ -140,35 +172,16 @@ class PhysicsEngine:
                 self._stopping_simthread = True
                 self._solutions_cond.notify_all()
             self._simthread.join()
+            self._simthread = None
 
-    def _start_simthread(self, t0: float, y0: PhysicsState) -> None:
-        if round(y0.time_acc) == 0:
-            # We've paused the simulation. Don't start a new simthread
-            log.info('Pausing simulation')
+    def _start_simthread(self) -> None:
+        """Starts the simthread, unless it's already running. It waits for
+        set_state to give it something to simulate."""
+        if self._simthread is not None and self._simthread.is_alive():
             return
-
-        # We don't need to synchronize self._last_simtime or
-        # self._solutions here, because we just stopped the background
-        # simulation thread only a few lines ago.
-        self._last_simtime = t0
-        # This double-ended queue should always have at least one element in
-        # it, and the first element should have a start_simtime less
-        # than self._last_simtime.
-        self._time_acc_changes = collections.deque(
-            [TimeAccChange(time_acc=y0.time_acc,
-                           start_simtime=y0.timestamp)]
-        )
-
-        # Essentially just a cache of ODE solutions.
-        self._solutions = collections.deque(maxlen=SOLUTION_CACHE_SIZE)
-
-        self._simthread = threading.Thread(
-            target=self._simthread_target,
-            args=(t0, y0),
-            name=f'simthread t={round(t0)} acc={y0.time_acc}',
-            daemon=True
-        )
         self._stopping_simthread = False
+        self._simthread = threading.Thread(
+            target=self._simthread_target, name='simthread', daemon=True)
 
         # Fork self._simthread into the background.
         self._simthread.start()
@@ -194,12 +207,19 @@ class PhysicsEngine:
             y0 = PhysicsState(None, self._last_physical_state)
         else:
             y0 = self.get_state(requested_t)
+        unchanged_state = y0.as_proto()
+        unchanged_capabilities = dict(common.craft_capabilities)
 
         for request in requests:
             if request.ident == Request.NOOP:
                 # We don't care about these requests
                 continue
             y0 = _one_request(request, y0)
+            if request.ident == Request.TOLERANCES_SET and \
+                    'tolerances' in self._engine_settings:
+                # The command overrides the command line.
+                self._engine_settings['tolerances'] = \
+                    y0.engine_settings.tolerances
             if request.ident == Request.TIME_ACC_SET:
                 assert request.time_acc_set >= 0
                 self._time_acc_changes.append(
@@ -207,26 +227,85 @@ class PhysicsEngine:
                                   start_simtime=y0.timestamp)
                 )
 
-        self.set_state(y0)
+        if y0.as_proto() == unchanged_state and \
+                common.craft_capabilities == unchanged_capabilities:
+            # Nothing changed, e.g. an engineering update with the same fuel
+            # and thrust as before, so everything that the simthread has
+            # simulated is still right.
+            return
+        # Unless a savefile was loaded, what was simulated up until
+        # requested_t still happened.
+        same_timeline = len(self._solutions) != 0 and \
+            y0.timestamp == requested_t and \
+            all(request.ident != Request.LOAD_SAVEFILE
+                for request in requests)
+        self._set_state(y0, same_timeline)
 
     def set_state(self, physical_state: PhysicsState):
-        self._stop_simthread()
-
+        """Simulates from physical_state from now on, forgetting everything
+        that was simulated so far."""
+        self._set_state(physical_state, same_timeline=False)
+
+    def _set_state(self, physical_state: PhysicsState, same_timeline: bool):
+        """Like set_state, but if same_timeline is True, get_state can still
+        look up the time before physical_state from what was simulated so
+        far."""
         physical_state = _reconcile_entity_dynamics(physical_state)
-        self._artificials = np.where(
-            np.array([
-                entity.artificial
-                for entity in physical_state]) >= 1)[0]
-
-        # We keep track of the PhysicalState because our simulation
-        # only simulates things that change like position and velocity,
-        # not things that stay constant like names and mass.
-        # self._last_physical_state contains these constants.
-        self._last_physical_state = physical_state.as_proto()
-        self.R = np.array([entity.r for entity in physical_state])
-        self.M = np.array([entity.mass for entity in physical_state])
-
-        self._start_simthread(physical_state.timestamp, physical_state)
+        for field, value in self._engine_settings.items():
+            setattr(physical_state.engine_settings, field, value)
+        # Raises an exception now, instead of in the simthread, if the
+        # savefile asks for an integrator or tolerance profile that doesn't
+        # exist.
+        integrator = integrators.integrator(physical_state)
+        tolerances.profile(physical_state)
+        # Working out whether everything is coasting takes a while, so the
+        # simthread slows down further if it turns out nothing is.
+        fastest_time_acc = integrators.fastest_time_acc(
+            integrator, coasting=True)
+        if physical_state.time_acc > fastest_time_acc:
+            # The main thread would spend all its time waiting in get_state.
+            log.info(f"{integrator.method} can't keep up with "
+                     f'{physical_state.time_acc}x, using '
+                     f'{fastest_time_acc}x instead.')
+            physical_state.time_acc = fastest_time_acc
+        ephemeris_table = _ephemeris_table(physical_state)
+        tuning_table = _tuning_table(physical_state)
+        solver = dynamics.gravity_solver(physical_state)
+        log.info(f'Using {protos.EngineSettings.GravitySolver.Name(solver)} '
+                 f'gravity solver for {len(physical_state)} entities.')
+
+        t0 = physical_state.timestamp
+        with self._solutions_cond:
+            self._generation += 1
+            # If the simthread crashed, it crashed simulating the old
+            # initial conditions. Give it a chance with the new ones.
+            self._simthread_exception = None
+            # We keep track of the PhysicalState because our simulation
+            # only simulates things that change like position and velocity,
+            # not things that stay constant like names and mass.
+            # self._last_physical_state contains these constants.
+            self._last_physical_state = physical_state.as_proto()
+            self._solutions = collections.deque(
+                [_Truncated(solution, t0) for solution in self._solutions
+                 if same_timeline and solution.t_min < t0],
+                maxlen=SOLUTION_CACHE_SIZE)
+            self._last_simtime = t0
+            # This double-ended queue should always have at least one
+            # element in it, and the first element should have a
+            # start_simtime less than self._last_simtime.
+            self._time_acc_changes = collections.deque(
+                [TimeAccChange(time_acc=physical_state.time_acc,
+                               start_simtime=t0)])
+            if round(physical_state.time_acc) == 0:
+                # We've paused the simulation. Leave the simthread waiting.
+                log.info('Pausing simulation')
+                self._next_start = None
+            else:
+                self._next_start = _Start(
+                    t=t0, y=physical_state, generation=self._generation,
+                    ephemeris=ephemeris_table, tuning=tuning_table)
+            self._solutions_cond.notify_all()
+        self._start_simthread()
 
     def get_state(self, requested_t=None) -> PhysicsState:
         """Return the latest physical state of the simulation."""
@@ -275,28 +354,44 @@ class PhysicsEngine:
             return newest_state
 
     class RestartSimulationException(Exception):
-        """A request to restart the simulation with new t and y."""
+        """A request to restart the simulation from start, which has a new t
+        and y."""
 
-        def __init__(self, t: float, y: PhysicsState):
-            self.t = t
-            self.y = y
+        def __init__(self, start: _Start):
+            self.start = start
 
-    def _simthread_target(self, t, y):
+    def _simthread_target(self):
+        # This only affects the simthread.
+        numba.set_num_threads(self._threads)
         while True:
-            try:
-                self._run_simulation(t, y)
+            with self._solutions_cond:
+                self._solutions_cond.wait_for(
+                    lambda:
+                    self._next_start is not None or self._stopping_simthread)
                 if self._stopping_simthread:
                     return
-            except PhysicsEngine.RestartSimulationException as e:
-                t = e.t
-                y = e.y
-                log.info(f'Simulation restarted itself at {t}.')
-            except Exception as e:
-                log.error(f'simthread got exception {repr(e)}.')
-                self._simthread_exception = e
-                with self._solutions_cond:
-                    self._solutions_cond.notify_all()
-                return
+                start = self._next_start
+                self._next_start = None
+            while True:
+                try:
+                    # Returns once set_state has been called again.
+                    self._run_simulation(start)
+                    break
+                except PhysicsEngine.RestartSimulationException as e:
+                    start = e.start
+                    log.info(f'Simulation restarted itself at {start.t}.')
+                except Exception as e:
+                    with self._solutions_cond:
+                        # Unless whatever went wrong, went wrong simulating
+                        # initial conditions that are out of date anyway,
+                        # get_state raises it. Either way, wait for set_state
+                        # to give us new initial conditions.
+                        if start.generation == self._generation:
+                            log.error(
+                                f'simthread got exception {repr(e)}.')
+                            self._simthread_exception = e
+                            self._solutions_cond.notify_all()
+                    break
 
     def _derive(self, t: float, y_1d: np.ndarray,
                 pass_through_state: PhysicalState) -> np.ndarray:
@@ -320,83 +415,13 @@ class PhysicsEngine:
                                                 current_t_of_system,
                                                 current_y_of_system)
         """
-        # Note: we create this y as a PhysicsState for convenience, but if you
-        # set any values of y, the changes will be discarded! The only way they
-        # will be propagated out of this function is by numpy using the return
-        # value of this function as a derivative, as explained above.
-        # If you want to set values in y, look at _reconcile_entity_dynamics.
+        # All the actual work is done in a compiled kernel, see dynamics.py.
+        # The engine itself precomputes the DeriveParams once per chunk of
+        # simulation, instead of once per call like here.
         y = PhysicsState(y_1d, pass_through_state)
-        acc_matrix = calc.grav_acc(y.X, y.Y, self.M, y.Fuel)
-        zeros = np.zeros(y._n)
-        fuel_cons = np.zeros(y._n)
-
-        # Engine thrust and fuel consumption
-        for artif_index in self._artificials:
-            if y[artif_index].fuel > 0 and y[artif_index].throttle > 0:
-                # We have fuel remaining, calculate thrust
-                entity = y[artif_index]
-                capability = common.craft_capabilities[entity.name]
-
-                fuel_cons[artif_index] = \
-                    -abs(capability.fuel_cons * entity.throttle)
-                eng_thrust = capability.thrust * entity.throttle * \
-                    calc.heading_vector(entity.heading)
-                mass = entity.mass + entity.fuel
-
-                if entity.name == common.AYSE and \
-                        y[common.HABITAT].landed_on == common.AYSE:
-                    # It's bad that this is hardcoded, but it's also the only
-                    # place that this comes up so IMO it's not too bad.
-                    hab = y[common.HABITAT]
-                    mass += hab.mass + hab.fuel
-
-                eng_acc = eng_thrust / mass
-                acc_matrix[artif_index] += eng_acc
-
-        # And SRB thrust
-        srb_usage = 0
-        try:
-            if y.srb_time >= 0:
-                hab_index = y._name_to_index(common.HABITAT)
-                hab = y[hab_index]
-                srb_acc = common.SRB_THRUST / (hab.mass + hab.fuel)
-                srb_acc_vector = srb_acc * calc.heading_vector(hab.heading)
-                acc_matrix[hab_index] += srb_acc_vector
-                srb_usage = -1
-        except PhysicsState.NoEntityError:
-            # The Habitat doesn't exist.
-            pass
-
-        # Drag effects
-        craft = y.craft
-        if craft is not None:
-            craft_index = y._name_to_index(y.craft)
-            drag_acc = calc.drag(y)
-            acc_matrix[craft_index] -= drag_acc
-
-        # Centripetal acceleration to keep landed entities glued to each other.
-        landed_on = y.LandedOn
-        for landed_i in landed_on:
-            lander = y[landed_i]
-            ground = y[landed_on[landed_i]]
-
-            centripetal_acc = (lander.pos - ground.pos) * ground.spin ** 2
-            acc_matrix[landed_i] = \
-                acc_matrix[landed_on[landed_i]] - centripetal_acc
-
-        # Sets velocity and spin of a couple more entities.
-        # If you want to set the acceleration of an entity, do it above and
-        # keep that logic in _derive. If you want to set the velocity and spin
-        # or any other fields that an Entity has, you should put that logic in
-        # this _reconcile_entity_dynamics helper.
-        y = _reconcile_entity_dynamics(y)
-
-        return np.concatenate((
-            y.VX, y.VY, np.hsplit(acc_matrix, 2), y.Spin,
-            zeros, fuel_cons, zeros, zeros, zeros, np.array([srb_usage, 0])
-        ), axis=None)
-
-    def _run_simulation(self, t: float, y: PhysicsState) -> None:
+        return dynamics.derive(t, y_1d, dynamics.build_params(y))
+
+    def _run_simulation(self, start: _Start) -> None:
         # An overview of how time is managed:
         #
         # self._last_simtime is the main thread's latest idea of
@@ -410,37 +435,154 @@ class PhysicsEngine:
         # time that the solution can be evaluated at and still be accurate.
         # The highest such t_max should always be larger than the current
         # simulation time, i.e. self._last_simtime
+        t, y, generation = start.t, start.y, start.generation
+        # The simthread only reads what set_state hands it, not anything
+        # that set_state might be changing at the same time.
+        ephemeris_table = start.ephemeris
+        radii = np.array([entity.r for entity in y])
+        artificials = np.flatnonzero([entity.artificial for entity in y])
         proto_state = y._proto_state
-
-        while not self._stopping_simthread:
-            derive_func = functools.partial(
-                self._derive, pass_through_state=proto_state)
-
-            events: List[Event] = [
-                CollisionEvent(y, self.R), HabFuelEvent(y), LiftoffEvent(y),
-                SrbFuelEvent()
-            ]
-            if y.craft is not None:
-                events.append(HighAccEvent(
-                    derive_func,
-                    self._artificials,
-                    TIME_ACC_TO_BOUND[round(y.time_acc)],
-                    y.time_acc,
-                    len(y)))
-
-            ivp_out = scipy.integrate.solve_ivp(
-                fun=derive_func,
-                t_span=[t, t + min(y.time_acc, 10 * self.MAX_STEP_SIZE)],
-                # solve_ivp requires a 1D y0 array
-                y0=y.y0(),
-                events=events,
-                dense_output=True,
-                max_step=self.MAX_STEP_SIZE
-            )
+        # True if the last chunk of simulation was done by
+        # symplectic.solve_ivp, and it stopped early because an event was
+        # about to happen.
+        stopped_before_event = False
+        # The interaction list is expensive to build, so this reports on the
+        # one that the first chunk builds anyway.
+        log_interactions = dynamics.gravity_solver(y) == \
+            protos.EngineSettings.INTERACTION_LIST
+        if self._pacer.time_acc != y.time_acc:
+            # Measurements at other time accs don't say much about this one.
+            self._pacer = pacing.Pacer(y.time_acc)
+
+        while not self._stopping_simthread and \
+                generation == self._generation:
+            chunk_start = time.monotonic()
+            params = dynamics.build_params(y)
+            if log_interactions:
+                pulls = len(params.sources) * (len(params.sources) - 1)
+                log.info(f'Skipping {pulls - len(params.interactions):,} of '
+                         f'{pulls:,} pulls between sources, with an error of '
+                         f'at most {params.interaction_error:.1e} m/s^2.')
+                log_interactions = False
+
+            integrator = integrators.integrator(y)
+            coasting = False
+            if integrator.backend in [integrators.SYMPLECTIC,
+                                      integrators.MULTIRATE]:
+                orbits = symplectic.hierarchy(y, params)
+                coasting = symplectic.coasting(y, params, orbits)
+            fastest_time_acc = integrators.fastest_time_acc(
+                integrator, coasting)
+            if y.time_acc > fastest_time_acc:
+                # This chunk falls back to an integrator that can't keep up,
+                # and the main thread would spend all its time waiting in
+                # get_state, so its clock has to slow down too.
+                log.info(f"{integrator.method} can't keep up with "
+                         f'{y.time_acc}x while not coasting, using '
+                         f'{fastest_time_acc}x instead.')
+                y.time_acc = fastest_time_acc
+                self._pacer = pacing.Pacer(y.time_acc)
+                with self._solutions_cond:
+                    if generation == self._generation:
+                        self._time_acc_changes.append(TimeAccChange(
+                            time_acc=fastest_time_acc,
+                            start_simtime=max(t, self._last_simtime)))
+
+            event_params = dynamics.build_event_params(
+                y, TIME_ACC_TO_BOUND[round(y.time_acc)])
+
+            # These are in the same order as dynamics.COLLISION_EVENT etc.
+            compiled_events = CompiledEvents(params, event_params)
+            events = compiled_events.events + [
+                _SupersededEvent(self, generation)]
+
+            ivp_out = None
+            if coasting and not stopped_before_event:
+                if integrator.rails_threshold > 0:
+                    orbits = symplectic.put_on_rails(
+                        y, params, orbits, integrator.rails_threshold)
+                max_step = symplectic.step_limit(
+                    orbits, integrators.max_step(integrator, y.time_acc))
+                t_end = t + self._pacer.chunk(
+                    default=min(y.time_acc,
+                                tuning.CHUNK_STEPS * max_step),
+                    shortest=min(y.time_acc, max_step), longest=np.inf)
+                if integrator.backend == integrators.MULTIRATE:
+                    ivp_out = multirate.solve_ivp(
+                        params, [t, t_end], y.y0(), events, max_step)
+                else:
+                    ivp_out = symplectic.solve_ivp(
+                        params, orbits, [t, t_end], y.y0(), events,
+                        max_step)
+                # Let solve_ivp find out exactly when the event happens.
+                stopped_before_event = ivp_out.t[-1] < t_end
+                if len(ivp_out.t) == 1:
+                    # The event is about to happen right now.
+                    ivp_out = None
+
+            if generation != self._generation:
+                # set_state stopped this chunk early, see _SupersededEvent.
+                break
+
+            if ivp_out is None:
+                regularize = \
+                    integrator.backend == integrators.REGULARIZED and \
+                    regularized.applies(params)
+                perturb = integrator.backend == integrators.PERTURBED and \
+                    encke.applies(params)
+                if integrator.fallback is not None and \
+                        not (regularize or perturb):
+                    integrator = integrators.INTEGRATORS[integrator.fallback]
+                stopped_before_event = False
+                setting = tuning.setting(start.tuning, integrator, y)
+                profile = tolerances.by_name(setting.tolerances)
+                max_step = setting.max_step
+                default_chunk = min(y.time_acc,
+                                    tuning.CHUNK_STEPS * max_step)
+                longest_chunk = setting.chunk
+                if symplectic.thrusting(y, params):
+                    # Steps get longer over the course of a chunk, and if
+                    # they got too long, the engine would take a step far
+                    # past where fuel or an SRB runs out before finding that
+                    # event. Chunks used to be short enough to stop that.
+                    longest_chunk = min(longest_chunk, default_chunk)
+                # See pacing.py.
+                t_span = [t, t + self._pacer.chunk(
+                    default=default_chunk,
+                    shortest=min(y.time_acc, max_step),
+                    longest=longest_chunk)]
+                if regularize:
+                    ivp_out = regularized.solve_ivp(
+                        params, t_span, y.y0(), events,
+                        integrators.fallback(integrator).method,
+                        max_step, profile, relative.orbits(y, params))
+                elif perturb:
+                    ivp_out = encke.solve_ivp(
+                        params, t_span, y.y0(), events,
+                        integrators.fallback(integrator).method,
+                        max_step, profile, relative.orbits(y, params))
+                elif integrator.backend == integrators.COMPILED:
+                    ivp_out = rk.solve_ivp(
+                        params, event_params, t_span, y.y0(), max_step,
+                        profile)
+                elif ephemeris_table is not None and \
+                        ephemeris_table.covers(t_span):
+                    ivp_out = ephemeris_table.solve_ivp(
+                        params, t_span, y.y0(), events, integrator.method,
+                        max_step, profile)
+                else:
+                    # Only integrates the parts of the y-vector that can
+                    # change, see packed.py.
+                    ivp_out = packed.solve_ivp(
+                        params, t_span, y.y0(), events, integrator.method,
+                        max_step, profile, compiled_events.derivatives,
+                        relative.orbits(y, params))
 
             if not ivp_out.success:
                 # Integration error
                 raise Exception(ivp_out.message)
+            self._pacer.simulated(ivp_out.t[-1] - t,
+                                  time.monotonic() - chunk_start)
 
             # When we create a new solution, let other people know.
             with self._solutions_cond:
@@ -452,35 +594,49 @@ class PhysicsEngine:
                     lambda:
                     len(self._solutions) < SOLUTION_CACHE_SIZE or
                     self._last_simtime > self._solutions[0].t_max or
-                    self._stopping_simthread
+                    self._stopping_simthread or
+                    generation != self._generation
                 )
-                if self._stopping_simthread:
+                if self._stopping_simthread or \
+                        generation != self._generation:
+                    # set_state was called while this chunk was being
+                    # simulated, so it starts from out of date initial
+                    # conditions. Throw it away.
                     break
 
                 # self._solutions contains ODE solutions for the interval
                 # [self._solutions[0].t_min, self._solutions[-1].t_max].
                 self._solutions.append(ivp_out.sol)
                 self._solutions_cond.notify_all()
+                self._pacer.consumed(self._last_simtime, time.monotonic())
 
             y = PhysicsState(ivp_out.y[:, -1], proto_state)
             t = ivp_out.t[-1]
 
             if ivp_out.status > 0:
                 log.info(f'Got event: {ivp_out.t_events} at t={t}.')
-                for index, event_t in enumerate(ivp_out.t_events):
+                for event, event_t in enumerate(ivp_out.t_events):
                     if len(event_t) == 0:
                         # If this event didn't occur, then event_t == []
                         continue
-                    event = events[index]
-                    if isinstance(event, CollisionEvent):
+                    if event == dynamics.COLLISION_EVENT:
                         # Collision, simulation ended. Handled it and continue.
                         assert len(ivp_out.t_events[0]) == 1
                         assert len(ivp_out.t) >= 2
-                        y = _collision_decision(t, y, events[0])
+                        collision = CollisionEvent(y, radii)
+                        e1, e2 = collision(t, y.y0(), return_pair=True)
+                        y = _collision_decision(t, y, collision)
                         y = _reconcile_entity_dynamics(y)
-                    if isinstance(event, HabFuelEvent):
+                        if ephemeris_table is not None and \
+                                not y[e1].artificial and \
+                                not y[e2].artificial:
+                            # Natural bodies bounced off each other, so
+                            # they won't go where the ephemeris says.
+                            log.info('No longer using the ephemeris.')
+                            ephemeris_table = None
+                    if event == dynamics.HAB_FUEL_EVENT:
                         # Something ran out of fuel.
-                        for artificial_index in self._artificials:
+                        for artificial_index in artificials:
                             artificial = y[artificial_index]
                             if round(artificial.fuel) != 0:
                                 continue
@@ -491,18 +647,18 @@ class PhysicsEngine:
                             # Set fuel to a negative value, so it doesn't
                             # trigger the event function.
                             artificial.fuel = 0
-                    if isinstance(event, LiftoffEvent):
+                    if event == dynamics.LIFTOFF_EVENT:
                         # A craft has a TWR > 1
                         craft = y.craft_entity()
                         log.info(
                             'We have liftoff of the '
                             f'{craft.name} from {craft.landed_on} at {t}.')
                         craft.landed_on = ''
-                    if isinstance(event, SrbFuelEvent):
+                    if event == dynamics.SRB_FUEL_EVENT:
                         # SRB fuel exhaustion.
                         log.info('SRB exhausted.')
                         y.srb_time = common.SRB_EMPTY
-                    if isinstance(event, HighAccEvent):
+                    if event == dynamics.HIGH_ACC_EVENT:
                         # The acceleration acting on the craft is high, might
                         # result in inaccurate results. SLOOWWWW DOWWWWNNNN.
                         slower_time_acc_index = list(
@@ -517,7 +673,13 @@ class PhysicsEngine:
                             f'slowing down to {slower_time_acc.value}')
                         # We should lower the time acc.
                         y.time_acc = slower_time_acc.value
-                        raise PhysicsEngine.RestartSimulationException(t, y)
+                        raise PhysicsEngine.RestartSimulationException(
+                            start._replace(t=t, y=y,
+                                           ephemeris=ephemeris_table))
+                    if event == dynamics.ATMOSPHERE_EVENT:
+                        # Nothing to do, the next chunk will work out drag.
+                        # See dynamics.flight_regime.
+                        log.info(f'{y.craft} entered an atmosphere at {t}.')
 
 
 class Event:
@@ -531,161 +693,199 @@ class Event:
         ...
 
 
-class SrbFuelEvent(Event):
-    def __call__(self, t, y_1d) -> float:
-        """Returns how much SRB burn time is left.
-        This will cause simulation to stop when SRB burn time reaches 0."""
-        return y_1d[PhysicsState.SRB_TIME_INDEX]
-
-
-class HabFuelEvent(Event):
-    def __init__(self, initial_state: PhysicsState):
-        self.initial_state = initial_state
-
-    def __call__(self, t, y_1d) -> float:
-        """Return a 0 only when throttle is nonzero."""
-        y = PhysicsState(y_1d, self.initial_state._proto_state)
-        for index, entity in enumerate(y._proto_state.entities):
-            if entity.artificial and y.Throttle[index] != 0:
-                return y.Fuel[index]
-        return np.inf
-
-
 class CollisionEvent(Event):
     def __init__(self, initial_state: PhysicsState, radii: np.ndarray):
         self.initial_state = initial_state
         self.radii = radii
 
+        # Nothing lands or lifts off in the middle of a chunk of simulation,
+        # so we can work out who is landed on who ahead of time.
+        self.landed_on = np.full(
+            len(initial_state), PhysicsState.NO_INDEX, dtype=np.int64)
+        for lander, ground in initial_state.LandedOn.items():
+            self.landed_on[lander] = ground
+        self.groups = initial_state.CollisionGroups
+        self.particle = initial_state.TestParticles
+        self.sources = np.flatnonzero(~self.particle)
+        self.test_particles = np.flatnonzero(self.particle)
+
+        self.broad_phase = broad_phase.worthwhile(len(initial_state))
+        if self.broad_phase:
+            self.sweep_order = broad_phase.sweep_order(
+                initial_state.X, radii)
+        elif dynamics.use_parallel_kernels(len(initial_state)):
+            self.closest_approach = calc.closest_approach_parallel
+        else:
+            self.closest_approach = calc.closest_approach
+
     def __call__(self, t, y_1d, return_pair=False
                  ) -> Union[float, Tuple[int, int]]:
         """Returns a scalar, with 0 indicating a collision and a sign change
         indicating a collision has happened."""
-        y = PhysicsState(y_1d, self.initial_state._proto_state)
         n = len(self.initial_state)
-        # 2xN of (x, y) positions
-        posns = np.column_stack((y.X, y.Y))
-        # An n*n matrix of _altitudes_ between each entity
-        alt_matrix = (
-                scipy.spatial.distance.cdist(posns, posns) -
-                np.array([self.radii]) - np.array([self.radii]).T)
-        # To simplify calculations, an entity's altitude from itself is inf
-        np.fill_diagonal(alt_matrix, np.inf)
-        # For each pair of objects that have collisions disabled between
-        # them, also set their altitude to be inf
-
-        # If there are any entities landed on any other entities, ignore
-        # both the landed and the landee entity.
-        landed_on = y.LandedOn
-        for index in landed_on:
-            alt_matrix[index, landed_on[index]] = np.inf
-            alt_matrix[landed_on[index], index] = np.inf
+        X = y_1d[_FIELD_ORDERING['x'] * n:(_FIELD_ORDERING['x'] + 1) * n]
+        Y = y_1d[_FIELD_ORDERING['y'] * n:(_FIELD_ORDERING['y'] + 1) * n]
+        # The altitude is the distance between the surfaces of the two
+        # entities that are closest to touching, ignoring landed entities and
+        # pairs of test particles.
+        if self.broad_phase:
+            altitude, object_i, object_j = broad_phase.closest_approach(
+                X, Y, self.radii, self.landed_on, self.groups, self.particle,
+                self.sweep_order)
+        else:
+            altitude, object_i, object_j = self.closest_approach(
+                X, Y, self.radii, self.landed_on, self.groups, self.sources,
+                self.test_particles)
 
         if return_pair:
             # Returns the actual pair of indicies instead of a scalar.
-            flattened_index = alt_matrix.argmin()
-            # flattened_index is a value in the interval [1, n*n]-1.
-            # Turn it into a  2D index.
-            object_i = flattened_index // n
-            object_j = flattened_index % n
             return object_i, object_j
         else:
             # solve_ivp invocation, return scalar
-            return np.min(alt_matrix)
+            return altitude
+
+
+class CompiledEvents:
+    """All the events above, evaluated together by dynamics.event_values.
+
+    solve_ivp calls each of its events with the same y-vector after every
+    step, so the first of the events to be called works out the values of
+    all of them in one compiled pass, and the rest just look theirs up.
+    HIGH_ACC_EVENT needs the derivative, which is only worked out if the
+    event can happen at all, and isn't already in self.derivatives. Pass
+    that to packed.solve_ivp so that it is."""
+
+    def __init__(self, params: dynamics.DeriveParams,
+                 event_params: dynamics.EventParams):
+        self.params = params
+        self.event_params = event_params
+        self.gravity, self.test_particle_gravity = \
+            dynamics.gravity_kernels(params)
+        # None if HIGH_ACC_EVENT can't happen.
+        self.derivatives: Optional[dynamics.DerivativeCache] = None
+        if params.craft != dynamics._NO_INDEX and \
+                event_params.time_acc != 1:
+            self.derivatives = dynamics.DerivativeCache()
+        self.values = np.empty(dynamics.N_EVENTS)
+        self.dy = np.zeros(0)
+        # The t and y-vector that self.values are for. A y-vector is only
+        # recognized if it's the same array, which is how solve_ivp and our
+        # other integrators call their events.
+        self.t: Optional[float] = None
+        self.y_1d: Optional[np.ndarray] = None
+        # Pass these to solve_ivp, in the same order as
+        # dynamics.COLLISION_EVENT etc.
+        self.events = [_CompiledEvent(self, event)
+                       for event in range(dynamics.N_EVENTS)]
+
+    def value(self, event: int, t: float, y_1d: np.ndarray) -> float:
+        if t != self.t or y_1d is not self.y_1d:
+            if len(self.dy) != len(y_1d):
+                self.dy = np.zeros_like(y_1d)
+            dy = self.dy
+            if self.derivatives is not None:
+                dy = self.derivatives.lookup(t, y_1d)
+                if dy is None:
+                    dy = self.dy
+                    dynamics.derive_into(
+                        y_1d, dy, self.params, self.gravity,
+                        self.test_particle_gravity)
+            dynamics.event_values(y_1d, dy, self.params, self.event_params,
+                                  self.values)
+            self.t = t
+            self.y_1d = y_1d
+        return self.values[event]
 
 
-class LiftoffEvent(Event):
-    def __init__(self, initial_state: PhysicsState):
-        self.initial_state = initial_state
+class _CompiledEvent(Event):
+    """One of the CompiledEvents, as solve_ivp wants it."""
 
-    def __call__(self, t, y_1d) -> float:
-        """Return 0 when the craft is landed but thrusting enough to lift off,
-        and a positive value otherwise."""
-        y = PhysicsState(y_1d, self.initial_state._proto_state)
-        if y.craft is None:
-            # There is no craft, return early.
-            return np.inf
-        craft = y.craft_entity()
+    def __init__(self, compiled_events: CompiledEvents, event: int):
+        self.compiled_events = compiled_events
+        self.event = event
 
-        if not craft.landed():
-            # We don't have to lift off because we already lifted off.
-            return np.inf
-
-        planet = y[craft.landed_on]
-        if planet.artificial:
-            # If we're docked with another satellite, undocking is governed
-            # by other mechanisms. Ignore this.
-            return np.inf
-
-        thrust = common.craft_capabilities[craft.name].thrust * craft.throttle
-        if y.srb_time > 0 and y.craft == common.HABITAT:
-            thrust += common.SRB_THRUST
-
-        pos = craft.pos - planet.pos
-        # This is the G(m1*m2)/r^2 formula
-        weight = common.G * craft.mass * planet.mass / np.inner(pos, pos)
-
-        # This should be positive when the craft isn't thrusting enough, and
-        # zero when it is thrusting enough.
-        return max(0, common.LAUNCH_TWR - thrust / weight)
-
-
-class HighAccEvent(Event):
-    def __init__(
-            self, derive: Callable[[float, np.ndarray], np.ndarray],
-            artificials: List[int], acc_bound: float, current_acc: float,
-            n_entities: int):
-        self.derive = derive
-        self.artificials = artificials
-        self.acc_bound = acc_bound
-        self.current_acc = round(current_acc)
-        self.ax_offset = n_entities * _FIELD_ORDERING['vx']
-        self.ay_offset = n_entities * _FIELD_ORDERING['vy']
+    def __call__(self, t: float, y_1d: np.ndarray) -> float:
+        return self.compiled_events.value(self.event, t, y_1d)
+
+
+class _SupersededEvent(Event):
+    """Happens once set_state is called, so that the chunk being simulated
+    stops instead of running to the end only to be thrown away. Only
+    rk.solve_ivp doesn't call our events, so its chunks still run to the end.
+
+    When this first sees that set_state was called, it remembers that t and
+    returns how far before it the solver is, so that solve_ivp can find
+    the exact time of the event."""
+
+    def __init__(self, engine: PhysicsEngine, generation: int):
+        self.engine = engine
+        self.generation = generation
+        self.t: Optional[float] = None
 
     def __call__(self, t: float, y_1d: np.ndarray) -> float:
-        """Return positive if the current time acceleration is accurate, zero
-        then negative otherwise."""
-        if self.current_acc == 1:
-            # If we can't lower the time acc, don't bother doing any work.
-            return np.inf
-        derive_result = self.derive(t, y_1d)
-        max_acc_mag = 0.0005  # A small nonzero value.
-        for artif_index in self.artificials:
-            accel = (derive_result[self.ax_offset] + artif_index,
-                     derive_result[self.ay_offset] + artif_index)
-            acc_mag = calc.fastnorm(accel)
-            if acc_mag > max_acc_mag:
-                max_acc_mag = acc_mag
-        return max(self.acc_bound - acc_mag, 0)
+        if self.t is None:
+            if self.engine._generation == self.generation:
+                return np.inf
+            self.t = t
+        return self.t - t
+
+
+class _Truncated:
+    """A solution that's only used before time t, because set_state was
+    called at t and what comes from t on might not be right any more."""
+
+    def __init__(self, solution, t: float):
+        self.solution = solution
+        self.t_min = solution.t_min
+        # At t itself, it's whatever set_state was called with.
+        self.t_max = min(solution.t_max, np.nextafter(t, -np.inf))
+
+    def __call__(self, t: float) -> np.ndarray:
+        return self.solution(t)
+
+
+def _ephemeris_table(state: PhysicsState) -> Optional[ephemeris.Table]:
+    """Returns the ephemeris that the state's engine settings ask for, if it
+    can be used from this state on."""
+    name = state.engine_settings.ephemeris
+    if not name:
+        return None
+    table = ephemeris.Table(ephemeris.load_named(name), state)
+    if not table.covers([state.timestamp, state.timestamp]):
+        log.warning(f'Not using ephemeris {name}, it only covers '
+                    f't={table.ephemeris.t0} to t={table.ephemeris.t1}.')
+        return None
+    mismatch = table.mismatch(state)
+    if mismatch > ephemeris.MAX_MISMATCH:
+        log.warning(f'Not using ephemeris {name}, natural bodies are up to '
+                    f'{mismatch:,.0f} m away from where it says.')
+        return None
+    return table
+
+
+def _tuning_table(state: PhysicsState) -> Optional[tuning.Table]:
+    """Returns the tuning table that the state's engine settings ask for, if
+    it was tuned for the state's integrator."""
+    name = state.engine_settings.tuning
+    if not name:
+        return None
+    table = tuning.load_named(name)
+    integrator = integrators.integrator(state)
+    if table.integrator not in [integrator.method, integrator.fallback]:
+        log.warning(f'Not using tuning table {name}, it was tuned for '
+                    f'{table.integrator}, not {integrator.method}.')
+        return None
+    return table
 
 
 def _reconcile_entity_dynamics(y: PhysicsState) -> PhysicsState:
     """Idempotent helper that sets velocities and spins of some entities.
-    This is in its own function because it has a couple calling points."""
-    # Navmode auto-rotation
-    if y.navmode != Navmode['Manual']:
-        craft = y.craft_entity()
-        craft.spin = calc.navmode_spin(y)
-
-    # Keep landed entities glued together
-    landed_on = y.LandedOn
-    for index in landed_on:
-        # If we're landed on something, make sure we move in lockstep.
-        lander = y[index]
-        ground = y[landed_on[index]]
-
-        if ground.name == common.AYSE and lander.name == common.HABITAT:
-            # Always put the Habitat at the docking port.
-            lander.pos = (
-                ground.pos -
-                calc.heading_vector(ground.heading) * (lander.r + ground.r))
-        else:
-            norm = lander.pos - ground.pos
-            unit_norm = norm / calc.fastnorm(norm)
-            lander.pos = ground.pos + unit_norm * (ground.r + lander.r)
-
-        lander.spin = ground.spin
-        lander.v = calc.rotational_speed(lander, ground)
+    This is in its own function because it has a couple calling points.
 
+    Specifically, this sets the spin of the craft according to its navmode,
+    and keeps landed entities glued together. The compiled derivative in
+    dynamics.py does the same thing to its copy of the y-vector."""
+    dynamics.reconcile(y, dynamics.build_params(y))
     return y
 
 
@@ -810,7 +1010,7 @@ def _one_request(request: Request, y0: PhysicsState) \
     log.info(f'At simtime={y0.timestamp}, '
              f'Got command {MessageToString(request, as_one_line=True)}')
 
-    if request.ident != Request.TIME_ACC_SET:
+    if request.ident not in [Request.TIME_ACC_SET, Request.TOLERANCES_SET]:
         # Reveal the type of y0.craft as str (not None).
         assert y0.craft is not None
 
@@ -886,5 +1086,13 @@ def _one_request(request: Request, y0: PhysicsState) \
     elif request.ident == Request.IGNITE_SRBS:
         if round(y0.srb_time) == common.SRB_FULL:
             y0.srb_time = common.SRB_BURNTIME
+    elif request.ident == Request.TOLERANCES_SET:
+        if request.tolerances in tolerances.PROFILES:
+            y0.engine_settings.tolerances = request.tolerances
+        else:
+            # Any network client can send this, so don't let a typo take
+            # the whole engine down.
+            log.warning(f'Ignoring unknown tolerance profile '
+                        f'"{request.tolerances}".')
 
     return y0
@@ -0,0 +1,380 @@
+"""Precomputed tables of where natural bodies will be.
+
+Planets and moons don't care what the craft does, so wherever a savefile puts
+them, they'll always end up in the same places. make_ephemeris.py integrates
+the natural bodies of a savefile once, very accurately, and fits a Chebyshev
+polynomial to each body's position over short segments of time, like the JPL
+DE ephemerides do. The physics engine can then look up where each natural
+body is, and only has to integrate the artificial entities.
+
+Each body has its own segment length, short enough that the polynomial is
+within a tolerance of the integrated position and velocity everywhere in the
+segment. Velocities get polynomials of their own, since differentiating the
+position polynomials would amplify the integrator's errors, which are largest
+for fast bodies far from the Sun.
+
+Ephemerides are stored as .npz files in data/ephemerides/, and savefiles
+use one by naming it in engineSettings.ephemeris."""
+
+import functools
+import logging
+import math
+from pathlib import Path
+from typing import List, NamedTuple
+
+import numba
+import numpy as np
+import scipy.integrate
+
+from orbitx import common
+from orbitx import orbitx_pb2 as protos
+from orbitx.physics import calc, dynamics, integrators, packed, \
+    symplectic, tolerances
+from orbitx.data_structures import PhysicsState, _FIELD_ORDERING
+
+log = logging.getLogger()
+
+DEFAULT_DEGREE = 12
+# make_ephemeris.py fits each segment this closely, by default.
+DEFAULT_POSITION_TOLERANCE = 1.0  # m
+DEFAULT_VELOCITY_TOLERANCE = 1e-3  # m/s
+
+# If the state the engine starts from has a body somewhere else than the
+# ephemeris says, by more than this, the ephemeris isn't used.
+MAX_MISMATCH = 1000  # m
+
+# make_ephemeris.py starts each body with segments this fraction of its
+# orbital period long, before shortening them to fit the tolerances.
+_SEGMENTS_PER_ORBIT = 8
+# Steps of the integration that make_ephemeris.py fits are at most this
+# fraction of the shortest orbital period. Planets are far enough from the
+# Sun that the relative tolerance alone lets the integrator step right over
+# the orbits of their moons.
+_STEPS_PER_ORBIT = 100
+
+_X = dynamics._X
+_Y = dynamics._Y
+_VX = dynamics._VX
+_VY = dynamics._VY
+_N_FIELDS = len(_FIELD_ORDERING)
+_N_SINGULAR_ELEMENTS = PhysicsState.N_SINGULAR_ELEMENTS
+_NO_INDEX = PhysicsState.NO_INDEX
+
+
+class Ephemeris(NamedTuple):
+    """Positions of some natural bodies between t0 and t1. Make one with
+    build or load."""
+    names: List[str]
+    t0: float
+    t1: float
+    # Body b has n_segments[b] segments, each segment_length[b] seconds long,
+    # and the coefficients of its k-th segment are at
+    # coefficients[first_segment[b] + k].
+    segment_length: np.ndarray
+    first_segment: np.ndarray
+    n_segments: np.ndarray
+    # Chebyshev coefficients of x, y, vx and vy, for each segment.
+    # Shape is (total segments, 4, degree + 1).
+    coefficients: np.ndarray
+
+
+def path(name: str) -> Path:
+    """Where an ephemeris named in engineSettings.ephemeris is stored."""
+    return common.PROGRAM_PATH / 'data' / 'ephemerides' / name
+
+
+def save(ephemeris: Ephemeris, file: Path):
+    np.savez(file, **ephemeris._replace(names=np.array(ephemeris.names))
+             ._asdict())
+
+
+def load(file: Path) -> Ephemeris:
+    with np.load(file) as data:
+        return Ephemeris(
+            names=[str(name) for name in data['names']],
+            t0=float(data['t0']), t1=float(data['t1']),
+            segment_length=data['segment_length'],
+            first_segment=data['first_segment'],
+            n_segments=data['n_segments'],
+            coefficients=data['coefficients'])
+
+
+@functools.lru_cache(maxsize=4)
+def load_named(name: str) -> Ephemeris:
+    """Loads the ephemeris that engineSettings.ephemeris names. The engine
+    does this whenever its state changes, so this remembers the last few."""
+    return load(path(name))
+
+
+def natural_bodies(state: PhysicsState) -> PhysicsState:
+    """Returns a copy of state with only the natural bodies in it."""
+    proto = protos.PhysicalState()
+    proto.CopyFrom(state.as_proto())
+    del proto.entities[:]
+    proto.entities.extend(
+        entity for entity in state.as_proto().entities
+        if not entity.artificial)
+    return PhysicsState(None, proto)
+
+
+def build(state: PhysicsState, duration: float,
+          degree: int = DEFAULT_DEGREE,
+          position_tolerance: float = DEFAULT_POSITION_TOLERANCE,
+          velocity_tolerance: float = DEFAULT_VELOCITY_TOLERANCE
+          ) -> Ephemeris:
+    """Integrates the natural bodies in state for duration seconds, and
+    returns a table of where they went. Artificial entities are so light
+    that leaving them out makes no difference.
+
+    This takes a while, since it integrates with very tight tolerances."""
+    natural = natural_bodies(state)
+    n = len(natural)
+    params = dynamics.build_params(natural)
+    t0 = natural.timestamp
+    t1 = t0 + duration
+    orbits = symplectic.hierarchy(natural, params)
+    periods = [_period(natural, params, orbits, b) for b in range(n)]
+
+    log.info(f'Integrating {n} natural bodies for {duration:,.0f} s.')
+    solution = scipy.integrate.solve_ivp(
+        functools.partial(dynamics.derive, params=params), [t0, t1],
+        natural.y0(), method='DOP853', rtol=1e-12, atol=1e-6,
+        max_step=min(periods) / _STEPS_PER_ORBIT, dense_output=True).sol
+
+    all_coefficients = []
+    segment_length = np.empty(n)
+    first_segment = np.empty(n, dtype=np.int64)
+    n_segments = np.empty(n, dtype=np.int64)
+    nodes = np.cos(np.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))
+    # Between the nodes is where the fit is least accurate.
+    checks = np.cos(np.pi * np.arange(degree + 2) / (degree + 1))
+    total_segments = 0
+    for b, entity in enumerate(natural):
+        segments = max(1, math.ceil(
+            duration * _SEGMENTS_PER_ORBIT / periods[b]))
+        previous_error = np.inf
+        while True:
+            length = duration / segments
+            starts = t0 + length * np.arange(segments)
+            coefficients = np.empty((segments, 4, degree + 1))
+            fit_ts = starts[:, np.newaxis] + length * (nodes + 1) / 2
+            values = solution(fit_ts.ravel())
+            for field_n, field in enumerate([_X, _Y, _VX, _VY]):
+                coefficients[:, field_n] = np.polynomial.chebyshev.chebfit(
+                    nodes, values[field * n + b].reshape(segments, -1).T,
+                    degree).T
+            check_ts = starts[:, np.newaxis] + length * (checks + 1) / 2
+            expected = solution(check_ts.ravel())
+            position_error = 0.0
+            velocity_error = 0.0
+            for k, t in enumerate(check_ts.ravel()):
+                x, y, vx, vy = _evaluate(
+                    coefficients, 0, segments, length, t0, t)
+                position_error = max(position_error, math.hypot(
+                    x - expected[_X * n + b, k], y - expected[_Y * n + b, k]))
+                velocity_error = max(velocity_error, math.hypot(
+                    vx - expected[_VX * n + b, k],
+                    vy - expected[_VY * n + b, k]))
+            if position_error <= position_tolerance and \
+                    velocity_error <= velocity_tolerance:
+                break
+            if position_error + velocity_error >= previous_error:
+                # Shorter segments only fit the integrator's rounding errors
+                # better, so the tolerances are tighter than it can do.
+                log.warning(f'{entity.name} is only within '
+                            f'{position_error:.2g} m and '
+                            f'{velocity_error:.2g} m/s.')
+                break
+            previous_error = position_error + velocity_error
+            segments *= 2
+        log.info(f'{entity.name}: {segments} segments of {length:,.0f} s, '
+                 f'within {position_error:.2g} m and '
+                 f'{velocity_error:.2g} m/s.')
+        all_coefficients.append(coefficients)
+        segment_length[b] = length
+        first_segment[b] = total_segments
+        n_segments[b] = segments
+        total_segments += segments
+
+    return Ephemeris(
+        names=[entity.name for entity in natural], t0=t0, t1=t1,
+        segment_length=segment_length, first_segment=first_segment,
+        n_segments=n_segments,
+        coefficients=np.concatenate(all_coefficients))
+
+
+def _period(state: PhysicsState, params: dynamics.DeriveParams,
+            orbits: symplectic.Hierarchy, index: int) -> float:
+    """Returns the orbital period of an entity around its primary, or
+    infinity if it isn't on a closed orbit."""
+    primary = orbits.primary[index]
+    if primary == _NO_INDEX:
+        return np.inf
+    x = state.X[index] - state.X[primary]
+    y = state.Y[index] - state.Y[primary]
+    v_squared = (state.VX[index] - state.VX[primary]) ** 2 + \
+        (state.VY[index] - state.VY[primary]) ** 2
+    mu = params.GM[index] + params.GM[primary]
+    inverse_a = 2 / math.hypot(x, y) - v_squared / mu
+    if inverse_a <= 0:
+        return np.inf
+    return 2 * np.pi * math.sqrt(inverse_a ** -3 / mu)
+
+
+class Table:
+    """An Ephemeris, matched up with the entities of a PhysicsState."""
+
+    def __init__(self, ephemeris: Ephemeris, state: PhysicsState):
+        """Raises a ValueError if the ephemeris doesn't have any of the
+        state's natural bodies in it."""
+        self.ephemeris = ephemeris
+        names = [entity.name for entity in state]
+        # Which entity of the state each body of the ephemeris is, or
+        # NO_INDEX if the state doesn't have it.
+        self.entities = np.array([
+            names.index(name) if name in names and
+            not state[names.index(name)].artificial else _NO_INDEX
+            for name in ephemeris.names], dtype=np.int64)
+        if (self.entities == _NO_INDEX).all():
+            raise ValueError('The ephemeris has none of the natural bodies '
+                             'in this state.')
+
+        # Indices into the y-vector of everything that isn't looked up, i.e.
+        # all but the position and velocity of each entity in the ephemeris.
+        # solve_ivp integrates the ones that can change.
+        n = len(state)
+        looked_up = np.zeros(len(state.y0()), dtype=np.bool_)
+        for index in self.entities[self.entities != _NO_INDEX]:
+            for field in [_X, _Y, _VX, _VY]:
+                looked_up[field * n + index] = True
+        self.integrated = np.flatnonzero(~looked_up)
+
+    def covers(self, t_span: List[float]) -> bool:
+        return self.ephemeris.t0 <= t_span[0] and \
+            t_span[1] <= self.ephemeris.t1
+
+    def mismatch(self, state: PhysicsState) -> float:
+        """Returns how far, in metres, the furthest natural body in state is
+        from where the ephemeris says it should be."""
+        y_1d = state.y0().copy()
+        self._look_up(state.timestamp, y_1d)
+        return np.max(np.hypot(state.X - y_1d[_X * len(state):
+                                              (_X + 1) * len(state)],
+                               state.Y - y_1d[_Y * len(state):
+                                              (_Y + 1) * len(state)]))
+
+    def _look_up(self, t: float, y_1d: np.ndarray):
+        _look_up(t, y_1d, self.entities, self.ephemeris.coefficients,
+                 self.ephemeris.first_segment, self.ephemeris.n_segments,
+                 self.ephemeris.segment_length, self.ephemeris.t0)
+
+    def solve_ivp(self, params: dynamics.DeriveParams, t_span: List[float],
+                  y0: np.ndarray, events: list, method: str,
+                  max_step: float,
+                  profile: tolerances.Profile = tolerances.PROFILES[
+                      tolerances.DEFAULT_PROFILE]) -> integrators.Result:
+        """Like packed.solve_ivp, but also leaves out the parts of y0 that
+        are in the ephemeris, and looks them up instead.
+
+        Only call this if covers(t_span) is True."""
+        n = len(params.M)
+        integrated = np.intersect1d(self.integrated,
+                                    dynamics.continuous(params))
+        rtol, atol = tolerances.packed(profile, params, integrated, method)
+        # Only entities that aren't looked up need their gravity calculated,
+        # so treat them all like test particles.
+        params = params._replace(test_particles=np.setdiff1d(
+            np.arange(n), self.entities, assume_unique=True))
+
+        def unpack(t: float, y_packed: np.ndarray) -> np.ndarray:
+            y_1d = y0.copy()
+            _expand(y_packed, t, y_1d, params, integrated, self.entities,
+                    self.ephemeris.coefficients, self.ephemeris.first_segment,
+                    self.ephemeris.n_segments, self.ephemeris.segment_length,
+                    self.ephemeris.t0)
+            return y_1d
+
+        # Only the integrated and looked up elements of this are overwritten
+        # on each call to fun, so the rest stay as they are in y0.
+        y_1d = y0.copy()
+        dy = np.empty_like(y0)
+
+        def fun(t: float, y_packed: np.ndarray) -> np.ndarray:
+            return _derive(
+                y_packed, t, y_1d, dy, params, integrated, self.entities,
+                self.ephemeris.coefficients, self.ephemeris.first_segment,
+                self.ephemeris.n_segments, self.ephemeris.segment_length,
+                self.ephemeris.t0)
+
+        return packed.solve_packed(fun, unpack, t_span, y0[integrated],
+                                   events, method, max_step, rtol=rtol,
+                                   atol=atol)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _no_gravity(X, Y, GM, params, AX, AY):
+    """Used as the gravity kernel of derive_into when the entities that
+    aren't test particles are looked up in an ephemeris, so their
+    accelerations don't matter."""
+    AX[:] = 0
+    AY[:] = 0
+
+
+@numba.jit(nopython=True, nogil=True)
+def _evaluate(coefficients, first, n_segments, length, t0, t):
+    """Returns x, y, vx, vy of a body at time t, given the parts of an
+    Ephemeris about that body."""
+    k = min(max(int((t - t0) // length), 0), n_segments - 1)
+    # Where t is in this segment, scaled to [-1, 1].
+    s = 2 * (t - t0 - k * length) / length - 1
+    c = coefficients[first + k]
+
+    # Clenshaw's recurrence for sums of Chebyshev polynomials.
+    values = np.empty(4)
+    for field in range(4):
+        b_1 = 0.0
+        b_2 = 0.0
+        for i in range(c.shape[1] - 1, 0, -1):
+            b_1, b_2 = 2 * s * b_1 - b_2 + c[field, i], b_1
+        values[field] = s * b_1 - b_2 + c[field, 0]
+    return values[0], values[1], values[2], values[3]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _look_up(t, y_1d, entities, coefficients, first_segment, n_segments,
+             segment_length, t0):
+    """Writes the position and velocity at t of each body in the ephemeris
+    into y_1d."""
+    n = (len(y_1d) - _N_SINGULAR_ELEMENTS) // _N_FIELDS
+    for b in range(len(entities)):
+        i = entities[b]
+        if i == _NO_INDEX:
+            continue
+        (y_1d[_X * n + i], y_1d[_Y * n + i],
+         y_1d[_VX * n + i], y_1d[_VY * n + i]) = _evaluate(
+            coefficients, first_segment[b], n_segments[b],
+            segment_length[b], t0, t)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _expand(y_integrated, t, y_1d, params, integrated, entities,
+            coefficients, first_segment, n_segments, segment_length, t0):
+    """Fills in y_1d with the integrated parts of the y-vector, the
+    positions and velocities of bodies from the ephemeris at t, and the
+    landed entities on top of those."""
+    for k in range(len(integrated)):
+        y_1d[integrated[k]] = y_integrated[k]
+    _look_up(t, y_1d, entities, coefficients, first_segment, n_segments,
+             segment_length, t0)
+    dynamics.place_landers(y_1d, params)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _derive(y_integrated, t, y_1d, dy, params, integrated, entities,
+            coefficients, first_segment, n_segments, segment_length, t0):
+    """Returns the derivative of the integrated parts of the y-vector."""
+    _expand(y_integrated, t, y_1d, params, integrated, entities,
+            coefficients, first_segment, n_segments, segment_length, t0)
+    dynamics.derive_into(y_1d, dy, params, _no_gravity,
+                         calc.grav_acc_on_into)
+    return dy[integrated]
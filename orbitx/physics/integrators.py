@@ -0,0 +1,190 @@
+"""The numerical integrators that the physics engine can use.
+
+Most integrators here are one of the methods of scipy.integrate.solve_ivp.
+The exceptions are WisdomHolman and OnRails, see symplectic.py, MultiRate,
+see multirate.py, CompiledRK45, see rk.py, Sundman, see regularized.py, and
+Encke, see encke.py. Savefiles pick one with the integrator field of their
+engine settings, e.g. "engineSettings": {"integrator": "DOP853"}, and
+physicsserver and flighttraining can override that with --integrator.
+
+Run `python benchmark.py integrators` to see how fast and how accurate each
+integrator is on the standard savefiles."""
+
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from orbitx import common
+from orbitx.data_structures import PhysicsState
+
+# Values of Integrator.backend.
+SCIPY = 'scipy'  # scipy.integrate.solve_ivp
+SYMPLECTIC = 'symplectic'  # symplectic.solve_ivp
+COMPILED = 'compiled'  # rk.solve_ivp
+MULTIRATE = 'multirate'  # multirate.solve_ivp
+REGULARIZED = 'regularized'  # regularized.solve_ivp
+PERTURBED = 'perturbed'  # encke.solve_ivp
+
+
+class Integrator(NamedTuple):
+    """Describes one integrator, and how the physics engine should use it."""
+    # The `method` argument to solve_ivp, or the name of the integrator if
+    # it isn't one of the methods of solve_ivp.
+    method: str
+    # Shown in --help.
+    description: str
+    # The largest step the integrator can take, in simulated seconds. This
+    # is as much about not stepping over collisions as it is about accuracy.
+    max_step: float
+    # The largest step at FAST_TIME_ACC and above. At these time accs,
+    # HIGH_ACC_EVENT makes sure the craft is nowhere near anything it could
+    # collide with, so integrators that stay accurate with bigger steps can
+    # take them.
+    fast_max_step: float
+    # Which solve_ivp function does the integrating, see SCIPY etc. above.
+    backend: str = SCIPY
+    # Only for the SYMPLECTIC, MULTIRATE, REGULARIZED and PERTURBED
+    # backends. The integrator to use whenever symplectic.coasting is False,
+    # e.g. while the engines are firing. For the REGULARIZED and PERTURBED
+    # backends, the solve_ivp method to use, and the integrator to use
+    # whenever regularized.applies or encke.applies is False.
+    fallback: Optional[str] = None
+    # Only for the SYMPLECTIC backend. Entities that are perturbed by less
+    # than this are put on rails, see symplectic.put_on_rails. If it's 0,
+    # nothing is.
+    rails_threshold: float = 0
+
+
+class Result(NamedTuple):
+    """The parts of scipy's OdeResult that PhysicsEngine and benchmark.py
+    use. The solve_ivp functions of backends other than SCIPY return one of
+    these."""
+    t: np.ndarray
+    y: np.ndarray
+    # Like scipy's OdeSolution, this also has t_min and t_max attributes.
+    sol: Callable[[float], np.ndarray]
+    t_events: List[np.ndarray]
+    status: int = 0
+    success: bool = True
+    message: str = 'The solver successfully reached the end of the ' \
+                   'integration interval.'
+    # How many times the derivative was evaluated, if we kept track.
+    nfev: int = 0
+
+
+FAST_TIME_ACC = 10_000
+
+# The fastest time acc that only the SYMPLECTIC integrators keep up with in
+# real time. Every other integrator is limited to the next fastest one.
+SYMPLECTIC_TIME_ACC = 1_000_000
+
+DEFAULT_INTEGRATOR = 'RK45'
+
+# Increasing the max steps here results in the simulation being faster to
+# compute but less accurate of an approximation. If Phobos starts crashing into
+# Mars, tweak them downwards.
+_INTEGRATOR_LIST = [
+    Integrator(
+        method='RK45', max_step=100, fast_max_step=100,
+        description='Explicit Runge-Kutta of order 5(4). The default, and '
+                    'a good all-rounder.'),
+    Integrator(
+        method='DOP853', max_step=100, fast_max_step=500,
+        description='Explicit Runge-Kutta of order 8. Slower than RK45 for '
+                    'the same step size, but accurate enough to take much '
+                    'bigger steps at high time accs, where it is about '
+                    'twice as fast.'),
+    Integrator(
+        method='LSODA', max_step=100, fast_max_step=100,
+        description='Adams/BDF multistep method. The fastest integrator '
+                    'here, but with the default tolerances it drifts by '
+                    'hundreds of kilometres a day.'),
+    Integrator(
+        method='Radau', max_step=100, fast_max_step=100,
+        description='Implicit Runge-Kutta of order 5, for stiff problems. '
+                    'Each step needs a Jacobian, so it is about fifty times '
+                    'slower than RK45. Mostly useful for comparison.'),
+    Integrator(
+        method='CompiledRK45', max_step=100, fast_max_step=100,
+        backend=COMPILED,
+        description='The same as RK45, step for step, but compiled. Much '
+                    'less overhead per step than RK45, but compiling it '
+                    'takes about half a minute the first time it is used.'),
+    Integrator(
+        method='WisdomHolman', max_step=100, fast_max_step=500,
+        backend=SYMPLECTIC, fallback='RK45',
+        description='Symplectic integrator that moves everything along its '
+                    'orbit exactly, and only integrates how orbits perturb '
+                    'each other. Much faster and more accurate than the '
+                    'others at high time accs, but only while nothing is '
+                    'thrusting or in an atmosphere. Uses RK45 otherwise.'),
+    Integrator(
+        method='OnRails', max_step=100, fast_max_step=500,
+        backend=SYMPLECTIC, fallback='RK45', rails_threshold=1e-4,
+        description='WisdomHolman, except moons and planets that are barely '
+                    'perturbed just follow their orbits exactly. Less '
+                    'accurate for them, but faster, and if the craft is '
+                    'landed, time acc is only limited by the events.'),
+    Integrator(
+        method='MultiRate', max_step=100, fast_max_step=500,
+        backend=MULTIRATE, fallback='RK45',
+        description='Compiled leapfrog where each entity takes steps as long '
+                    'as its own orbit allows, so distant planets hardly need '
+                    'any work. Only while nothing is thrusting or in an '
+                    'atmosphere, and uses RK45 otherwise.'),
+    Integrator(
+        method='Sundman', max_step=100, fast_max_step=100,
+        backend=REGULARIZED, fallback='RK45',
+        description='RK45, but taking steps in a fictitious time that '
+                    'passes slower the closer the craft is to its '
+                    'reference, so that every step is about the same '
+                    'fraction of its orbit. Only takes fewer steps when '
+                    "the craft's orbit, and not the max step, limits how "
+                    'long steps are. Uses RK45 without a craft in flight.'),
+    Integrator(
+        method='Encke', max_step=100, fast_max_step=100,
+        backend=PERTURBED, fallback='RK45',
+        description='RK45, but only integrating how far the craft is off '
+                    'the conic its reference alone would have it follow, '
+                    'so the craft stays accurate even when steps are long. '
+                    'Uses RK45 without a craft in flight, or while anything '
+                    'is thrusting.'),
+]
+
+INTEGRATORS: Dict[str, Integrator] = {
+    integrator.method: integrator for integrator in _INTEGRATOR_LIST}
+
+
+def integrator(state: PhysicsState) -> Integrator:
+    """Returns the integrator that the state's engine settings ask for.
+    Raises a ValueError if there's no such integrator."""
+    name = state.engine_settings.integrator or DEFAULT_INTEGRATOR
+    if name not in INTEGRATORS:
+        raise ValueError(
+            f'Unknown integrator "{name}", expected one of '
+            f'{", ".join(INTEGRATORS)}.')
+    return INTEGRATORS[name]
+
+
+def fallback(integrator: Integrator) -> Integrator:
+    """Returns the integrator that integrator falls back to. Only call this
+    for integrators that have one, see Integrator.fallback."""
+    assert integrator.fallback is not None, integrator.method
+    return INTEGRATORS[integrator.fallback]
+
+
+def fastest_time_acc(integrator: Integrator, coasting: bool) -> float:
+    """Returns the fastest time acc the integrator keeps up with. coasting is
+    symplectic.coasting() for the state being simulated, since the symplectic
+    integrators fall back to a slower integrator whenever it's False."""
+    if integrator.backend == SYMPLECTIC and coasting:
+        return SYMPLECTIC_TIME_ACC
+    return max(time_acc.value for time_acc in common.TIME_ACCS
+               if time_acc.value < SYMPLECTIC_TIME_ACC)
+
+
+def max_step(integrator: Integrator, time_acc: float) -> float:
+    """Returns the largest step the integrator should take at a time acc."""
+    if time_acc >= FAST_TIME_ACC:
+        return integrator.fast_max_step
+    return integrator.max_step
@@ -0,0 +1,108 @@
+"""Exact two-body motion, used to move entities along their orbits.
+
+If nothing but one other body pulls on an entity, it follows a conic section
+(an ellipse, parabola, or hyperbola) and we can say exactly where it will be
+any amount of time later, instead of integrating its motion step by step.
+
+drift() does this with the universal variable formulation, which works for
+every kind of conic without special cases. See chapter 3 of Curtis, "Orbital
+Mechanics for Engineering Students", or
+https://en.wikipedia.org/wiki/Universal_variable_formulation"""
+
+import math
+
+import numba
+
+# drift() stops refining the universal anomaly once it changes by less than
+# this fraction of itself.
+_TOLERANCE = 1e-13
+_MAX_ITERATIONS = 50
+
+
+@numba.jit(nopython=True, nogil=True)
+def drift(x, y, vx, vy, mu, dt):
+    """Returns (x, y, vx, vy) of a body dt seconds later, where (x, y) and
+    (vx, vy) are its position and velocity relative to a body it's orbiting,
+    and mu is G * (the mass of both bodies)."""
+    r0 = math.sqrt(x * x + y * y)
+    v_squared = vx * vx + vy * vy
+    sqrt_mu = math.sqrt(mu)
+    # The reciprocal of the semimajor axis. Positive for ellipses, zero for
+    # parabolas, negative for hyperbolas.
+    alpha = 2 / r0 - v_squared / mu
+    # r0 * radial velocity / sqrt(mu)
+    sigma0 = (x * vx + y * vy) / sqrt_mu
+
+    if alpha > 0:
+        # Ellipses come back to where they started every period, so never
+        # solve for more than one orbit.
+        period = 2 * math.pi / (sqrt_mu * alpha ** 1.5)
+        dt -= period * math.trunc(dt / period)
+        chi = sqrt_mu * alpha * dt
+    else:
+        chi = sqrt_mu * dt / r0
+
+    # Laguerre-Conway iteration for Kepler's equation in terms of the
+    # universal anomaly chi. It converges from much worse initial guesses than
+    # Newton's method does, which matters for fast hyperbolic flybys.
+    for _ in range(_MAX_ITERATIONS):
+        z = alpha * chi * chi
+        C, S = _stumpff(z)
+        chi_squared = chi * chi
+        F = (sigma0 * chi_squared * C + (1 - alpha * r0) * chi_squared * chi *
+             S + r0 * chi - sqrt_mu * dt)
+        dF = (sigma0 * chi * (1 - z * S) + (1 - alpha * r0) * chi_squared *
+              C + r0)
+        ddF = sigma0 * (1 - z * C) + (1 - alpha * r0) * chi * (1 - z * S)
+        root = math.sqrt(abs(16 * dF * dF - 20 * F * ddF))
+        if dF < 0:
+            root = -root
+        delta = 5 * F / (dF + root)
+        chi -= delta
+        if abs(delta) <= _TOLERANCE * max(abs(chi), 1e-300):
+            break
+
+    z = alpha * chi * chi
+    C, S = _stumpff(z)
+    chi_squared = chi * chi
+    # The Lagrange coefficients, which express the new position and velocity
+    # as combinations of the old ones.
+    f = 1 - chi_squared / r0 * C
+    g = dt - chi_squared * chi * S / sqrt_mu
+    new_x = f * x + g * vx
+    new_y = f * y + g * vy
+    r = math.sqrt(new_x * new_x + new_y * new_y)
+    df = sqrt_mu / (r * r0) * (z * chi * S - chi)
+    dg = 1 - chi_squared / r * C
+    return new_x, new_y, df * x + dg * vx, df * y + dg * vy
+
+
+@numba.jit(nopython=True, nogil=True)
+def periapsis(x, y, vx, vy, mu):
+    """Returns the closest distance that a body with relative position (x, y)
+    and velocity (vx, vy) will get to the body it's orbiting, where mu is
+    G * (the mass of both bodies). Unlike calc.periapsis, this is a distance
+    between centres, not an altitude."""
+    h = x * vy - y * vx
+    energy = (vx * vx + vy * vy) / 2 - mu / math.sqrt(x * x + y * y)
+    eccentricity = math.sqrt(max(0.0, 1 + 2 * energy * h * h / (mu * mu)))
+    # The semi-latus rectum is h^2 / mu, and the periapsis is where the
+    # denominator of the orbit equation is largest.
+    return h * h / mu / (1 + eccentricity)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _stumpff(z):
+    """Returns the Stumpff functions C(z) and S(z)."""
+    if abs(z) < 1e-2:
+        # Taylor series, since the closed forms lose all their precision here.
+        return (1 / 2 - z * (1 / 24 - z * (1 / 720 - z / 40320)),
+                1 / 6 - z * (1 / 120 - z * (1 / 5040 - z / 362880)))
+    elif z > 0:
+        sqrt_z = math.sqrt(z)
+        return ((1 - math.cos(sqrt_z)) / z,
+                (sqrt_z - math.sin(sqrt_z)) / (z * sqrt_z))
+    else:
+        sqrt_z = math.sqrt(-z)
+        return ((math.cosh(sqrt_z) - 1) / -z,
+                (math.sinh(sqrt_z) - sqrt_z) / (-z * sqrt_z))
@@ -0,0 +1,299 @@
+"""A leapfrog integrator where each entity takes steps as long as it can.
+
+solve_ivp integrators step every entity at once, so Sedna, which takes
+eleven thousand years to orbit the Sun, is stepped as often as a craft in low
+Earth orbit. Here, every entity gets its own step, as long as its local
+dynamical timescale allows: the shortest time it would take to orbit
+anything massive enough to matter to it. Steps are a power-of-two fraction
+of a big step, so that every entity lines up at the end of each big step,
+and how far they're divided is worked out again for every big step.
+
+Within a big step, everything moves in substeps of the shortest step, like
+a kick-drift-kick leapfrog with different kicks for different entities:
+
+1. Every entity starting a step of its own gets half a step's kick.
+2. Everything drifts in a straight line for a substep.
+3. Every entity at the end of its step has its acceleration calculated, and
+   gets another half a step's kick.
+
+Only the entities at the end of their steps need their accelerations
+calculated, which is where this saves time. Entities in the middle of a
+step are interpolated to where they are at the time, using the acceleration
+they had at the start of their step. Without that, a planet taking big steps
+would pull on a craft in orbit around it from hundreds of metres away from
+where it really is.
+
+A leapfrog is only second order, so a craft in low Earth orbit would need
+steps of a fraction of a second to stay as accurate as RK45. Instead, each
+big step is three leapfrog passes, forwards, backwards, and forwards again,
+in the proportions that make the whole step fourth order (Yoshida 1990).
+That lets the craft take steps of several seconds.
+
+Like symplectic.py, this can't model thrust, SRBs, or drag, so the engine
+only uses it while symplectic.coasting() is True, and it also stops just
+before any event happens."""
+
+import math
+from typing import List
+
+import numba
+import numpy as np
+
+from orbitx.physics import calc, dynamics, integrators, symplectic
+from orbitx.data_structures import PhysicsState
+
+_X = dynamics._X
+_Y = dynamics._Y
+_VX = dynamics._VX
+_VY = dynamics._VY
+_HEADING = dynamics._HEADING
+_SPIN = dynamics._SPIN
+
+# Each entity's step is at most this fraction of its dynamical timescale.
+# The error per orbit goes up with the fourth power of this, and with 0.005
+# a craft in low Earth orbit drifts by less than a metre per orbit.
+ETA = 0.005
+# Entities less massive than this fraction of an entity don't count when
+# working out how short its steps have to be. Phobos is too light to shorten
+# the steps of Mars, but the Moon isn't too light for the Earth.
+MIN_MASS_RATIO = 1e-6
+# Each big step is split into at most 2**MAX_LEVEL substeps, however close
+# two entities get.
+MAX_LEVEL = 16
+
+# How long each leapfrog pass of a big step is, as a fraction of it.
+_W1 = 1 / (2 - 2 ** (1 / 3))
+_W0 = 1 - 2 * _W1
+
+
+def levels(state: PhysicsState, params: dynamics.DeriveParams,
+           big_step: float) -> np.ndarray:
+    """Returns how many times each entity's step is halved from big_step.
+    Landed entities don't take steps of their own, and get -1."""
+    return _levels(state.X, state.Y, params.GM, _moving(params),
+                   params.sources, big_step)
+
+
+class Solution:
+    """Dense output of solve_ivp, used like scipy's OdeSolution."""
+
+    def __init__(self, ts: np.ndarray, ys: np.ndarray,
+                 accelerations: List[np.ndarray],
+                 step_levels: List[np.ndarray],
+                 params: dynamics.DeriveParams):
+        self.ts = ts
+        self.ys = ys
+        self.accelerations = accelerations
+        self.step_levels = step_levels
+        self.params = params
+        self.t_min = ts[0]
+        self.t_max = ts[-1]
+
+    def __call__(self, t: float) -> np.ndarray:
+        """Returns the y-vector at time t, which should be between t_min and
+        t_max. This takes a shorter big step from the start of the big step
+        t is in, with the same levels, so it's as accurate as the big steps
+        themselves."""
+        step = np.searchsorted(self.ts, t, side='right') - 1
+        if step >= len(self.ts) - 1:
+            return self.ys[:, -1].copy()
+        step = max(step, 0)
+        y_1d = self.ys[:, step].copy()
+        if t > self.ts[step]:
+            _step(y_1d, self.accelerations[step].copy(), self.params,
+                  _moving(self.params), self.step_levels[step],
+                  t - self.ts[step])
+        return y_1d
+
+
+def solve_ivp(params: dynamics.DeriveParams, t_span: List[float],
+              y0: np.ndarray, events: list,
+              max_step: float) -> integrators.Result:
+    """Integrates y0 over t_span, like scipy.integrate.solve_ivp, in big
+    steps of at most max_step.
+
+    Only call this if symplectic.coasting() is True. Like symplectic.solve_ivp,
+    if any of the events are about to happen, this returns early with the
+    last big step before they happen, and never reports any events.
+
+    nfev in the returned Result counts how many times the acceleration of
+    every entity could have been calculated with the work it took to only
+    calculate the accelerations that were needed."""
+    t0, t_end = t_span
+    n_steps = max(1, math.ceil((t_end - t0) / max_step))
+    big_step = (t_end - t0) / n_steps
+    n = len(params.M)
+    moving = _moving(params)
+
+    y_1d = y0.copy()
+    accelerations = np.zeros(2 * n)
+    calc.grav_acc_on_into(y_1d[_X * n:(_X + 1) * n], y_1d[_Y * n:(_Y + 1) * n],
+                          params.GM, params.sources, moving,
+                          accelerations[:n], accelerations[n:])
+    ts = [t0]
+    ys = [y0.copy()]
+    all_accelerations = []
+    all_levels = []
+    evaluations = len(moving)
+    last_values = [event(t0, y_1d) for event in events]
+    for step in range(1, n_steps + 1):
+        step_levels = _levels(
+            y_1d[_X * n:(_X + 1) * n], y_1d[_Y * n:(_Y + 1) * n], params.GM,
+            moving, params.sources, big_step)
+        start_accelerations = accelerations.copy()
+        evaluations += _step(y_1d, accelerations, params, moving, step_levels,
+                             big_step)
+        t = t0 + step * big_step if step < n_steps else t_end
+
+        # All of our events are terminal and only trigger when they
+        # decrease through zero, see engine.Event.
+        values = [event(t, y_1d) for event in events]
+        if any(last > 0 >= value
+               for last, value in zip(last_values, values)):
+            break
+        last_values = values
+        ts.append(t)
+        ys.append(y_1d.copy())
+        all_accelerations.append(start_accelerations)
+        all_levels.append(step_levels)
+
+    ts = np.array(ts)
+    ys = np.array(ys).T
+    return integrators.Result(
+        t=ts, y=ys,
+        sol=Solution(ts, ys, all_accelerations, all_levels, params),
+        t_events=[np.array([]) for _ in events],
+        nfev=math.ceil(evaluations / max(1, len(moving))))
+
+
+def _moving(params: dynamics.DeriveParams) -> np.ndarray:
+    """Every entity that isn't landed."""
+    landed = np.zeros(len(params.M), dtype=np.bool_)
+    landed[params.landers] = True
+    return np.flatnonzero(~landed)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _levels(X, Y, GM, moving, sources, big_step):
+    """See levels. Each entity's dynamical timescale is the shortest time
+    it would take to orbit, at its current distance, any source that's at
+    least MIN_MASS_RATIO as massive as it is, divided by 2 pi."""
+    step_levels = np.full(len(X), -1, dtype=np.int64)
+    for k in range(len(moving)):
+        i = moving[k]
+        timescale_squared = np.inf
+        for s in range(len(sources)):
+            j = sources[s]
+            if j == i or GM[j] < MIN_MASS_RATIO * GM[i]:
+                continue
+            r_squared = (X[j] - X[i]) ** 2 + (Y[j] - Y[i]) ** 2
+            timescale_squared = min(
+                timescale_squared,
+                r_squared * math.sqrt(r_squared) / (GM[i] + GM[j]))
+        step = ETA * math.sqrt(timescale_squared)
+        if step >= big_step:
+            step_levels[i] = 0
+        else:
+            step_levels[i] = min(MAX_LEVEL,
+                                 int(math.ceil(math.log2(big_step / step))))
+    return step_levels
+
+
+@numba.jit(nopython=True, nogil=True)
+def _step(y_1d, accelerations, params, moving, step_levels, big_step):
+    """Advances y_1d by a big step, in place, and returns how many
+    accelerations were calculated. accelerations has the accelerations of
+    the entities in y_1d, x components then y components, and is updated
+    to match it."""
+    return _leapfrog(y_1d, accelerations, params, moving, step_levels,
+                     _W1 * big_step) + \
+        _leapfrog(y_1d, accelerations, params, moving, step_levels,
+                  _W0 * big_step) + \
+        _leapfrog(y_1d, accelerations, params, moving, step_levels,
+                  _W1 * big_step)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _leapfrog(y_1d, accelerations, params, moving, step_levels, big_step):
+    """One leapfrog pass of _step, which can go backwards in time."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    VX = y_1d[_VX * n:(_VX + 1) * n]
+    VY = y_1d[_VY * n:(_VY + 1) * n]
+    Heading = y_1d[_HEADING * n:(_HEADING + 1) * n]
+    Spin = y_1d[_SPIN * n:(_SPIN + 1) * n]
+    AX = accelerations[:n]
+    AY = accelerations[n:]
+
+    finest = max(0, step_levels.max())
+    substeps = 2 ** finest
+    substep = big_step / substeps
+    # How many substeps are in each entity's step, and how long it is.
+    stride = np.ones(n, dtype=np.int64)
+    dt = np.zeros(n)
+    for k in range(len(moving)):
+        i = moving[k]
+        stride[i] = 2 ** (finest - step_levels[i])
+        dt[i] = stride[i] * substep
+        VX[i] += AX[i] * dt[i] / 2
+        VY[i] += AY[i] * dt[i] / 2
+
+    XP = np.empty(n)
+    YP = np.empty(n)
+    active = np.empty(len(moving), dtype=np.int64)
+    evaluations = 0
+    landed_x, landed_y = symplectic._landed_offsets(X, Y, params)
+    for s in range(1, substeps + 1):
+        # Landed entities drift in a straight line too, until they're put
+        # back on what they're landed on at the end.
+        for i in range(n):
+            X[i] += VX[i] * substep
+            Y[i] += VY[i] * substep
+        n_active = 0
+        for k in range(len(moving)):
+            i = moving[k]
+            if s % stride[i] == 0:
+                active[n_active] = i
+                n_active += 1
+        _interpolate(X, Y, AX, AY, XP, YP, params, moving, stride, dt,
+                     substep, s)
+        calc.grav_acc_on_into(XP, YP, params.GM, params.sources,
+                              active[:n_active], AX, AY)
+        evaluations += n_active
+        # Finish this step with half a kick, and start the next one with
+        # another half, unless this is the end of the big step.
+        for k in range(n_active):
+            i = active[k]
+            kick = dt[i] if s < substeps else dt[i] / 2
+            VX[i] += AX[i] * kick
+            VY[i] += AY[i] * kick
+
+    # Turning only depends on how long it's been, except with the autopilot
+    # on, which turns at most as fast as it can by the end.
+    symplectic._turn(X, Y, VX, VY, Heading, Spin, params, landed_x, landed_y,
+                     big_step)
+    return evaluations
+
+
+@numba.jit(nopython=True, nogil=True)
+def _interpolate(X, Y, AX, AY, XP, YP, params, moving, stride, dt, substep,
+                 s):
+    """Writes where every entity is after s substeps into XP and YP.
+
+    X and Y are where the leapfrog has drifted everything to. That's right
+    at the end of each entity's step, but in between, it's a straight line.
+    Entities in the middle of a step are bent back onto a parabola with the
+    acceleration they had at the start of it, and landed entities are moved
+    with what they're landed on."""
+    XP[:] = X
+    YP[:] = Y
+    for k in range(len(moving)):
+        i = moving[k]
+        into_step = (s % stride[i]) * substep
+        XP[i] -= AX[i] * into_step * (dt[i] - into_step) / 2
+        YP[i] -= AY[i] * into_step * (dt[i] - into_step) / 2
+    for k in range(len(params.landers)):
+        ground = params.grounds[k]
+        XP[params.landers[k]] += XP[ground] - X[ground]
+        YP[params.landers[k]] += YP[ground] - Y[ground]
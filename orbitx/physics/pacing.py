@@ -0,0 +1,94 @@
+"""Picking how long each chunk of simulation is.
+
+The simthread simulates in chunks. Each chunk is one call to solve_ivp, and
+before it the simthread rebuilds the DeriveParams and events, and after it
+hands the solution over to the main thread. That overhead is the same however
+long the chunk is, so short chunks waste time, which matters most at low time
+accs where a chunk is only a few steps long. But the main thread has to wait
+in get_state if it catches up with the simthread, and commands have to wait
+for the current chunk to finish before the simthread starts simulating them,
+so chunks can't take too long either.
+
+A Pacer measures how many simulated seconds the main thread consumes per wall
+second, and how many wall seconds the simthread takes per simulated second.
+From those, it picks chunks long enough that the simthread stays LOOKAHEAD
+wall seconds ahead of the main thread, so there are as few chunks as
+possible, but short enough that none of them takes longer than
+MAX_CHUNK_WALL_TIME. Until it has measured anything, and while any engines
+or SRBs are firing, chunks are as long as they used to be, see
+tuning.CHUNK_STEPS."""
+
+from typing import Optional, Tuple
+
+# How far ahead of the main thread the simthread tries to stay, in wall
+# seconds.
+LOOKAHEAD = 2.0
+# The longest a chunk should take to simulate, in wall seconds.
+MAX_CHUNK_WALL_TIME = 0.1
+# The main thread's consumption is measured over at least this many wall
+# seconds, so that a few quick chunks in a row don't look like the main
+# thread has stopped.
+CONSUMPTION_WINDOW = 0.25
+# How much each new measurement counts for, compared to all the earlier ones.
+SMOOTHING = 0.5
+
+
+class Pacer:
+    """Measures the simthread and the main thread at one time acc, and picks
+    chunk lengths from that. Only the simthread uses this."""
+
+    def __init__(self, time_acc: float):
+        self.time_acc = time_acc
+        # Simulated seconds the main thread consumes per wall second, and
+        # wall seconds the simthread takes per simulated second. These are
+        # None until they've been measured.
+        self.consumption: Optional[float] = None
+        self.cost: Optional[float] = None
+        self._last_consumed: Optional[Tuple[float, float]] = None
+
+    def consumed(self, simtime: float, monotime: float):
+        """Records that the main thread had asked for the state at simtime,
+        as of time.monotonic() == monotime."""
+        if self._last_consumed is None:
+            self._last_consumed = (simtime, monotime)
+            return
+        last_simtime, last_monotime = self._last_consumed
+        if monotime - last_monotime < CONSUMPTION_WINDOW:
+            return
+        self.consumption = _smooth(
+            self.consumption,
+            max(simtime - last_simtime, 0) / (monotime - last_monotime))
+        self._last_consumed = (simtime, monotime)
+
+    def simulated(self, duration: float, wall_time: float):
+        """Records that a chunk of duration simulated seconds took wall_time
+        wall seconds, including building its events and parameters."""
+        if duration <= 0:
+            # The chunk stopped right away for an event, so there's nothing
+            # to learn about how long simulating takes.
+            return
+        self.cost = _smooth(self.cost, wall_time / duration)
+
+    def chunk(self, default: float, shortest: float,
+              longest: float) -> float:
+        """Returns how many simulated seconds the next chunk should be.
+
+        default is the length to use before the cost of simulating has been
+        measured. Chunks are never shorter than shortest, usually one max
+        step, or longer than longest."""
+        if self.cost is None:
+            return min(default, longest)
+        # Until the main thread has been measured, assume it's asking for
+        # the state in real time, like orbitx.py does.
+        consumption = self.time_acc if self.consumption is None \
+            else self.consumption
+        chunk = consumption * LOOKAHEAD
+        if self.cost > 0:
+            chunk = min(chunk, MAX_CHUNK_WALL_TIME / self.cost)
+        return min(max(chunk, shortest), longest)
+
+
+def _smooth(average: Optional[float], measurement: float) -> float:
+    if average is None:
+        return measurement
+    return SMOOTHING * measurement + (1 - SMOOTHING) * average
@@ -0,0 +1,185 @@
+"""Integrating only the parts of the y-vector that change.
+
+More than half of a PhysicsState's y-vector stays the same for a whole chunk
+of simulation: throttles, landed_on, broken, spins, the fuel of natural
+bodies, and time_acc only ever change between chunks, when the engine handles
+an event or a command, and derive_into always gives them a derivative of zero.
+scipy doesn't know that, so it carries them through every stage of every step
+and stores them in the dense output. Worse, they count towards its error norm,
+which is a root mean square over the whole y-vector, so the error in the
+elements that do change looked smaller than it really was.
+
+solve_ivp here integrates a packed y-vector of only the elements in
+dynamics.continuous, and fills in the rest from y0 whenever the whole y-vector
+is needed: for the derivative, for events, and for everything it returns. The
+PhysicsStates the engine makes out of those never see the packed y-vector.
+
+Landed and docked entities aren't integrated either: they can only move with
+whatever they're landed on, so dynamics.place_landers puts them there
+whenever the whole y-vector is filled in. Their glued-on motion used to make
+the system stiff, and cost as much to integrate as any other entity."""
+
+from typing import Callable, List, Optional
+
+import numba
+import numpy as np
+import scipy.integrate
+
+from orbitx.physics import dynamics, integrators, relative, symplectic, \
+    tolerances
+
+
+def solve_ivp(params: dynamics.DeriveParams, t_span: List[float],
+              y0: np.ndarray, events: list, method: str, max_step: float,
+              profile: tolerances.Profile = tolerances.PROFILES[
+                  tolerances.DEFAULT_PROFILE],
+              derivatives: Optional[dynamics.DerivativeCache] = None,
+              orbits: Optional[symplectic.Hierarchy] = None
+              ) -> integrators.Result:
+    """Like scipy.integrate.solve_ivp with dense output, integrating y0 with
+    dynamics.derive to the tolerances of profile, but only integrates the
+    elements of y0 in dynamics.continuous(params).
+
+    Every derivative worked out is stored in derivatives, if given, for the
+    events to reuse. If orbits is given, positions and velocities are
+    integrated relative to each entity's primary, see relative.py."""
+    integrated = dynamics.continuous(params)
+    rtol, atol = tolerances.packed(profile, params, integrated, method)
+    gravity, test_particle_gravity = dynamics.gravity_kernels(params)
+    # Only the integrated elements of this are overwritten on each call to
+    # fun, so the rest stay as they are in y0.
+    y_1d = y0.copy()
+    dy = np.empty_like(y0)
+
+    if orbits is None:
+        def fun(t: float, y_packed: np.ndarray) -> np.ndarray:
+            dy_packed = _derive(y_packed, y_1d, dy, integrated, params,
+                                gravity, test_particle_gravity)
+            if derivatives is not None:
+                derivatives.store(t, y_1d, dy)
+            return dy_packed
+
+        def unpack(t: float, y_packed: np.ndarray) -> np.ndarray:
+            y_full = y0.copy()
+            y_full[integrated] = y_packed
+            dynamics.place_landers(y_full, params)
+            return y_full
+
+        return solve_packed(fun, unpack, t_span, y0[integrated], events,
+                            method, max_step, rtol=rtol, atol=atol)
+
+    primary = orbits.primary
+    order = orbits.order
+    dy_relative = np.empty_like(y0)
+
+    def fun(t: float, y_packed: np.ndarray) -> np.ndarray:
+        dy_packed = _derive_relative(
+            y_packed, y_1d, dy, dy_relative, integrated, params, gravity,
+            test_particle_gravity, primary, order)
+        if derivatives is not None:
+            derivatives.store(t, y_1d, dy)
+        return dy_packed
+
+    def unpack(t: float, y_packed: np.ndarray) -> np.ndarray:
+        y_full = y0.copy()
+        y_full[integrated] = y_packed
+        relative.to_absolute(y_full, primary, order)
+        dynamics.place_landers(y_full, params)
+        return y_full
+
+    y0_relative = y0.copy()
+    relative.to_relative(y0_relative, primary, order)
+    return solve_packed(fun, unpack, t_span, y0_relative[integrated], events,
+                        method, max_step, rtol=rtol, atol=atol)
+
+
+def solve_packed(fun: Callable, unpack: Callable, t_span: List[float],
+                 y_packed: np.ndarray, events: list, method: str,
+                 max_step: float, **options) -> integrators.Result:
+    """Integrates y_packed with scipy, where fun(t, y_packed) is its
+    derivative and unpack(t, y_packed) returns the whole y-vector it's part
+    of. events are called with the whole y-vector, and the Result has whole
+    y-vectors in it, including from its dense output."""
+    unpacked = _Unpacked(unpack)
+    ivp_out = scipy.integrate.solve_ivp(
+        fun=fun, t_span=t_span, y0=y_packed,
+        events=[_UnpackedEvent(event, unpacked) for event in events],
+        dense_output=True, method=method, max_step=max_step, **options)
+    ys = np.array([unpack(t, y) for t, y in zip(ivp_out.t, ivp_out.y.T)]).T
+    return integrators.Result(
+        t=ivp_out.t, y=ys, sol=_Solution(ivp_out.sol, unpack),
+        t_events=ivp_out.t_events, status=ivp_out.status,
+        success=ivp_out.success, message=ivp_out.message, nfev=ivp_out.nfev)
+
+
+class _Unpacked:
+    """Remembers the last y-vector it unpacked, so that every event called
+    after a step gets the same whole y-vector, and engine.CompiledEvents
+    only has to evaluate them once."""
+
+    def __init__(self, unpack: Callable):
+        self.unpack = unpack
+        self.t = None
+        self.y_packed = None
+        self.y_full = None
+
+    def __call__(self, t: float, y_packed: np.ndarray) -> np.ndarray:
+        if t != self.t or y_packed is not self.y_packed:
+            self.y_full = self.unpack(t, y_packed)
+            self.t = t
+            self.y_packed = y_packed
+        return self.y_full
+
+
+class _UnpackedEvent:
+    """Calls an engine event with the whole y-vector."""
+
+    def __init__(self, event, unpacked: _Unpacked):
+        self.event = event
+        self.unpacked = unpacked
+        self.terminal = event.terminal
+        self.direction = event.direction
+
+    def __call__(self, t: float, y_packed: np.ndarray) -> float:
+        return self.event(t, self.unpacked(t, y_packed))
+
+
+class _Solution:
+    """Dense output of solve_packed, used like scipy's OdeSolution."""
+
+    def __init__(self, sol, unpack: Callable):
+        self.sol = sol
+        self.unpack = unpack
+        self.t_min = sol.t_min
+        self.t_max = sol.t_max
+
+    def __call__(self, t: float) -> np.ndarray:
+        return self.unpack(t, self.sol(t))
+
+
+@numba.jit(nopython=True, nogil=True)
+def _derive(y_packed, y_1d, dy, integrated, params, gravity,
+            test_particle_gravity):
+    """Returns the derivative of y_packed, the integrated elements of
+    y_1d."""
+    for k in range(len(integrated)):
+        y_1d[integrated[k]] = y_packed[k]
+    dynamics.place_landers(y_1d, params)
+    dynamics.derive_into(y_1d, dy, params, gravity, test_particle_gravity)
+    return dy[integrated]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _derive_relative(y_packed, y_1d, dy, dy_relative, integrated, params,
+                     gravity, test_particle_gravity, primary, order):
+    """Like _derive, but y_packed is relative to each entity's primary. The
+    y-vector and its derivative are left in y_1d and dy, relative to the
+    Sun, and dy_relative is scratch space."""
+    for k in range(len(integrated)):
+        y_1d[integrated[k]] = y_packed[k]
+    relative.to_absolute(y_1d, primary, order)
+    dynamics.place_landers(y_1d, params)
+    dynamics.derive_into(y_1d, dy, params, gravity, test_particle_gravity)
+    dy_relative[:] = dy
+    relative.to_relative(dy_relative, primary, order)
+    return dy_relative[integrated]
@@ -0,0 +1,257 @@
+"""Integrating with a Sundman time transformation around the craft's
+reference.
+
+On an eccentric orbit, the craft moves fastest and its acceleration changes
+fastest at periapsis, so an adaptive integrator stepping in time has to take
+tiny steps there, and can take huge ones at apoapsis. Near a close flyby,
+nearly every step of a chunk is spent on the few minutes around closest
+approach, and the step size changes by orders of magnitude in between.
+
+solve_ivp here integrates in a fictitious time s instead, where
+
+    dt/ds = min((r / r0) ** EXPONENT, 1)
+
+and r is the distance from the craft to its reference. Closer than r0, a step
+in s is a shorter step in time the closer the craft is to its reference, so
+the integrator's steps in s hardly need to change size over an orbit. With
+an EXPONENT of 3/2, a step in s is about the same fraction of an orbit
+wherever the craft is, and the number of steps per orbit hardly depends on
+the eccentricity at all.
+
+Further out than r0, s is just time, so max_step still limits how long a
+step in time is. The craft isn't the only thing being integrated, and fast
+moons like Phobos need that. r0 is where RK45 would take steps of max_step
+on a circular orbit, since closer in, the tolerances limit its steps instead,
+or the periapsis of the craft's orbit if that's further out. Without a
+max_step, r0 is the periapsis and dt/ds isn't capped at 1, so a step in s is
+as long as a step in time there. `python benchmark.py regularized` measures
+all this.
+
+Time is integrated along with the packed y-vector (see packed.py), relative
+to the start of the chunk so that it isn't a small difference between two
+huge timestamps. The chunk ends when t gets to the end of t_span, which is
+found like any other event, and everything solve_ivp returns is in time, not
+in s, so nothing outside this module ever sees s."""
+
+import math
+from typing import Callable, List, Optional, Tuple
+
+import numba
+import numpy as np
+import scipy.integrate
+import scipy.optimize
+
+from orbitx import common
+from orbitx.physics import dynamics, integrators, packed, relative, \
+    symplectic, tolerances
+
+_NO_INDEX = dynamics._NO_INDEX
+_X = dynamics._X
+_Y = dynamics._Y
+_VX = dynamics._VX
+_VY = dynamics._VY
+
+# dt/ds is the distance to the reference to this power, see above. 1 makes s
+# proportional to the eccentric anomaly, and 2 to the true anomaly.
+EXPONENT = 1.5
+
+# How many steps RK45 takes per radian of a circular orbit, with the default
+# tolerances. See r0 above.
+_STEPS_PER_RADIAN = 5
+
+# Absolute tolerance of the time since the start of the chunk, in seconds.
+# The craft goes a few metres in a millisecond.
+_TIME_ATOL = 1e-3
+
+
+def applies(params: dynamics.DeriveParams) -> bool:
+    """Returns True if there's a craft and a reference that it's not landed
+    on, which solve_ivp needs. Use the regularized integrator's fallback
+    otherwise."""
+    return params.craft != _NO_INDEX and \
+        params.reference != _NO_INDEX and \
+        params.craft != params.reference and \
+        params.craft not in params.landers
+
+
+def solve_ivp(params: dynamics.DeriveParams, t_span: List[float],
+              y0: np.ndarray, events: list, method: str, max_step: float,
+              profile: tolerances.Profile = tolerances.PROFILES[
+                  tolerances.DEFAULT_PROFILE],
+              orbits: Optional[symplectic.Hierarchy] = None
+              ) -> integrators.Result:
+    """Like packed.solve_ivp, but steps in s instead of time. max_step is
+    still the longest step in time.
+
+    Only call this if applies(params) is True."""
+    integrated = dynamics.continuous(params)
+    rtol, atol = tolerances.packed(profile, params, integrated, method)
+    rtol = np.append(rtol, np.min(rtol))
+    atol = np.append(atol, _TIME_ATOL)
+    gravity, test_particle_gravity = dynamics.gravity_kernels(params)
+    t0, t_end = t_span
+    if orbits is None:
+        # Converting to and from relative coordinates does nothing if
+        # there's no hierarchy to convert with.
+        primary = np.full(len(params.M), _NO_INDEX, dtype=np.int64)
+        order = np.empty(0, dtype=np.int64)
+    else:
+        primary = orbits.primary
+        order = orbits.order
+    y_1d = y0.copy()
+    dynamics.place_landers(y_1d, params)
+    dy = np.empty_like(y0)
+    dy_relative = np.empty_like(y0)
+    r0, cap = _scale(y_1d, params, max_step)
+
+    def fun(s: float, z: np.ndarray) -> np.ndarray:
+        return _derive(z, y_1d, dy, dy_relative, integrated, params,
+                       gravity, test_particle_gravity, primary, order, r0,
+                       cap)
+
+    def unpack(z: np.ndarray) -> np.ndarray:
+        y_full = y0.copy()
+        y_full[integrated] = z[:-1]
+        relative.to_absolute(y_full, primary, order)
+        dynamics.place_landers(y_full, params)
+        return y_full
+
+    def end(s: float, z: np.ndarray) -> float:
+        return t_end - t0 - z[-1]
+    end.terminal = True
+    end.direction = -1
+
+    y0_relative = y0.copy()
+    relative.to_relative(y0_relative, primary, order)
+    # Events are called with s, which packed._Unpacked doesn't need.
+    unpacked = packed._Unpacked(lambda s, z: unpack(z))
+    ivp_out = scipy.integrate.solve_ivp(
+        fun=fun, t_span=[0, np.inf],
+        y0=np.append(y0_relative[integrated], 0),
+        events=[_TimedEvent(event, t0, unpacked) for event in events] +
+        [end], dense_output=True, method=method, max_step=max_step,
+        rtol=rtol, atol=atol)
+
+    ts = t0 + ivp_out.y[-1]
+    status = ivp_out.status
+    message = ivp_out.message
+    if status == 1 and all(len(s_events) == 0
+                           for s_events in ivp_out.t_events[:-1]):
+        # Only the end of t_span was found, which isn't a real event.
+        ts[-1] = t_end
+        status = 0
+        message = integrators.Result._field_defaults['message']
+    ys = np.array([unpack(z) for z in ivp_out.y.T]).T
+    return integrators.Result(
+        t=ts, y=ys, sol=_Solution(ivp_out.sol, ivp_out.t, ts, t0, unpack),
+        t_events=[t0 + z_events[:, -1] if len(z_events) else np.array([])
+                  for z_events in ivp_out.y_events[:-1]],
+        status=status, success=ivp_out.success, message=message,
+        nfev=ivp_out.nfev)
+
+
+class _TimedEvent:
+    """Calls an engine event with the time and the whole y-vector, unlike
+    packed._UnpackedEvent, which would call it with s."""
+
+    def __init__(self, event, t0: float, unpacked: packed._Unpacked):
+        self.event = event
+        self.t0 = t0
+        self.unpacked = unpacked
+        self.terminal = event.terminal
+        self.direction = event.direction
+
+    def __call__(self, s: float, z: np.ndarray) -> float:
+        return self.event(self.t0 + z[-1], self.unpacked(s, z))
+
+
+class _Solution:
+    """Dense output of solve_ivp, used like scipy's OdeSolution. Finds the s
+    that each t is at, and returns the y-vector there."""
+
+    def __init__(self, sol, ss: np.ndarray, ts: np.ndarray, t0: float,
+                 unpack: Callable):
+        # ss and ts are the s and t at the end of each step.
+        self.sol = sol
+        self.ss = ss
+        self.ts = ts
+        self.t0 = t0
+        self.unpack = unpack
+        self.t_min = ts[0]
+        self.t_max = ts[-1]
+
+    def __call__(self, t: float) -> np.ndarray:
+        if len(self.ss) == 1:
+            return self.unpack(self.sol(self.ss[0]))
+        step = min(max(np.searchsorted(self.ts, t) - 1, 0),
+                   len(self.ss) - 2)
+        s_start = self.ss[step]
+        s_end = self.ss[step + 1]
+        if t <= self.ts[step]:
+            s = s_start
+        elif t >= self.ts[step + 1]:
+            s = s_end
+        else:
+            s = scipy.optimize.brentq(
+                lambda s: self.t0 + self.sol(s)[-1] - t, s_start, s_end)
+        return self.unpack(self.sol(s))
+
+
+def _scale(y_1d: np.ndarray, params: dynamics.DeriveParams,
+           max_step: float) -> Tuple[float, float]:
+    """Returns r0, see the top of this file, and the most that dt/ds can
+    be."""
+    r0 = _periapsis(y_1d, params)
+    if max_step == np.inf:
+        return r0, np.inf
+    mu = common.G * (params.M[params.craft] + params.M[params.reference])
+    # A radian of a circular orbit of radius r takes sqrt(r**3 / mu).
+    r_max_step = (mu * (_STEPS_PER_RADIAN * max_step) ** 2) ** (1 / 3)
+    return max(r0, r_max_step), 1.0
+
+
+def _periapsis(y_1d: np.ndarray, params: dynamics.DeriveParams) -> float:
+    """Returns the periapsis distance of the osculating orbit of the craft
+    around its reference, but no lower than the surface of the
+    reference."""
+    n = len(params.M)
+    craft = params.craft
+    reference = params.reference
+    x = y_1d[_X * n + craft] - y_1d[_X * n + reference]
+    y = y_1d[_Y * n + craft] - y_1d[_Y * n + reference]
+    vx = y_1d[_VX * n + craft] - y_1d[_VX * n + reference]
+    vy = y_1d[_VY * n + craft] - y_1d[_VY * n + reference]
+    r = math.hypot(x, y)
+    mu = common.G * (params.M[craft] + params.M[reference])
+    # Same as calc.periapsis, from the specific angular momentum and energy.
+    h = x * vy - y * vx
+    energy = (vx * vx + vy * vy) / 2 - mu / r
+    e = math.sqrt(max(1 + 2 * energy * h * h / (mu * mu), 0))
+    return max(h * h / (mu * (1 + e)), params.R[reference])
+
+
+@numba.jit(nopython=True, nogil=True)
+def _distance(y_1d, params):
+    """Returns how far the craft is from its reference."""
+    n = len(params.M)
+    craft = params.craft
+    reference = params.reference
+    return math.hypot(y_1d[_X * n + craft] - y_1d[_X * n + reference],
+                      y_1d[_Y * n + craft] - y_1d[_Y * n + reference])
+
+
+@numba.jit(nopython=True, nogil=True)
+def _derive(z, y_1d, dy, dy_relative, integrated, params, gravity,
+            test_particle_gravity, primary, order, r0, cap):
+    """Returns the derivative with respect to s of z, which is the packed
+    y-vector with the time since the start of the chunk after it. r0 and
+    cap are from _scale, and the rest of the arguments are the same as
+    packed._derive_relative's."""
+    dy_packed = packed._derive_relative(
+        z[:-1], y_1d, dy, dy_relative, integrated, params, gravity,
+        test_particle_gravity, primary, order)
+    dt_ds = min((_distance(y_1d, params) / r0) ** EXPONENT, cap)
+    dz = np.empty(len(z))
+    dz[:-1] = dy_packed * dt_ds
+    dz[-1] = dt_ds
+    return dz
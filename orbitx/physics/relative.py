@@ -0,0 +1,71 @@
+"""Integrating positions and velocities relative to each entity's primary.
+
+Everything in the y-vector is relative to the Sun, so positions are around
+1e11 m. A craft in low Earth orbit is then integrated as the small difference
+between two huge numbers, and the tolerances in tolerances.py, which are
+relative to the size of each element, let it be off by far more than the size
+of its orbit. Its motion relative to the Earth is what actually matters.
+
+With the relative_coordinates engine setting, packed.solve_ivp integrates the
+position and velocity of every entity relative to its primary (see
+symplectic.hierarchy), so the Moon is integrated relative to the Earth, and a
+craft in low Earth orbit is too. The most massive entity, and landed
+entities, stay relative to the Sun. The primaries are worked out again at the
+start of every chunk, and the y-vectors that packed.solve_ivp hands to the
+derivative, the events, and everything it returns are converted back, so
+nothing outside packed.py ever sees relative coordinates.
+
+The y-vectors are converted in place, in the order of the hierarchy: every
+primary comes before the entities orbiting it."""
+
+from typing import Optional
+
+import numba
+
+from orbitx.physics import dynamics, symplectic
+from orbitx.data_structures import PhysicsState
+
+_NO_INDEX = PhysicsState.NO_INDEX
+_X = dynamics._X
+_Y = dynamics._Y
+_VX = dynamics._VX
+_VY = dynamics._VY
+
+
+def orbits(state: PhysicsState, params: dynamics.DeriveParams
+           ) -> Optional[symplectic.Hierarchy]:
+    """Returns what to pass as the orbits of packed.solve_ivp: the hierarchy
+    of the state if its engine settings ask for relative coordinates, and
+    None otherwise."""
+    if not state.engine_settings.relative_coordinates:
+        return None
+    return symplectic.hierarchy(state, params)
+
+
+@numba.jit(nopython=True, nogil=True)
+def to_relative(y_1d, primary, order):
+    """Makes the positions and velocities in y_1d relative to each entity's
+    primary. This works on the derivative of a y-vector too."""
+    n = len(primary)
+    # Entities orbiting a primary come after it, so this converts them
+    # while their primary is still relative to the Sun.
+    for k in range(len(order) - 1, -1, -1):
+        i = order[k]
+        p = primary[i]
+        if p == _NO_INDEX:
+            continue
+        for field in (_X, _Y, _VX, _VY):
+            y_1d[field * n + i] -= y_1d[field * n + p]
+
+
+@numba.jit(nopython=True, nogil=True)
+def to_absolute(y_1d, primary, order):
+    """Undoes to_relative."""
+    n = len(primary)
+    for k in range(len(order)):
+        i = order[k]
+        p = primary[i]
+        if p == _NO_INDEX:
+            continue
+        for field in (_X, _Y, _VX, _VY):
+            y_1d[field * n + i] += y_1d[field * n + p]
@@ -0,0 +1,409 @@
+"""A compiled version of scipy's RK45 integrator.
+
+scipy.integrate.solve_ivp is written in Python, so even with a compiled
+derivative (see dynamics.py), every step pays for Python doing step size
+control, building a dense output object, and calling each of our events.
+solve_ivp here does all of that in a single numba call per chunk of
+simulation, using the compiled events in dynamics.py.
+
+It takes exactly the same steps as scipy's RK45 does in packed.solve_ivp:
+the same Dormand-Prince coefficients, initial step size, error control, and
+event handling. See scipy/integrate/_ivp/rk.py and ivp.py if you want to
+compare. Like packed.solve_ivp, error control only looks at the elements of
+the y-vector that can change, but this still steps the whole y-vector, since
+it doesn't cost any Python overhead. Landed entities are stepped too, but
+dynamics.place_landers puts them back on what they're landed on at every
+stage, so they don't count towards the error either."""
+
+import math
+
+import numba
+import numpy as np
+
+from orbitx.physics import dynamics, integrators, tolerances
+
+_N_STAGES = 6
+# Our derivative doesn't depend on time, so we don't need the C coefficients
+# that say when each stage is.
+_A = np.array([
+    [0, 0, 0, 0, 0],
+    [1 / 5, 0, 0, 0, 0],
+    [3 / 40, 9 / 40, 0, 0, 0],
+    [44 / 45, -56 / 15, 32 / 9, 0, 0],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729, 0],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]
+])
+_B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+_E = np.array([-71 / 57600, 0, 71 / 16695, -71 / 1920, 17253 / 339200,
+               -22 / 525, 1 / 40])
+# Coefficients of the quartic dense output.
+_P = np.array([
+    [1, -8048581381 / 2820520608, 8663915743 / 2820520608,
+     -12715105075 / 11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200 / 32700410799, -68118460800 / 10900136933,
+     87487479700 / 32700410799],
+    [0, -1754552775 / 470086768, 14199869525 / 1410260304,
+     -10690763975 / 1880347072],
+    [0, 127303824393 / 49829197408, -318862633887 / 49829197408,
+     701980252875 / 199316789632],
+    [0, -282668133 / 205662961, 2019193451 / 616988883,
+     -1453857185 / 822651844],
+    [0, 40617522 / 29380423, -110615467 / 29380423,
+     69997945 / 29380423]])
+_DENSE_ORDER = _P.shape[1]
+
+_SAFETY = 0.9
+_MIN_FACTOR = 0.2
+_MAX_FACTOR = 10
+_ERROR_EXPONENT = -1 / 5
+
+# Values of the status returned by _solve, same as solve_ivp.
+_FAILED = -1
+_FINISHED = 0
+_EVENT = 1
+
+
+class Solution:
+    """Dense output of solve_ivp, used like scipy's OdeSolution.
+
+    This stores a few coefficients per step for each element of the y-vector,
+    instead of a Python object per step like scipy does."""
+
+    def __init__(self, ts: np.ndarray, ys: np.ndarray, Qs: np.ndarray,
+                 params: dynamics.DeriveParams):
+        # ts and ys are the times and y-vectors at the end of each step, and
+        # Qs are the coefficients of the interpolating polynomial of each
+        # step, with len(ts) == len(ys) == len(Qs) + 1.
+        self.ts = ts
+        self.ys = ys
+        self.Qs = Qs
+        self.params = params
+        self.t_min = ts[0]
+        self.t_max = ts[-1]
+
+    def __call__(self, t: float) -> np.ndarray:
+        """Returns the y-vector at time t, which should be between t_min and
+        t_max."""
+        if len(self.Qs) == 0:
+            return self.ys[0].copy()
+        step = min(max(np.searchsorted(self.ts, t) - 1, 0), len(self.Qs) - 1)
+        y_1d = np.empty(self.ys.shape[1])
+        _interpolate(self.ts[step], self.ts[step + 1] - self.ts[step],
+                     self.ys[step], self.Qs[step], t, y_1d)
+        dynamics.place_landers(y_1d, self.params)
+        return y_1d
+
+
+def solve_ivp(params: dynamics.DeriveParams,
+              event_params: dynamics.EventParams, t_span, y0: np.ndarray,
+              max_step: float,
+              profile: tolerances.Profile = tolerances.PROFILES[
+                  tolerances.DEFAULT_PROFILE]) -> integrators.Result:
+    """Integrates y0 over t_span, with steps of at most max_step, to the
+    tolerances of profile. Like packed.solve_ivp(method='RK45'), with the
+    events in engine.py (in the same order), but compiled.
+
+    Stops at the first event, and reports it in t_events. If that's right
+    at the start, t and y only have the start in them, where scipy would
+    have the start twice."""
+    gravity, test_particle_gravity = dynamics.gravity_kernels(params)
+    rtol, atol = tolerances.arrays(profile, params)
+    # Passing the same types every time means numba only compiles once.
+    ts, ys, Qs, status, event, t_event, nfev = _solve(
+        float(t_span[0]), float(t_span[1]), y0.astype(np.float64),
+        float(max_step), rtol, atol, dynamics.continuous(params),
+        params, event_params, gravity, test_particle_gravity)
+
+    t_events = [np.array([]) for _ in range(dynamics.N_EVENTS)]
+    if status == _FAILED:
+        message = 'Required step size is less than spacing between numbers.'
+    elif status == _EVENT:
+        t_events[event] = np.array([t_event])
+        message = 'A termination event occurred.'
+    else:
+        message = integrators.Result._field_defaults['message']
+    return integrators.Result(
+        t=ts, y=ys.T, sol=Solution(ts, ys, Qs, params), t_events=t_events,
+        status=status, success=status >= 0, message=message, nfev=nfev)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _rms_norm(x, scale, integrated):
+    """The root mean square of x / scale, over the integrated elements."""
+    total = 0.0
+    for k in range(len(integrated)):
+        i = integrated[k]
+        total += (x[i] / scale[i]) ** 2
+    return math.sqrt(total / len(integrated))
+
+
+@numba.jit(nopython=True, nogil=True)
+def _interpolate(t_old, h, y_old, Q, t, out):
+    """Writes the dense output of a step of size h from (t_old, y_old) at t
+    into out."""
+    x = (t - t_old) / h
+    for i in range(len(out)):
+        # Horner's method for h * (Q[i, 0] x + Q[i, 1] x^2 + ...)
+        total = 0.0
+        for j in range(_DENSE_ORDER - 1, -1, -1):
+            total = (total + Q[i, j]) * x
+        out[i] = y_old[i] + h * total
+
+
+@numba.jit(nopython=True, nogil=True)
+def _initial_step(t0, y0, f0, t_bound, max_step, rtol, atol, integrated,
+                  params, gravity, test_particle_gravity):
+    """Same as scipy.integrate._ivp.common.select_initial_step, for RK45."""
+    interval_length = t_bound - t0
+    if interval_length == 0:
+        return 0.0
+    scale = atol + np.abs(y0) * rtol
+    d0 = _rms_norm(y0, scale, integrated)
+    d1 = _rms_norm(f0, scale, integrated)
+    if d0 < 1e-5 or d1 < 1e-5:
+        h0 = 1e-6
+    else:
+        h0 = 0.01 * d0 / d1
+    h0 = min(h0, interval_length)
+    y1 = y0 + h0 * f0
+    dynamics.place_landers(y1, params)
+    f1 = np.empty_like(y0)
+    dynamics.derive_into(y1, f1, params, gravity, test_particle_gravity)
+    d2 = _rms_norm(f1 - f0, scale, integrated) / h0
+    if d1 <= 1e-15 and d2 <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2)) ** (1 / 5)
+    return min(100 * h0, h1, interval_length, max_step)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _rk_step(y, h, K, y_new, y_stage, params, gravity, test_particle_gravity):
+    """Takes a step of size h from y, which has derivative K[0]. Writes the
+    new y-vector to y_new, its derivative to K[-1], and the other stages to
+    the rest of K."""
+    n = len(y)
+    for s in range(1, _N_STAGES):
+        for i in range(n):
+            dy = 0.0
+            for j in range(s):
+                dy += K[j, i] * _A[s, j]
+            y_stage[i] = y[i] + dy * h
+        dynamics.place_landers(y_stage, params)
+        dynamics.derive_into(y_stage, K[s], params, gravity,
+                             test_particle_gravity)
+    for i in range(n):
+        dy = 0.0
+        for j in range(_N_STAGES):
+            dy += K[j, i] * _B[j]
+        y_new[i] = y[i] + h * dy
+    dynamics.place_landers(y_new, params)
+    dynamics.derive_into(y_new, K[_N_STAGES], params, gravity,
+                         test_particle_gravity)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _event_root(event, t_old, h, y_old, Q, x_pre, x_cur, f_pre, f_cur,
+                params, event_params, gravity, test_particle_gravity):
+    """Finds where an event is zero between x_pre and x_cur, where it's
+    f_pre and f_cur. This is scipy.optimize.brentq, with the tolerances that
+    solve_ivp uses, and the event evaluated on the step's dense output."""
+    tol = 4 * np.finfo(np.float64).eps
+    y = np.empty_like(y_old)
+    dy = np.empty_like(y_old)
+    if f_pre == 0:
+        return x_pre
+    if f_cur == 0:
+        return x_cur
+    x_blk = f_blk = s_pre = s_cur = 0.0
+    for _ in range(100):
+        if f_pre != 0 and f_cur != 0 and (f_pre < 0) != (f_cur < 0):
+            x_blk = x_pre
+            f_blk = f_pre
+            s_pre = s_cur = x_cur - x_pre
+        if abs(f_blk) < abs(f_cur):
+            x_pre, x_cur, x_blk = x_cur, x_blk, x_cur
+            f_pre, f_cur, f_blk = f_cur, f_blk, f_cur
+
+        delta = (tol + tol * abs(x_cur)) / 2
+        s_bis = (x_blk - x_cur) / 2
+        if f_cur == 0 or abs(s_bis) < delta:
+            return x_cur
+
+        if abs(s_pre) > delta and abs(f_cur) < abs(f_pre):
+            if x_pre == x_blk:
+                # Interpolate
+                s_try = -f_cur * (x_cur - x_pre) / (f_cur - f_pre)
+            else:
+                # Extrapolate
+                d_pre = (f_pre - f_cur) / (x_pre - x_cur)
+                d_blk = (f_blk - f_cur) / (x_blk - x_cur)
+                s_try = -f_cur * (f_blk * d_blk - f_pre * d_pre) / (
+                    d_blk * d_pre * (f_blk - f_pre))
+            if 2 * abs(s_try) < min(abs(s_pre), 3 * abs(s_bis) - delta):
+                s_pre = s_cur
+                s_cur = s_try
+            else:
+                s_pre = s_cur = s_bis
+        else:
+            s_pre = s_cur = s_bis
+
+        x_pre = x_cur
+        f_pre = f_cur
+        if abs(s_cur) > delta:
+            x_cur += s_cur
+        else:
+            x_cur += delta if s_bis > 0 else -delta
+
+        _interpolate(t_old, h, y_old, Q, x_cur, y)
+        dynamics.place_landers(y, params)
+        if event == dynamics.HIGH_ACC_EVENT:
+            dynamics.derive_into(y, dy, params, gravity,
+                                 test_particle_gravity)
+        f_cur = dynamics.event_value(event, y, dy, params, event_params)
+    return x_cur
+
+
+@numba.jit(nopython=True, nogil=True)
+def _solve(t0, t_bound, y0, max_step, rtol, atol, integrated, params,
+           event_params, gravity, test_particle_gravity):
+    """The compiled part of solve_ivp. Returns the times and y-vectors at
+    the end of each step, dense output coefficients for each step, the
+    status, which event happened when (or -1 and NaN), and how many times
+    the derivative was evaluated. integrated has the indices of the elements
+    of the y-vector that count towards the error, see dynamics.continuous."""
+    n = len(y0)
+    capacity = 64
+    ts = np.empty(capacity)
+    ys = np.empty((capacity, n))
+    Qs = np.empty((capacity, n, _DENSE_ORDER))
+    y = y0.copy()
+    dynamics.place_landers(y, params)
+    ts[0] = t0
+    ys[0] = y
+    n_points = 1
+
+    K = np.empty((_N_STAGES + 1, n))
+    y_new = np.empty(n)
+    y_stage = np.empty(n)
+    err = np.empty(n)
+    scale = np.empty(n)
+    dynamics.derive_into(y, K[0], params, gravity, test_particle_gravity)
+    f = K[0].copy()
+    # One evaluation for f, one in _initial_step, and _N_STAGES per step.
+    nfev = 2
+
+    g = np.empty(dynamics.N_EVENTS)
+    g_new = np.empty(dynamics.N_EVENTS)
+    dynamics.event_values(y, f, params, event_params, g)
+
+    t = t0
+    h_abs = _initial_step(t0, y, f, t_bound, max_step, rtol, atol,
+                          integrated, params, gravity, test_particle_gravity)
+    status = _FINISHED
+    first_event = -1
+    t_first_event = np.nan
+    while t < t_bound:
+        min_step = 10 * abs(np.nextafter(t, np.inf) - t)
+        if h_abs > max_step:
+            h_abs = max_step
+        elif h_abs < min_step:
+            h_abs = min_step
+
+        step_accepted = False
+        step_rejected = False
+        while not step_accepted:
+            if h_abs < min_step:
+                status = _FAILED
+                break
+            t_new = min(t + h_abs, t_bound)
+            h = t_new - t
+            h_abs = h
+
+            K[0] = f
+            _rk_step(y, h, K, y_new, y_stage, params, gravity,
+                     test_particle_gravity)
+            nfev += _N_STAGES
+            for i in range(n):
+                scale[i] = atol[i] + max(abs(y[i]), abs(y_new[i])) * rtol[i]
+                err[i] = 0.0
+                for j in range(_N_STAGES + 1):
+                    err[i] += K[j, i] * _E[j]
+                err[i] *= h
+            error_norm = _rms_norm(err, scale, integrated)
+
+            if error_norm < 1:
+                if error_norm == 0:
+                    factor = float(_MAX_FACTOR)
+                else:
+                    factor = min(_MAX_FACTOR,
+                                 _SAFETY * error_norm ** _ERROR_EXPONENT)
+                if step_rejected:
+                    factor = min(1.0, factor)
+                h_abs *= factor
+                step_accepted = True
+            else:
+                h_abs *= max(_MIN_FACTOR,
+                             _SAFETY * error_norm ** _ERROR_EXPONENT)
+                step_rejected = True
+        if status == _FAILED:
+            break
+
+        if n_points == capacity:
+            capacity *= 2
+            ts = _grow(ts, capacity)
+            ys = _grow(ys, capacity)
+            Qs = _grow(Qs, capacity)
+        Q = Qs[n_points - 1]
+        for i in range(n):
+            for j in range(_DENSE_ORDER):
+                total = 0.0
+                for k in range(_N_STAGES + 1):
+                    total += K[k, i] * _P[k, j]
+                Q[i, j] = total
+
+        # Like solve_ivp, an event happens if it's gone from >= 0 to <= 0.
+        # If more than one happens in this step, only the first one counts.
+        dynamics.event_values(y_new, K[_N_STAGES], params, event_params,
+                              g_new)
+        for event in range(dynamics.N_EVENTS):
+            if g[event] >= 0 and g_new[event] <= 0:
+                root = _event_root(
+                    event, t, h, y, Q, t, t_new, g[event], g_new[event],
+                    params, event_params, gravity, test_particle_gravity)
+                if first_event == -1 or root < t_first_event:
+                    first_event = event
+                    t_first_event = root
+        if first_event != -1:
+            status = _EVENT
+            if t_first_event != t:
+                ts[n_points] = t_first_event
+                _interpolate(t, h, y, Q, t_first_event, ys[n_points])
+                dynamics.place_landers(ys[n_points], params)
+                n_points += 1
+                # Solution assumes each step ends at the next point, so
+                # rescale the polynomial of this step to end at the event.
+                ratio = (t_first_event - t) / h
+                for j in range(_DENSE_ORDER):
+                    Q[:, j] *= ratio ** j
+            break
+
+        ts[n_points] = t_new
+        ys[n_points] = y_new
+        n_points += 1
+        t = t_new
+        y[:] = y_new
+        f[:] = K[_N_STAGES]
+        g[:] = g_new
+
+    return (ts[:n_points], ys[:n_points], Qs[:n_points - 1], status,
+            first_event, t_first_event, nfev)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _grow(array, capacity):
+    """Returns a copy of array with room for capacity rows."""
+    grown = np.empty((capacity,) + array.shape[1:])
+    grown[:len(array)] = array
+    return grown
@@ -0,0 +1,463 @@
+"""A symplectic integrator for when nothing but gravity is acting.
+
+Most of the time, everything in OrbitX is coasting: planets orbit the Sun,
+moons orbit planets, and the craft orbits whatever it's near. Almost all of
+that motion is two-body motion, which kepler.drift can do exactly. This is the
+idea behind the Wisdom-Holman integrator: only the small remainder (the Sun
+tugging on the Moon, the Moon tugging on a craft in orbit around the Earth)
+has to be integrated numerically, so it can take huge steps without losing
+accuracy. Since it's a symmetric, kick-drift-kick leapfrog, it also doesn't
+drift in energy over long runs the way RK45 does.
+
+Unlike textbook Wisdom-Holman, which has every body orbit the Sun, each entity
+here orbits its primary: the smallest body whose sphere of influence it's in.
+The Moon orbits the Earth, and the Earth orbits the Sun. Each step:
+
+1. Kicks every velocity by half a step of the remainder, i.e. the real
+   acceleration minus the acceleration that the drift will already account for.
+2. Drifts every entity for a whole step along its orbit around its primary,
+   while its primary is drifting along its own orbit.
+3. Kicks velocities by another half step of the remainder.
+
+This can't model thrust, SRBs, or drag, so the engine only uses it while
+coasting() is True, and uses a solve_ivp method otherwise. It also can't find
+exactly when an event happens, so solve_ivp stops just before any event, and
+the engine lets solve_ivp find it.
+
+Most moons and planets are hardly perturbed at all, so put_on_rails can skip
+the kicks for them, and they just follow their orbits around their primaries.
+Only the spacecraft and the entities that are perturbed more than a threshold
+then need their accelerations calculated. If nothing else is left (e.g. the
+craft is landed), there's nothing to integrate numerically, and solve_ivp
+can take steps as long as it likes."""
+
+import math
+from typing import List, NamedTuple
+
+import numba
+import numpy as np
+
+from orbitx import common
+from orbitx.physics import calc, dynamics, integrators, kepler
+from orbitx.data_structures import PhysicsState
+
+_NO_INDEX = PhysicsState.NO_INDEX
+_X = dynamics._X
+_Y = dynamics._Y
+_VX = dynamics._VX
+_VY = dynamics._VY
+_HEADING = dynamics._HEADING
+_SPIN = dynamics._SPIN
+_MANUAL = dynamics._MANUAL
+
+# dynamics.drag ignores atmospheres that are more than this many scale heights
+# (which are in kilometres) away from the craft.
+_ATMOSPHERE_SCALE_HEIGHTS = 20
+
+
+class Hierarchy(NamedTuple):
+    """Which entity orbits which. Build one of these with hierarchy."""
+    # The index of the entity each entity orbits, or NO_INDEX. Only the most
+    # massive entity doesn't orbit anything, and landed entities aren't
+    # considered to be orbiting what they're landed on.
+    primary: np.ndarray
+    # Every entity that isn't landed, such that primaries come before the
+    # entities orbiting them.
+    order: np.ndarray
+    # True for entities that only ever move along their orbit around their
+    # primary, see put_on_rails.
+    on_rails: np.ndarray
+
+
+def hierarchy(state: PhysicsState,
+              params: dynamics.DeriveParams) -> Hierarchy:
+    """Works out which entity each entity orbits."""
+    landed = np.zeros(len(state), dtype=np.bool_)
+    landed[params.landers] = True
+    can_be_primary = ~landed & ~state.TestParticles & (params.GM > 0)
+    primary, order = _hierarchy(state.X, state.Y, params.GM, landed,
+                                can_be_primary)
+    return Hierarchy(primary=primary, order=order,
+                     on_rails=np.zeros(len(state), dtype=np.bool_))
+
+
+def put_on_rails(state: PhysicsState, params: dynamics.DeriveParams,
+                 orbits: Hierarchy, threshold: float) -> Hierarchy:
+    """Returns orbits, but with every entity that's barely perturbed on
+    rails. Spacecraft are never on rails.
+
+    An entity is barely perturbed if everything but its primary pulls on it
+    (relative to its primary) with less than threshold times the pull of its
+    primary. The entity at the top of the hierarchy is compared with the
+    pull it has on the closest entity orbiting it instead."""
+    n = len(state)
+    dy = dynamics.derive(0, state.y0(), params)
+    perturbation = _perturbations(
+        state.X, state.Y, dy[_VX * n:(_VX + 1) * n],
+        dy[_VY * n:(_VY + 1) * n], params.GM, orbits.primary, orbits.order)
+    on_rails = perturbation < threshold
+    on_rails[params.artificials] = False
+    return orbits._replace(on_rails=on_rails)
+
+
+def step_limit(orbits: Hierarchy, max_step: float) -> float:
+    """Returns the longest step solve_ivp should take. That's max_step,
+    unless everything that moves is on rails."""
+    if orbits.on_rails[orbits.order].all():
+        return np.inf
+    return max_step
+
+
+def thrusting(state: PhysicsState, params: dynamics.DeriveParams) -> bool:
+    """Returns True if any engines or SRBs are firing."""
+    return bool(params.regime & dynamics.POWERED)
+
+
+def coasting(state: PhysicsState, params: dynamics.DeriveParams,
+             orbits: Hierarchy) -> bool:
+    """Returns True if only gravity will act on anything for a while, so that
+    the solve_ivp in this module can be used.
+
+    This is False if any engines or SRBs are firing, if the craft is feeling
+    any drag, or if any spacecraft is on an orbit that would take it into an
+    atmosphere or the ground."""
+    if thrusting(state, params):
+        return False
+    if params.craft != _NO_INDEX and dynamics.drag(
+            state.X, state.Y, state.VX, state.VY, state.Spin, params) != \
+            (0.0, 0.0):
+        return False
+
+    atmospheres = dict(zip(params.atmospheres, params.atmosphere_scaling))
+    for index in params.artificials:
+        primary = orbits.primary[index]
+        if primary == _NO_INDEX:
+            # Either landed, or there's nothing to crash into.
+            continue
+        x = state.X[index] - state.X[primary]
+        y = state.Y[index] - state.Y[primary]
+        vx = state.VX[index] - state.VX[primary]
+        vy = state.VY[index] - state.VY[primary]
+        mu = params.GM[index] + params.GM[primary]
+        closest_safe_distance = params.R[index] + params.R[primary] + \
+            1000 * _ATMOSPHERE_SCALE_HEIGHTS * atmospheres.get(primary, 0)
+        if kepler.periapsis(x, y, vx, vy, mu) >= closest_safe_distance:
+            continue
+        escaping = (x * vx + y * vy > 0 and
+                    (vx * vx + vy * vy) / 2 >= mu / math.hypot(x, y))
+        if not escaping:
+            return False
+    return True
+
+
+class Solution:
+    """Dense output of solve_ivp, used like scipy's OdeSolution."""
+
+    def __init__(self, ts: np.ndarray, ys: np.ndarray,
+                 params: dynamics.DeriveParams, orbits: Hierarchy):
+        self.ts = ts
+        self.ys = ys
+        self.params = params
+        self.orbits = orbits
+        self.t_min = ts[0]
+        self.t_max = ts[-1]
+
+    def __call__(self, t: float) -> np.ndarray:
+        """Returns the y-vector at time t, which should be between t_min and
+        t_max. This drifts the y-vector at the closest step to t, which is
+        as accurate as the steps themselves."""
+        step = np.searchsorted(self.ts, t)
+        if step == len(self.ts) or (
+                step > 0 and t - self.ts[step - 1] < self.ts[step] - t):
+            step -= 1
+        y_1d = self.ys[:, step].copy()
+        _drift(y_1d, self.params, self.orbits.primary, self.orbits.order,
+               t - self.ts[step])
+        return y_1d
+
+
+def solve_ivp(params: dynamics.DeriveParams, orbits: Hierarchy,
+              t_span: List[float], y0: np.ndarray, events: list,
+              max_step: float) -> integrators.Result:
+    """Integrates y0 over t_span, like scipy.integrate.solve_ivp, in steps
+    of at most max_step.
+
+    Only call this if coasting() is True. If any of the events are about to
+    happen, this returns early with the last step before they happen. None
+    of the events are ever reported in t_events, and there might only be one
+    step in the returned Result if an event is imminent."""
+    t0, t_end = t_span
+    n_steps = max(1, math.ceil((t_end - t0) / max_step))
+    step_size = (t_end - t0) / n_steps
+    ts = [t0]
+    ys = [y0.copy()]
+    gravity, test_particle_gravity = dynamics.gravity_kernels(params)
+    numeric = orbits.order[~orbits.on_rails[orbits.order]]
+
+    y_1d = y0.copy()
+    dy = np.empty_like(y_1d)
+    dynamics.derive_into(y_1d, dy, params, gravity, test_particle_gravity)
+    last_values = [event(t0, y_1d) for event in events]
+    for step in range(1, n_steps + 1):
+        _step(y_1d, dy, params, gravity, test_particle_gravity,
+              orbits.primary, orbits.order, orbits.on_rails, numeric,
+              step_size)
+        t = t0 + step * step_size if step < n_steps else t_end
+
+        # All of our events are terminal and only trigger when they
+        # decrease through zero, see engine.Event.
+        values = [event(t, y_1d) for event in events]
+        if any(last > 0 >= value
+               for last, value in zip(last_values, values)):
+            break
+        last_values = values
+        ts.append(t)
+        ys.append(y_1d.copy())
+
+    ts = np.array(ts)
+    ys = np.array(ys).T
+    return integrators.Result(
+        t=ts, y=ys, sol=Solution(ts, ys, params, orbits),
+        t_events=[np.array([]) for _ in events])
+
+
+@numba.jit(nopython=True, nogil=True)
+def _hierarchy(X, Y, GM, landed, can_be_primary):
+    """Returns the primary of each entity, and an order to process them in
+    such that primaries come first. See Hierarchy.
+
+    An entity's primary is the smallest entity whose sphere of influence it's
+    inside. Spheres of influence are calculated with the Laplace formula,
+    from the entity's distance to its own primary."""
+    n = len(X)
+    by_mass = np.argsort(-GM, kind='mergesort')
+    primary = np.full(n, _NO_INDEX, dtype=np.int64)
+    soi = np.zeros(n)
+    order = np.empty(n, dtype=np.int64)
+    candidates = np.empty(n, dtype=np.int64)
+    n_candidates = 0
+    n_ordered = 0
+    for i in by_mass:
+        if landed[i]:
+            continue
+        best = _NO_INDEX
+        best_soi = np.inf
+        best_distance = 0.0
+        for k in range(n_candidates):
+            j = candidates[k]
+            distance = math.sqrt((X[i] - X[j]) ** 2 + (Y[i] - Y[j]) ** 2)
+            # The first candidate has an infinite sphere of influence, so
+            # every entity but the first one has a primary.
+            if distance < soi[j] and (best == _NO_INDEX or soi[j] < best_soi):
+                best = j
+                best_soi = soi[j]
+                best_distance = distance
+        primary[i] = best
+        order[n_ordered] = i
+        n_ordered += 1
+
+        if can_be_primary[i]:
+            if best == _NO_INDEX:
+                soi[i] = np.inf
+            else:
+                soi[i] = best_distance * (GM[i] / GM[best]) ** 0.4
+            candidates[n_candidates] = i
+            n_candidates += 1
+    return primary, order[:n_ordered]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _perturbations(X, Y, AX, AY, GM, primary, order):
+    """Returns how perturbed each entity is, see put_on_rails. AX and AY
+    are the accelerations of each entity. Landed entities, and an entity at
+    the top of the hierarchy with nothing orbiting it, are infinitely
+    perturbed."""
+    n = len(X)
+    perturbation = np.full(n, np.inf)
+    for i in order:
+        p = primary[i]
+        if p == _NO_INDEX:
+            closest_squared = np.inf
+            for j in order:
+                if primary[j] == i:
+                    closest_squared = min(closest_squared,
+                                          (X[j] - X[i]) ** 2 +
+                                          (Y[j] - Y[i]) ** 2)
+            if closest_squared < np.inf:
+                perturbation[i] = math.sqrt(AX[i] ** 2 + AY[i] ** 2) / (
+                    GM[i] / closest_squared)
+            continue
+        x = X[i] - X[p]
+        y = Y[i] - Y[p]
+        r = math.sqrt(x * x + y * y)
+        mu_over_r_cubed = (GM[i] + GM[p]) / (r * r * r)
+        # What's left of the acceleration relative to the primary, after
+        # taking away the two-body acceleration towards it.
+        rest_x = AX[i] - AX[p] + mu_over_r_cubed * x
+        rest_y = AY[i] - AY[p] + mu_over_r_cubed * y
+        perturbation[i] = math.sqrt(rest_x ** 2 + rest_y ** 2) / (
+            mu_over_r_cubed * r)
+    return perturbation
+
+
+@numba.jit(nopython=True, nogil=True)
+def _numeric_gravity(y_1d, dy, params, numeric):
+    """Writes the gravitational acceleration of only the numeric entities
+    into dy, the derivative of y_1d. This is all that _kick needs when
+    everything else is on rails."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    AX = dy[_VX * n:(_VX + 1) * n]
+    AY = dy[_VY * n:(_VY + 1) * n]
+    calc.grav_acc_on_into(X, Y, params.GM, params.sources, numeric, AX, AY)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _kick(y_1d, dy, params, primary, order, on_rails, dt):
+    """Changes the velocity of every entity by dt times the acceleration that
+    _drift doesn't account for. dy is the derivative of y_1d, and only has to
+    be right for entities that aren't on rails.
+
+    An entity on rails gets the same kick as its primary, so that it keeps
+    following its orbit around it."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    VX = y_1d[_VX * n:(_VX + 1) * n]
+    VY = y_1d[_VY * n:(_VY + 1) * n]
+    AX = dy[_VX * n:(_VX + 1) * n]
+    AY = dy[_VY * n:(_VY + 1) * n]
+
+    # The acceleration of each entity during a drift is the acceleration of
+    # its primary, plus the two-body acceleration towards its primary.
+    drift_ax = np.zeros(n)
+    drift_ay = np.zeros(n)
+    kick_x = np.zeros(n)
+    kick_y = np.zeros(n)
+    for i in order:
+        p = primary[i]
+        if p != _NO_INDEX:
+            x = X[i] - X[p]
+            y = Y[i] - Y[p]
+            r = math.sqrt(x * x + y * y)
+            mu_over_r_cubed = (params.GM[i] + params.GM[p]) / (r * r * r)
+            drift_ax[i] = drift_ax[p] - mu_over_r_cubed * x
+            drift_ay[i] = drift_ay[p] - mu_over_r_cubed * y
+        if not on_rails[i]:
+            kick_x[i] = AX[i] - drift_ax[i]
+            kick_y[i] = AY[i] - drift_ay[i]
+        elif p != _NO_INDEX:
+            kick_x[i] = kick_x[p]
+            kick_y[i] = kick_y[p]
+        VX[i] += kick_x[i] * dt
+        VY[i] += kick_y[i] * dt
+
+
+@numba.jit(nopython=True, nogil=True)
+def _drift(y_1d, params, primary, order, dt):
+    """Moves every entity along its orbit around its primary for dt seconds,
+    and turns everything by its spin."""
+    n = len(params.M)
+    X = y_1d[_X * n:(_X + 1) * n]
+    Y = y_1d[_Y * n:(_Y + 1) * n]
+    VX = y_1d[_VX * n:(_VX + 1) * n]
+    VY = y_1d[_VY * n:(_VY + 1) * n]
+    Heading = y_1d[_HEADING * n:(_HEADING + 1) * n]
+    Spin = y_1d[_SPIN * n:(_SPIN + 1) * n]
+    landed_x, landed_y = _landed_offsets(X, Y, params)
+
+    # Going backwards through the order, every entity is drifted before its
+    # primary is, so we can replace each entity's position and velocity with
+    # its new position and velocity relative to its primary.
+    for k in range(len(order) - 1, -1, -1):
+        i = order[k]
+        p = primary[i]
+        if p == _NO_INDEX:
+            X[i] += VX[i] * dt
+            Y[i] += VY[i] * dt
+        else:
+            X[i], Y[i], VX[i], VY[i] = kepler.drift(
+                X[i] - X[p], Y[i] - Y[p], VX[i] - VX[p], VY[i] - VY[p],
+                params.GM[i] + params.GM[p], dt)
+    # Then going forwards, every primary already has its new position and
+    # velocity when we make the positions of its orbiters absolute again.
+    for i in order:
+        p = primary[i]
+        if p != _NO_INDEX:
+            X[i] += X[p]
+            Y[i] += Y[p]
+            VX[i] += VX[p]
+            VY[i] += VY[p]
+    _turn(X, Y, VX, VY, Heading, Spin, params, landed_x, landed_y, dt)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _landed_offsets(X, Y, params):
+    """Returns where each landed entity is relative to what it's landed on.
+    Landed entities turn with whatever they're landed on, so a drift has to
+    work this out before anything moves."""
+    landed_x = np.empty(len(params.landers))
+    landed_y = np.empty(len(params.landers))
+    for k in range(len(params.landers)):
+        landed_x[k] = X[params.landers[k]] - X[params.grounds[k]]
+        landed_y[k] = Y[params.landers[k]] - Y[params.grounds[k]]
+    return landed_x, landed_y
+
+
+@numba.jit(nopython=True, nogil=True)
+def _turn(X, Y, VX, VY, Heading, Spin, params, landed_x, landed_y, dt):
+    """The rest of a drift of dt seconds, after everything that isn't landed
+    has moved: puts landed entities back where they were on what they're
+    landed on, and turns everything by its spin."""
+    n = len(params.M)
+    for k in range(len(params.landers)):
+        lander = params.landers[k]
+        ground = params.grounds[k]
+        turn = Spin[ground] * dt
+        X[lander] = X[ground] + (landed_x[k] * math.cos(turn) -
+                                 landed_y[k] * math.sin(turn))
+        Y[lander] = Y[ground] + (landed_x[k] * math.sin(turn) +
+                                 landed_y[k] * math.cos(turn))
+
+    craft = params.craft
+    for i in range(n):
+        if i != craft or params.navmode == _MANUAL:
+            Heading[i] += Spin[i] * dt
+    if craft != _NO_INDEX and params.navmode != _MANUAL:
+        # The autopilot turns the craft towards where it should be pointing
+        # within a few seconds, so steps much longer than that would
+        # overshoot if they used the craft's spin. Turn it directly instead.
+        requested = dynamics._navmode_heading(X, Y, VX, VY, Heading, params)
+        difference = (requested - Heading[craft] + np.pi) % (2 * np.pi) - \
+            np.pi
+        max_turn = common.AUTOPILOT_SPEED * abs(dt)
+        if abs(difference) <= max_turn:
+            Heading[craft] = requested
+        else:
+            Heading[craft] += math.copysign(max_turn, difference)
+
+    dynamics._reconcile(X, Y, VX, VY, Heading, Spin, params)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _step(y_1d, dy, params, gravity, test_particle_gravity, primary, order,
+          on_rails, numeric, dt):
+    """Advances y_1d by one kick-drift-kick step of dt seconds, in place.
+    dy has to be the derivative of y_1d, and is updated to match it, except
+    for entities on rails. numeric is every entity in order that isn't on
+    rails."""
+    _kick(y_1d, dy, params, primary, order, on_rails, dt / 2)
+    _drift(y_1d, params, primary, order, dt)
+    if len(numeric) == len(order):
+        dynamics.derive_into(y_1d, dy, params, gravity,
+                             test_particle_gravity)
+    else:
+        _numeric_gravity(y_1d, dy, params, numeric)
+    _kick(y_1d, dy, params, primary, order, on_rails, dt / 2)
+    n = len(params.M)
+    dynamics._reconcile(
+        y_1d[_X * n:(_X + 1) * n], y_1d[_Y * n:(_Y + 1) * n],
+        y_1d[_VX * n:(_VX + 1) * n], y_1d[_VY * n:(_VY + 1) * n],
+        y_1d[_HEADING * n:(_HEADING + 1) * n],
+        y_1d[_SPIN * n:(_SPIN + 1) * n], params)
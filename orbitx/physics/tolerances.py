@@ -0,0 +1,148 @@
+"""Error tolerances for the physics engine's adaptive integrators.
+
+scipy's default tolerances, rtol=1e-3 and atol=1e-6 for every element of the
+y-vector, don't mean much for us. Positions are around 1e11 m, so a relative
+tolerance of 1e-3 lets planets be off by a hundred thousand kilometres per
+step, while an absolute tolerance of a micrometre is far stricter than
+anything needs to be near the origin. Here, each field of the y-vector gets
+tolerances in its own units, and artificial entities get tighter absolute
+tolerances than natural bodies, since a craft being off by a kilometre
+matters a lot more than a planet being off by a kilometre.
+
+Tolerances come in named profiles. Savefiles pick one with the tolerances
+field of their engine settings, e.g. "engineSettings": {"tolerances":
+"precise"}, physicsserver and flighttraining can override that with
+--tolerances, and a TOLERANCES_SET command changes it at runtime.
+
+Run `python benchmark.py tolerances` to see how many steps each profile
+takes, and how accurate it is, on the standard savefiles."""
+
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+import numpy as np
+
+from orbitx.physics import dynamics
+from orbitx.data_structures import PhysicsState, _FIELD_ORDERING
+
+
+class Profile(NamedTuple):
+    """Tolerances for each field that the integrators integrate, see
+    dynamics.continuous. Make the dictionaries with fields()."""
+    name: str
+    # Shown in --help.
+    description: str
+    rtol: Dict[str, float]
+    # Absolute tolerances for natural bodies, and for artificial entities.
+    atol: Dict[str, float]
+    craft_atol: Dict[str, float]
+
+
+def fields(position: float, velocity: float, heading: float, fuel: float,
+           srb_time: float) -> Dict[str, float]:
+    """Returns a tolerance for each field of the y-vector that can change,
+    in metres, metres per second, radians, kilograms, and seconds."""
+    return {'x': position, 'y': position, 'vx': velocity, 'vy': velocity,
+            'heading': heading, 'fuel': fuel, 'srb_time': srb_time}
+
+
+DEFAULT_PROFILE = 'training'
+
+_PROFILE_LIST = [
+    Profile(
+        name='training', description="The default. Tighter than scipy's "
+        "defaults where it matters, and looser where it doesn't, so it is "
+        'at least as accurate for about the same number of steps.',
+        rtol=fields(1e-6, 1e-6, 1e-3, 1e-3, 1e-3),
+        atol=fields(100, 1e-3, 1e-3, 1, 1e-2),
+        craft_atol=fields(1e-1, 1e-4, 1e-4, 1e-2, 1e-2)),
+    Profile(
+        name='precise', description='Thousands of times more accurate than '
+        'training when tolerances are what limits steps, for about twice as '
+        'many steps. Otherwise, only a little more accurate.',
+        rtol=fields(1e-10, 1e-10, 1e-6, 1e-6, 1e-6),
+        atol=fields(1, 1e-5, 1e-6, 1e-3, 1e-4),
+        craft_atol=fields(1e-3, 1e-6, 1e-6, 1e-4, 1e-4)),
+    Profile(
+        name='fast', description='A few percent fewer steps than training, '
+        'when max step sizes are what limits steps anyway. Can be hundreds '
+        'of kilometres off when they are not.',
+        rtol=fields(1e-3, 1e-3, 1e-2, 1e-2, 1e-2),
+        atol=fields(1e4, 1, 1e-1, 100, 1),
+        craft_atol=fields(10, 1e-2, 1e-2, 1, 1)),
+    Profile(
+        name='scipy', description="scipy's default tolerances, which the "
+        'engine used before there were profiles. Mostly useful for '
+        'comparison.',
+        rtol=fields(1e-3, 1e-3, 1e-3, 1e-3, 1e-3),
+        atol=fields(1e-6, 1e-6, 1e-6, 1e-6, 1e-6),
+        craft_atol=fields(1e-6, 1e-6, 1e-6, 1e-6, 1e-6)),
+]
+
+PROFILES: Dict[str, Profile] = {
+    profile.name: profile for profile in _PROFILE_LIST}
+
+# Much tighter than any of the PROFILES, for the reference integrations that
+# benchmark.py and tune.py compare everything else to.
+REFERENCE = Profile(
+    name='reference', description='',
+    rtol=fields(1e-12, 1e-12, 1e-9, 1e-9, 1e-9),
+    atol=fields(1e-3, 1e-8, 1e-8, 1e-6, 1e-6),
+    craft_atol=fields(1e-3, 1e-8, 1e-8, 1e-6, 1e-6))
+
+# These solve_ivp methods only accept a single rtol for the whole y-vector.
+_SCALAR_RTOL_METHODS: List[str] = ['Radau', 'BDF']
+
+
+def profile(state: PhysicsState) -> Profile:
+    """Returns the tolerance profile that the state's engine settings ask
+    for. Raises a ValueError if there's no such profile."""
+    return by_name(state.engine_settings.tolerances or DEFAULT_PROFILE)
+
+
+def by_name(name: str) -> Profile:
+    """Returns the named tolerance profile, or raises a ValueError."""
+    if name not in PROFILES:
+        raise ValueError(
+            f'Unknown tolerance profile "{name}", expected one of '
+            f'{", ".join(PROFILES)}.')
+    return PROFILES[name]
+
+
+def arrays(profile: Profile, params: dynamics.DeriveParams) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """Returns rtol and atol for every element of the y-vector.
+
+    Elements that aren't in dynamics.continuous(params) get an rtol of 1
+    and an infinite atol, so they'd never count towards the error even if
+    they were integrated."""
+    n = len(params.M)
+    size = len(_FIELD_ORDERING) * n + PhysicsState.N_SINGULAR_ELEMENTS
+    rtol = np.ones(size)
+    atol = np.full(size, np.inf)
+    artificial = np.zeros(n, dtype=np.bool_)
+    artificial[params.artificials] = True
+    for field in ['x', 'y', 'vx', 'vy', 'heading']:
+        offset = _FIELD_ORDERING[field] * n
+        rtol[offset:offset + n] = profile.rtol[field]
+        atol[offset:offset + n] = np.where(
+            artificial, profile.craft_atol[field], profile.atol[field])
+        # Landed entities aren't integrated, see dynamics.place_landers.
+        rtol[offset + params.landers] = 1
+        atol[offset + params.landers] = np.inf
+    fuel = _FIELD_ORDERING['fuel'] * n + params.artificials
+    rtol[fuel] = profile.rtol['fuel']
+    atol[fuel] = profile.craft_atol['fuel']
+    rtol[PhysicsState.SRB_TIME_INDEX] = profile.rtol['srb_time']
+    atol[PhysicsState.SRB_TIME_INDEX] = profile.craft_atol['srb_time']
+    return rtol, atol
+
+
+def packed(profile: Profile, params: dynamics.DeriveParams,
+           integrated: np.ndarray, method: str) \
+        -> Tuple[Union[float, np.ndarray], np.ndarray]:
+    """Returns rtol and atol for the elements of the y-vector in integrated,
+    as the solve_ivp method wants them."""
+    rtol, atol = arrays(profile, params)
+    if method in _SCALAR_RTOL_METHODS:
+        return rtol[integrated].min(), atol[integrated]
+    return rtol[integrated], atol[integrated]
@@ -0,0 +1,110 @@
+"""Max step sizes, tolerances, and chunk lengths tuned for each time acc.
+
+Out of the box, the engine uses the same max step (see integrators.max_step)
+and tolerance profile at every time acc, and picks chunk lengths as it goes
+(see pacing.py). The max step and tolerances are hand-picked to be accurate
+enough for the standard savefiles on any machine, so on most savefiles and
+machines, they're more careful than they need to be at some time accs, and
+not careful enough at others.
+
+tune.py measures, for each time acc, how far entities end up from a very
+accurate reference integration of a savefile, and how far the total energy
+drifts, with a range of max steps and tolerance profiles. It picks the fastest
+settings that stay within an accuracy budget, then the fastest chunk length
+for them, which the engine won't go over, and writes them all to a tuning
+table in data/tuning/. Savefiles use a tuning table by naming it in
+engineSettings.tuning, and the engine looks up the settings for the current
+time acc in it for every chunk of simulation.
+
+Tuning tables are only for integrators with the SCIPY and COMPILED backends,
+since the others don't have tolerances."""
+
+import functools
+import json
+import math
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from orbitx import common
+from orbitx.physics import integrators, tolerances
+from orbitx.data_structures import PhysicsState
+
+# How many max steps long each chunk of simulation is, until the engine has
+# measured enough to pick chunk lengths itself.
+CHUNK_STEPS = 10
+
+
+class Setting(NamedTuple):
+    """How the engine simulates each chunk at one time acc."""
+    max_step: float
+    # The name of a tolerance profile.
+    tolerances: str
+    # The longest a chunk of simulation can be, in simulated seconds. The
+    # engine picks shorter chunks when it needs to, see pacing.py.
+    chunk: float
+
+
+class Table(NamedTuple):
+    """Settings tuned for each time acc. Make one with tune.py."""
+    # The method of the integrator that these settings are for.
+    integrator: str
+    # The savefile and accuracy budget they were tuned with. Position error
+    # is in metres and energy error is relative, both after duration
+    # simulated seconds.
+    savefile: str
+    duration: float
+    position_budget: float
+    energy_budget: float
+    settings: Dict[int, Setting]
+
+
+def path(name: str) -> Path:
+    """Where a tuning table named in engineSettings.tuning is stored."""
+    return common.PROGRAM_PATH / 'data' / 'tuning' / name
+
+
+def save(table: Table, file: Path):
+    data = table._asdict()
+    data['settings'] = {str(time_acc): setting._asdict()
+                        for time_acc, setting in table.settings.items()}
+    file.write_text(json.dumps(data, indent=2))
+
+
+def load(file: Path) -> Table:
+    data = json.loads(file.read_text())
+    data['settings'] = {int(time_acc): Setting(**setting)
+                        for time_acc, setting in data['settings'].items()}
+    return Table(**data)
+
+
+def load_named(name: str) -> Table:
+    """Loads the tuning table that engineSettings.tuning names. The engine
+    does this whenever its state changes, so this remembers the last few,
+    until tune.py rewrites them."""
+    file = path(name)
+    return _load_cached(file, file.stat().st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_cached(file: Path, mtime_ns: int) -> Table:
+    return load(file)
+
+
+def setting(table: Optional[Table], integrator: integrators.Integrator,
+            state: PhysicsState) -> Setting:
+    """Returns how to simulate the next chunk of state with integrator.
+
+    This comes from the table, if it has a setting for the integrator at the
+    state's time acc, and from the integrator's own max step and the default
+    tolerance profile, with no limit on chunk length, otherwise. Tolerances
+    that the state's engine settings ask for are used either way."""
+    time_acc = round(state.time_acc)
+    profile = state.engine_settings.tolerances
+    if table is not None and table.integrator == integrator.method and \
+            time_acc in table.settings:
+        tuned = table.settings[time_acc]
+        return tuned._replace(tolerances=profile or tuned.tolerances)
+    max_step = integrators.max_step(integrator, time_acc)
+    return Setting(max_step=max_step,
+                   tolerances=profile or tolerances.DEFAULT_PROFILE,
+                   chunk=math.inf)
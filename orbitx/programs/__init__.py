@@ -3,7 +3,9 @@ This modules in this subpackage implement the different OrbitX programs.
 Each submodule implements a programs.Program.
 """
 import argparse
-from typing import Callable, List, NamedTuple
+from typing import Callable, Dict, List, NamedTuple
+
+from orbitx.physics import integrators, tolerances
 
 
 class Program(NamedTuple):
@@ -13,6 +15,59 @@ class Program(NamedTuple):
     argparser: argparse.ArgumentParser
 
 
+# The arguments that add_engine_arguments adds that override the savefile's
+# EngineSettings, which have the same names.
+_ENGINE_SETTINGS = ['integrator', 'tolerances', 'tuning', 'ephemeris']
+
+
+def add_engine_arguments(argument_parser: argparse.ArgumentParser):
+    """Adds the arguments of programs that run a PhysicsEngine."""
+    argument_parser.add_argument(
+        '--threads', type=int, default=1,
+        help=(
+            'Number of threads the physics engine can use. This only speeds '
+            'up savefiles with hundreds of entities or more.')
+    )
+    argument_parser.add_argument(
+        '--integrator', choices=integrators.INTEGRATORS,
+        help=(
+            'Numerical integrator to use, instead of the one the savefile '
+            'asks for. ' + ' '.join(
+                f'{integrator.method}: {integrator.description}'
+                for integrator in integrators.INTEGRATORS.values()))
+    )
+    argument_parser.add_argument(
+        '--tolerances', choices=tolerances.PROFILES,
+        help=(
+            'Tolerance profile of the integrator, instead of the one the '
+            'savefile asks for. ' + ' '.join(
+                f'{profile.name}: {profile.description}'
+                for profile in tolerances.PROFILES.values()))
+    )
+    argument_parser.add_argument(
+        '--tuning',
+        help=(
+            'Tuning table in data/tuning/ to look up max step sizes, '
+            'tolerances and chunk lengths for each time acc in, made by '
+            'tune.py. Use an empty string to use the defaults, even if the '
+            'savefile asks for a tuning table.')
+    )
+    argument_parser.add_argument(
+        '--ephemeris',
+        help=(
+            'Ephemeris in data/ephemerides/ to look up natural bodies in, '
+            'made by make_ephemeris.py. Use an empty string to integrate them '
+            'instead, even if the savefile asks for an ephemeris.')
+    )
+
+
+def engine_settings(args: argparse.Namespace) -> Dict[str, str]:
+    """Returns the EngineSettings that the arguments added by
+    add_engine_arguments override, for PhysicsEngine."""
+    return {field: getattr(args, field) for field in _ENGINE_SETTINGS
+            if getattr(args, field) is not None}
+
+
 from . import compat  # noqa: E402
 from . import flight_training  # noqa: E402
 from . import hab_flight  # noqa: E402
@@ -29,6 +29,7 @@ argument_parser.add_argument(
         'Should be a .json savefile written by OrbitX. '
         'Can also read OrbitV .RND savefiles.')
 )
+programs.add_engine_arguments(argument_parser)
 
 
 def main(args: argparse.Namespace):
@@ -39,7 +40,9 @@ def main(args: argparse.Namespace):
         # Take paths relative to 'data/saves/'
         loadfile = common.savefile(args.loadfile)
 
-    physics_engine = physics.PhysicsEngine(common.load_savefile(loadfile))
+    physics_engine = physics.PhysicsEngine(
+        common.load_savefile(loadfile), threads=args.threads,
+        engine_settings=programs.engine_settings(args))
     initial_state = physics_engine.get_state()
 
     gui = flight_gui.FlightGui(
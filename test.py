@@ -1,18 +1,28 @@
 #!/usr/bin/env python3
+import functools
 import logging
+import os
 import sys
+import tempfile
 import unittest
+import unittest.mock
+from pathlib import Path
+from typing import Tuple
 
 import numpy as np
+import scipy.integrate
 
 import orbitx.orbitx_pb2 as protos
 
-from orbitx.physics import calc
+from orbitx.physics import barnes_hut, broad_phase, calc, dynamics, \
+    encke, ephemeris, integrators, interactions, kepler, multirate, packed, \
+    pacing, regularized, relative, rk, symplectic, tolerances, tuning
 from orbitx import common
 from orbitx import logs
 from orbitx import network
 from orbitx import physics
-from orbitx.data_structures import _EntityView, Entity, PhysicsState
+from orbitx.data_structures import _EntityView, Entity, Navmode, \
+    PhysicsState
 
 log = logging.getLogger()
 
@@ -31,6 +41,117 @@ class PhysicsEngine:
         self.physics_engine._stop_simthread()
 
 
+# Reference implementations of some of the events that
+# dynamics.event_value compiles, to check it against.
+
+
+class SrbFuelEvent(physics.engine.Event):
+    def __call__(self, t, y_1d) -> float:
+        """Returns how much SRB burn time is left."""
+        return y_1d[PhysicsState.SRB_TIME_INDEX]
+
+
+class HabFuelEvent(physics.engine.Event):
+    def __init__(self, initial_state: PhysicsState):
+        self.initial_state = initial_state
+
+    def __call__(self, t, y_1d) -> float:
+        """Return a 0 only when throttle is nonzero."""
+        y = PhysicsState(y_1d, self.initial_state._proto_state)
+        for index, entity in enumerate(y._proto_state.entities):
+            if entity.artificial and y.Throttle[index] != 0:
+                return y.Fuel[index]
+        return np.inf
+
+
+class LiftoffEvent(physics.engine.Event):
+    def __init__(self, initial_state: PhysicsState):
+        self.initial_state = initial_state
+
+    def __call__(self, t, y_1d) -> float:
+        """Return 0 when the craft is landed but thrusting enough to lift off,
+        and a positive value otherwise."""
+        y = PhysicsState(y_1d, self.initial_state._proto_state)
+        if y.craft is None:
+            return np.inf
+        craft = y.craft_entity()
+        if not craft.landed():
+            return np.inf
+        planet = y[craft.landed_on]
+        if planet.artificial:
+            # Undocking is governed by other mechanisms.
+            return np.inf
+
+        thrust = common.craft_capabilities[craft.name].thrust * craft.throttle
+        if y.srb_time > 0 and y.craft == common.HABITAT:
+            thrust += common.SRB_THRUST
+        pos = craft.pos - planet.pos
+        weight = common.G * craft.mass * planet.mass / np.inner(pos, pos)
+        return max(0, common.LAUNCH_TWR - thrust / weight)
+
+
+class HighAccEvent(physics.engine.Event):
+    def __init__(self, derive, artificials, acc_bound: float,
+                 current_acc: float, n_entities: int):
+        self.derive = derive
+        self.artificials = artificials
+        self.acc_bound = acc_bound
+        self.current_acc = round(current_acc)
+        self.ax_offset = n_entities * dynamics._VX
+        self.ay_offset = n_entities * dynamics._VY
+
+    def __call__(self, t: float, y_1d: np.ndarray) -> float:
+        """Return positive if the current time acceleration is accurate, zero
+        otherwise."""
+        if self.current_acc == 1:
+            return np.inf
+        derive_result = self.derive(t, y_1d)
+        max_acc_mag = 0.0005  # A small nonzero value.
+        for artif_index in self.artificials:
+            accel = (derive_result[self.ax_offset + artif_index],
+                     derive_result[self.ay_offset + artif_index])
+            max_acc_mag = max(max_acc_mag, calc.fastnorm(accel))
+        return max(self.acc_bound - max_acc_mag, 0)
+
+
+class AtmosphereEvent(physics.engine.Event):
+    def __init__(self, initial_state: PhysicsState):
+        self.initial_state = initial_state
+        self.in_atmosphere = \
+            initial_state.craft is not None and self._margin(initial_state) < 1
+
+    def __call__(self, t, y_1d) -> float:
+        """Return 0 when the craft gets close enough to an atmosphere to
+        feel any drag, unless it was already that close at the start."""
+        y = PhysicsState(y_1d, self.initial_state._proto_state)
+        if y.craft is None or self.in_atmosphere:
+            return np.inf
+        return self._margin(y)
+
+    @staticmethod
+    def _margin(y: PhysicsState) -> float:
+        craft = y.craft_entity()
+        margin = np.inf
+        for index in y.Atmospheres:
+            atmosphere = y[index]
+            dist = calc.fastnorm(atmosphere.pos - craft.pos)
+            # Zero when the exponential in calc.relevant_atmosphere is -20.
+            margin = min(margin, (dist - craft.r - atmosphere.r) / 1000 /
+                         atmosphere.atmosphere_scaling - 20)
+        return margin
+
+
+def random_system(n: int, seed=0, size=1e11) -> Tuple[np.ndarray, ...]:
+    """Returns X, Y, M, Fuel for n bodies scattered across a square 2*size
+    metres on a side, with masses anywhere from asteroids to stars."""
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(-size, size, n)
+    Y = rng.uniform(-size, size, n)
+    M = 10 ** rng.uniform(3, 30, n)
+    Fuel = rng.uniform(0, 1e3, n)
+    return X, Y, M, Fuel
+
+
 class PhysicsEngineTestCase(unittest.TestCase):
     """Test the motion of the simulated system is correct."""
 
@@ -222,6 +343,820 @@ class PhysicsEngineTestCase(unittest.TestCase):
                              (y0.Y[2] - y0.Y[1])**2
                              ))
 
+    def test_test_particles(self):
+        """Test that test particles feel gravity, but don't exert it or
+        collide with each other."""
+        rng = np.random.default_rng(0)
+        n = 50
+        proto_state = protos.PhysicalState()
+        for index in range(n):
+            proto_state.entities.add(
+                name=str(index), r=1,
+                x=rng.uniform(-1e11, 1e11), y=rng.uniform(-1e11, 1e11),
+                mass=10 ** rng.uniform(20, 30),
+                test_particle=bool(index % 2))
+        state = PhysicsState(None, proto_state)
+        test_particles = state.TestParticles
+        self.assertEqual(np.count_nonzero(test_particles), n // 2)
+
+        # Test particles act as if they had no mass, even though they do.
+        masses = np.array([entity.mass for entity in state])
+        expected = calc.grav_acc(state.X, state.Y,
+                                 np.where(test_particles, 0, masses),
+                                 np.where(test_particles, 0, state.Fuel))
+        dy = PhysicsState(
+            dynamics.derive(0, state.y0(), dynamics.build_params(state)),
+            state._proto_state)
+        np.testing.assert_allclose(dy.VX, expected[:, 0], rtol=1e-9)
+        np.testing.assert_allclose(dy.VY, expected[:, 1], rtol=1e-9)
+
+        # Put two test particles on top of each other. They shouldn't
+        # collide, until one of them stops being a test particle.
+        state[3].pos = state[1].pos
+        collision = physics.engine.CollisionEvent(state, np.ones(n))
+        self.assertGreater(collision(0, state.y0()), 0)
+        state[3].test_particle = False
+        collision = physics.engine.CollisionEvent(state, np.ones(n))
+        self.assertLess(collision(0, state.y0()), 0)
+        self.assertEqual(collision(0, state.y0(), return_pair=True), (1, 3))
+
+    def test_integrators(self):
+        """Test that savefiles can choose any integrator, and that they all
+        agree with each other."""
+        state = common.load_savefile(
+            common.savefile('tests/massive-objects.json'))
+        vx = {}
+        for name in integrators.INTEGRATORS:
+            state.engine_settings.integrator = name
+            physics_engine = physics.PhysicsEngine(state)
+            try:
+                vx[name] = physics_engine.get_state(10)[1].vx
+            finally:
+                physics_engine._stop_simthread()
+        default_vx = vx[integrators.DEFAULT_INTEGRATOR]
+        for name in vx:
+            self.assertAlmostEqual(vx[name] / default_vx, 1, places=4,
+                                   msg=name)
+
+        state.engine_settings.integrator = 'Euler'
+        with self.assertRaises(ValueError):
+            physics.PhysicsEngine(state)
+
+    def test_wisdom_holman(self):
+        """Test that the symplectic integrator agrees with RK45 while
+        coasting, and that the engine only uses it while coasting."""
+        state = common.load_savefile(common.savefile('LEO.json'))
+        state.engine_settings.integrator = 'WisdomHolman'
+        params = dynamics.build_params(state)
+        orbits = symplectic.hierarchy(state, params)
+        self.assertEqual(state[orbits.primary[state._name_to_index('Moon')]]
+                         .name, 'Earth')
+        self.assertEqual(state[orbits.primary[state._name_to_index('Earth')]]
+                         .name, 'Sun')
+        self.assertTrue(symplectic.coasting(state, params, orbits))
+
+        # A couple of orbits, with steps much bigger than RK45 could take.
+        reference = scipy.integrate.solve_ivp(
+            functools.partial(dynamics.derive, params=params), [0, 20_000],
+            state.y0(), method='DOP853', rtol=1e-10, atol=1e-6,
+            dense_output=True)
+        result = symplectic.solve_ivp(
+            params, orbits, [0, 20_000], state.y0(), [], max_step=500)
+        self.assertEqual(len(result.t), 41)
+        for t in [20_000, 12_345]:
+            expected = PhysicsState(reference.sol(t), state._proto_state)
+            actual = PhysicsState(result.sol(t), state._proto_state)
+            np.testing.assert_allclose(actual.X, expected.X, atol=20)
+            np.testing.assert_allclose(actual.Y, expected.Y, atol=20)
+
+        # Firing the engines means we're not coasting anymore.
+        state.craft_entity().throttle = 1
+        self.assertFalse(symplectic.coasting(
+            state, dynamics.build_params(state), orbits))
+
+        t0 = state.timestamp
+        physics_engine = physics.PhysicsEngine(state)
+        try:
+            thrusting = physics_engine.get_state(t0 + 100)
+            physics_engine.handle_requests(
+                [network.Request(ident=network.Request.HAB_THROTTLE_SET,
+                                 throttle_set=0)], requested_t=t0 + 100)
+            coasting = physics_engine.get_state(t0 + 200)
+        finally:
+            physics_engine._stop_simthread()
+        self.assertLess(thrusting.craft_entity().fuel,
+                        state.craft_entity().fuel)
+        self.assertAlmostEqual(coasting.craft_entity().fuel,
+                               thrusting.craft_entity().fuel)
+
+    def test_on_rails(self):
+        """Test that barely perturbed entities follow their orbits exactly,
+        and that the craft is still integrated properly."""
+        state = common.load_savefile(common.savefile('LEO.json'))
+        params = dynamics.build_params(state)
+        orbits = symplectic.put_on_rails(
+            state, params, symplectic.hierarchy(state, params), 1e-4)
+        phobos = state._name_to_index('Phobos')
+        mars = state._name_to_index('Mars')
+        self.assertEqual(orbits.primary[phobos], mars)
+        self.assertTrue(orbits.on_rails[phobos])
+        self.assertFalse(orbits.on_rails[state._name_to_index('Moon')])
+        self.assertFalse(orbits.on_rails[params.craft])
+        self.assertEqual(symplectic.step_limit(orbits, 500), 500)
+
+        reference = scipy.integrate.solve_ivp(
+            functools.partial(dynamics.derive, params=params), [0, 20_000],
+            state.y0(), method='DOP853', rtol=1e-10, atol=1e-6)
+        result = symplectic.solve_ivp(
+            params, orbits, [0, 20_000], state.y0(), [], max_step=500)
+        expected = PhysicsState(reference.y[:, -1], state._proto_state)
+        actual = PhysicsState(result.y[:, -1], state._proto_state)
+        self.assertAlmostEqual(actual.X[params.craft],
+                               expected.X[params.craft], delta=20)
+        self.assertAlmostEqual(actual.Y[params.craft],
+                               expected.Y[params.craft], delta=20)
+        np.testing.assert_allclose(
+            [actual.X[phobos] - actual.X[mars],
+             actual.Y[phobos] - actual.Y[mars]],
+            kepler.drift(state.X[phobos] - state.X[mars],
+                         state.Y[phobos] - state.Y[mars],
+                         state.VX[phobos] - state.VX[mars],
+                         state.VY[phobos] - state.VY[mars],
+                         params.GM[phobos] + params.GM[mars], 20_000)[:2],
+            rtol=1e-9)
+
+        # With nothing left to integrate numerically, one step will do.
+        orbits = orbits._replace(on_rails=np.ones(len(state), dtype=bool))
+        self.assertEqual(symplectic.step_limit(orbits, 500), np.inf)
+        result = symplectic.solve_ivp(
+            params, orbits, [0, 1e6], state.y0(), [], max_step=np.inf)
+        self.assertEqual(len(result.t), 2)
+
+    def test_fastest_time_acc(self):
+        """Test that only the symplectic integrators get 1,000,000x, and only
+        while nothing is thrusting."""
+        for integrator, throttle, expected in [('RK45', 0, 100_000),
+                                               ('OnRails', 0, 1_000_000),
+                                               ('OnRails', 1, 100_000)]:
+            state = common.load_savefile(common.savefile('LEO.json'))
+            state.engine_settings.integrator = integrator
+            state.craft_entity().throttle = throttle
+            physics_engine = physics.PhysicsEngine(state)
+            try:
+                physics_engine.handle_requests([network.Request(
+                    ident=network.Request.TIME_ACC_SET,
+                    time_acc_set=1_000_000)])
+                # The simthread slows the clock down as soon as it finds out
+                # the craft is thrusting. HIGH_ACC_EVENT slows the simulation
+                # down further, but not the clock.
+                physics_engine.get_state(
+                    physics_engine._last_physical_state.timestamp + 1)
+                self.assertEqual(
+                    physics_engine._time_acc_changes[-1].time_acc, expected,
+                    msg=f'{integrator} at throttle {throttle}')
+            finally:
+                physics_engine._stop_simthread()
+
+    def test_multirate(self):
+        """Test that each entity steps as often as it needs to, and that the
+        multi-rate integrator still agrees with DOP853."""
+        state = physics.engine._reconcile_entity_dynamics(
+            common.load_savefile(common.savefile('LEO.json')))
+        params = dynamics.build_params(state)
+        levels = multirate.levels(state, params, 500)
+        self.assertEqual(levels[state._name_to_index('Sedna')], 0)
+        self.assertGreater(levels[state._name_to_index('Phobos')],
+                           levels[state._name_to_index('Mars')])
+        self.assertEqual(levels[params.craft], levels.max())
+
+        reference = scipy.integrate.solve_ivp(
+            functools.partial(dynamics.derive, params=params), [0, 20_000],
+            state.y0(), method='DOP853', rtol=1e-10, atol=1e-6,
+            dense_output=True)
+        result = multirate.solve_ivp(
+            params, [0, 20_000], state.y0(), [], max_step=500)
+        self.assertEqual(len(result.t), 41)
+        for t in [20_000, 12_345]:
+            expected = PhysicsState(reference.sol(t), state._proto_state)
+            actual = PhysicsState(result.sol(t), state._proto_state)
+            np.testing.assert_allclose(actual.X, expected.X, atol=20)
+            np.testing.assert_allclose(actual.Y, expected.Y, atol=20)
+            np.testing.assert_allclose(actual.VX, expected.VX, atol=0.02)
+            np.testing.assert_allclose(actual.VY, expected.VY, atol=0.02)
+
+    def test_ephemeris(self):
+        """Test that natural bodies looked up in an ephemeris are where
+        integrating them would put them, and so is the craft."""
+        state = common.load_savefile(common.savefile('LEO.json'))
+        params = dynamics.build_params(state)
+        t0 = state.timestamp
+        with tempfile.TemporaryDirectory() as directory:
+            file = Path(directory) / 'LEO.npz'
+            ephemeris.save(ephemeris.build(state, 2000), file)
+            table = ephemeris.Table(ephemeris.load(file), state)
+        self.assertLess(table.mismatch(state),
+                        ephemeris.DEFAULT_POSITION_TOLERANCE)
+        self.assertTrue(table.covers([t0, t0 + 2000]))
+        self.assertFalse(table.covers([t0, t0 + 2001]))
+
+        reference = scipy.integrate.solve_ivp(
+            functools.partial(dynamics.derive, params=params),
+            [t0, t0 + 2000], state.y0(), method='DOP853', rtol=1e-10,
+            atol=1e-6, dense_output=True)
+        result = table.solve_ivp(
+            params, [t0, t0 + 2000], state.y0(), [], 'DOP853', max_step=100)
+        for t in [t0 + 1000, t0 + 2000]:
+            expected = PhysicsState(reference.sol(t), state._proto_state)
+            actual = PhysicsState(result.sol(t), state._proto_state)
+            np.testing.assert_allclose(actual.X, expected.X, atol=1)
+            np.testing.assert_allclose(actual.Y, expected.Y, atol=1)
+            np.testing.assert_allclose(actual.VX, expected.VX, atol=1e-3)
+            np.testing.assert_allclose(actual.VY, expected.VY, atol=1e-3)
+
+    def test_packed(self):
+        """Test that only integrating the continuous parts of the y-vector
+        gives the same results as integrating all of it."""
+        state = physics.engine._reconcile_entity_dynamics(
+            common.load_savefile(common.savefile('LEO.json')))
+        state.craft_entity().throttle = 1
+        params = dynamics.build_params(state)
+        y0 = state.y0()
+
+        # Everything that isn't integrated would have a derivative of zero.
+        constant = np.ones(len(y0), dtype=bool)
+        constant[dynamics.continuous(params)] = False
+        dy = dynamics.derive(0, y0, params)
+        self.assertTrue(constant.any())
+        np.testing.assert_array_equal(dy[constant], 0)
+        # The fuel of the craft is integrated, the fuel of planets isn't.
+        fuel = constant[dynamics._FUEL * len(state):
+                        (dynamics._FUEL + 1) * len(state)]
+        self.assertFalse(fuel[state._name_to_index(state.craft)])
+        self.assertTrue(fuel[state._name_to_index('Earth')])
+
+        expected = scipy.integrate.solve_ivp(
+            functools.partial(dynamics.derive, params=params), [0, 100], y0,
+            method='RK45', max_step=10, dense_output=True)
+        actual = packed.solve_ivp(params, [0, 100], y0, [], 'RK45',
+                                  max_step=10)
+        self.assertTrue(actual.success)
+        np.testing.assert_array_equal(actual.y[constant, -1], y0[constant])
+        np.testing.assert_allclose(actual.y[:, -1], expected.y[:, -1],
+                                   rtol=1e-6)
+        np.testing.assert_allclose(actual.sol(50), expected.sol(50),
+                                   rtol=1e-6)
+
+    def test_relative(self):
+        """Test that integrating relative to each entity's primary gives
+        the same results as integrating relative to the Sun, in the same
+        coordinates."""
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        params = dynamics.build_params(state)
+        self.assertIsNone(relative.orbits(state, params))
+        state.engine_settings.relative_coordinates = True
+        orbits = relative.orbits(state, params)
+        y_1d = state.y0().copy()
+        relative.to_relative(y_1d, orbits.primary, orbits.order)
+        self.assertEqual(orbits.primary[state._name_to_index('Moon')],
+                         state._name_to_index('Earth'))
+        self.assertAlmostEqual(
+            PhysicsState(y_1d, state._proto_state)['Moon'].x,
+            state['Moon'].x - state['Earth'].x, delta=1e-3)
+        relative.to_absolute(y_1d, orbits.primary, orbits.order)
+        np.testing.assert_allclose(y_1d, state.y0(), atol=1e-3)
+
+        # The Habitat starts just above the Earth. In absolute coordinates,
+        # the default tolerances let it drift by over a hundred metres from
+        # where it should be. It hardly drifts at all in relative
+        # coordinates.
+        reference = packed.solve_ivp(params, [0, 1000], state.y0(), [],
+                                     'DOP853', 10, tolerances.REFERENCE)
+        absolute = packed.solve_ivp(params, [0, 1000], state.y0(), [],
+                                    'RK45', 100)
+        result = packed.solve_ivp(params, [0, 1000], state.y0(), [],
+                                  'RK45', 100, orbits=orbits)
+        self.assertTrue(result.success)
+        self.assertEqual(result.t[-1], 1000)
+        np.testing.assert_array_equal(result.sol(1000), result.y[:, -1])
+
+        def drift(result) -> np.ndarray:
+            final = PhysicsState(result.y[:, -1], state._proto_state)
+            expected = PhysicsState(reference.y[:, -1], state._proto_state)
+            return np.hypot(final.X - expected.X, final.Y - expected.Y)
+
+        habitat = state._name_to_index('Habitat')
+        self.assertLess(np.max(drift(result)), 1)
+        self.assertLess(drift(result)[habitat],
+                        drift(absolute)[habitat] / 100)
+
+    def test_regularized(self):
+        """Test that integrating in Sundman's fictitious time gives the same
+        results as integrating in time, never steps further in time than the
+        max step, and that everything it returns is in time."""
+        state = common.load_savefile(common.savefile('earth-flyby.json'))
+        params = dynamics.build_params(state)
+        self.assertTrue(regularized.applies(params))
+        self.assertFalse(regularized.applies(params._replace(
+            reference=params.craft)))
+
+        duration = 20_000
+        reference = packed.solve_ivp(params, [0, duration], state.y0(), [],
+                                     'DOP853', 10, tolerances.REFERENCE)
+        result = regularized.solve_ivp(params, [0, duration], state.y0(),
+                                       [], 'RK45', 100)
+        self.assertTrue(result.success)
+        self.assertEqual(result.status, 0)
+        self.assertEqual(result.t[-1], duration)
+        self.assertTrue(np.all(np.diff(result.t) > 0))
+        self.assertLessEqual(np.max(np.diff(result.t)), 100 + 1e-6)
+        craft = state._name_to_index(state.craft)
+        n = len(state)
+        self.assertAlmostEqual(result.y[craft, -1], reference.y[craft, -1],
+                               delta=1)
+        self.assertAlmostEqual(result.y[n + craft, -1],
+                               reference.y[n + craft, -1], delta=1)
+        np.testing.assert_allclose(result.sol(duration), result.y[:, -1])
+        middle = len(result.t) // 2
+        np.testing.assert_allclose(result.sol(result.t[middle]),
+                                   result.y[:, middle])
+
+        def halfway(t, y) -> float:
+            return duration / 2 - t
+        halfway.terminal = True
+        halfway.direction = 0
+        result = regularized.solve_ivp(params, [0, duration], state.y0(),
+                                       [halfway], 'RK45', 100)
+        self.assertEqual(result.status, 1)
+        self.assertAlmostEqual(result.t_events[0][0], duration / 2,
+                               delta=1e-6)
+        self.assertAlmostEqual(result.t[-1], duration / 2, delta=1e-6)
+
+    def test_encke(self):
+        """Test that integrating the craft as its deviation from a conic
+        keeps it on course with steps far too long for integrating it
+        directly, and that rectifying the conic changes nothing."""
+        state = common.load_savefile(common.savefile('LEO.json'))
+        params = dynamics.build_params(state)
+        self.assertTrue(encke.applies(params))
+        state.craft_entity().throttle = 1
+        self.assertFalse(encke.applies(dynamics.build_params(state)))
+        state.craft_entity().throttle = 0
+
+        craft = state._name_to_index(state.craft)
+        n = len(state)
+
+        def drift(result, reference) -> float:
+            return np.hypot(result.y[craft, -1] - reference.y[craft, -1],
+                            result.y[n + craft, -1] -
+                            reference.y[n + craft, -1])
+
+        duration = 20_000
+        reference = packed.solve_ivp(params, [0, duration], state.y0(), [],
+                                     'DOP853', 10, tolerances.REFERENCE)
+        direct = packed.solve_ivp(params, [0, duration], state.y0(), [],
+                                  'RK45', 1000)
+        result = encke.solve_ivp(params, [0, duration], state.y0(), [],
+                                 'RK45', 1000)
+        self.assertTrue(result.success)
+        self.assertEqual(result.status, 0)
+        self.assertEqual(result.t[-1], duration)
+        np.testing.assert_allclose(result.sol(duration), result.y[:, -1])
+        self.assertGreater(drift(direct, reference), 1000)
+        self.assertLess(drift(result, reference), 1)
+
+        # Relative to the Moon, the Earth pulls the craft off its conic so
+        # hard that the conic needs rectifying every twenty minutes or so.
+        state.reference = 'Moon'
+        params = dynamics.build_params(state)
+        duration = 3000
+        reference = packed.solve_ivp(params, [0, duration], state.y0(), [],
+                                     'DOP853', 10, tolerances.REFERENCE)
+        result = encke.solve_ivp(params, [0, duration], state.y0(), [],
+                                 'RK45', 100)
+        self.assertGreater(len(result.sol.pieces), 1)
+        self.assertEqual(result.t[-1], duration)
+        self.assertLess(drift(result, reference), 1)
+        for t in [result.sol.starts[0], duration / 3]:
+            np.testing.assert_allclose(result.sol(t)[:4 * n],
+                                       reference.sol(t)[:4 * n], atol=1)
+
+    def test_landers(self):
+        """Test that landed entities aren't integrated, and stay exactly
+        where they landed as what they're landed on moves and turns."""
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        state['Habitat'].landed_on = 'Earth'
+        state = physics.engine._reconcile_entity_dynamics(state)
+        params = dynamics.build_params(state)
+        event_params = dynamics.build_event_params(state, np.inf)
+        n = len(state)
+        habitat = state._name_to_index('Habitat')
+        earth = state._name_to_index('Earth')
+        integrated = dynamics.continuous(params)
+        self.assertNotIn(dynamics._X * n + habitat, integrated)
+        self.assertNotIn(dynamics._HEADING * n + habitat, integrated)
+        self.assertIn(dynamics._X * n + earth, integrated)
+
+        # Placing the Habitat where it already is doesn't move it.
+        y_1d = state.y0().copy()
+        dynamics.place_landers(y_1d, params)
+        np.testing.assert_allclose(y_1d, state.y0(), rtol=1e-12)
+
+        for result in [
+                packed.solve_ivp(params, [0, 10_000], state.y0(), [],
+                                 'RK45', 1000),
+                rk.solve_ivp(params, event_params, [0, 10_000], state.y0(),
+                             1000)]:
+            self.assertTrue(result.success)
+            for y in [result.y[:, -1], result.sol(5_000)]:
+                final = PhysicsState(y, state._proto_state)
+                self.assertAlmostEqual(
+                    calc.fastnorm(final['Habitat'].pos - final['Earth'].pos),
+                    final['Earth'].r + final['Habitat'].r, delta=1e-3)
+                # The Habitat turns along with the Earth.
+                self.assertAlmostEqual(
+                    final['Habitat'].heading - final['Earth'].heading,
+                    state['Habitat'].heading - state['Earth'].heading)
+                self.assertEqual(final['Habitat'].spin,
+                                 final['Earth'].spin)
+
+    def test_tolerances(self):
+        """Test that tolerance profiles can be picked and changed, and that
+        tighter profiles are more accurate."""
+        state = physics.engine._reconcile_entity_dynamics(
+            common.load_savefile(common.savefile('LEO.json')))
+        self.assertEqual(tolerances.profile(state).name,
+                         tolerances.DEFAULT_PROFILE)
+        state.engine_settings.tolerances = 'nonexistent'
+        with self.assertRaises(ValueError):
+            tolerances.profile(state)
+
+        params = dynamics.build_params(state)
+        precise = tolerances.PROFILES['precise']
+        rtol, atol = tolerances.arrays(precise, params)
+        n = len(state)
+        craft = state._name_to_index(state.craft)
+        earth = state._name_to_index('Earth')
+        self.assertEqual(atol[dynamics._X * n + craft],
+                         precise.craft_atol['x'])
+        self.assertEqual(atol[dynamics._X * n + earth], precise.atol['x'])
+        self.assertEqual(rtol[dynamics._VY * n + earth], precise.rtol['vy'])
+        self.assertEqual(atol[dynamics._FUEL * n + earth], np.inf)
+
+        # With steps this long, only the tolerances limit how long they are.
+        reference = packed.solve_ivp(
+            params, [0, 4000], state.y0(), [], 'DOP853', max_step=100,
+            profile=tolerances.PROFILES['precise'])
+        errors = []
+        evaluations = []
+        for name in ['fast', 'training', 'precise']:
+            result = packed.solve_ivp(
+                params, [0, 4000], state.y0(), [], 'RK45', max_step=4000,
+                profile=tolerances.PROFILES[name])
+            errors.append(np.hypot(
+                *(result.y[[dynamics._X * n + craft,
+                            dynamics._Y * n + craft], -1] -
+                  reference.y[[dynamics._X * n + craft,
+                               dynamics._Y * n + craft], -1])))
+            evaluations.append(result.nfev)
+        self.assertEqual(errors, sorted(errors, reverse=True))
+        self.assertEqual(evaluations, sorted(evaluations))
+
+        with PhysicsEngine('LEO.json') as physics_engine:
+            physics_engine.handle_requests([network.Request(
+                ident=network.Request.TOLERANCES_SET,
+                tolerances='precise')])
+            self.assertEqual(
+                physics_engine.get_state().engine_settings.tolerances,
+                'precise')
+            # Unknown profiles are ignored.
+            physics_engine.handle_requests([network.Request(
+                ident=network.Request.TOLERANCES_SET,
+                tolerances='nonexistent')])
+            self.assertEqual(
+                physics_engine.get_state().engine_settings.tolerances,
+                'precise')
+
+        # Overrides, e.g. from the command line, outlast loading a savefile.
+        physics_engine = physics.PhysicsEngine(
+            common.load_savefile(common.savefile('LEO.json')),
+            engine_settings={'tolerances': 'fast'})
+        try:
+            physics_engine.handle_requests([network.Request(
+                ident=network.Request.LOAD_SAVEFILE, loadfile='LEO.json')])
+            self.assertEqual(
+                physics_engine.get_state().engine_settings.tolerances, 'fast')
+        finally:
+            physics_engine._stop_simthread()
+
+    def test_tuning(self):
+        """Test that tuning tables survive being saved, that rewriting one
+        takes effect without a restart, and that the engine only uses them
+        for the integrator and time accs they were tuned for."""
+        state = common.load_savefile(common.savefile('LEO.json'))
+        state.time_acc = 1_000
+        tuned = tuning.Setting(max_step=250, tolerances='fast', chunk=2500)
+        table = tuning.Table(
+            integrator='RK45', savefile='LEO.json', duration=10_000,
+            position_budget=100, energy_budget=1e-12,
+            settings={1_000: tuned})
+        with tempfile.TemporaryDirectory() as directory:
+            file = Path(directory) / 'LEO.json'
+            tuning.save(table, file)
+            self.assertEqual(tuning.load(file), table)
+            with unittest.mock.patch.object(tuning, 'path',
+                                            return_value=file):
+                self.assertEqual(tuning.load_named('LEO.json'), table)
+                retuned = table._replace(integrator='DOP853')
+                tuning.save(retuned, file)
+                stat = file.stat()
+                os.utime(file, ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 1_000_000_000))
+                self.assertEqual(tuning.load_named('LEO.json'), retuned)
+
+        rk45 = integrators.INTEGRATORS['RK45']
+        self.assertEqual(tuning.setting(table, rk45, state), tuned)
+        default = tuning.setting(None, rk45, state)
+        self.assertEqual(default.max_step,
+                         integrators.max_step(rk45, state.time_acc))
+        self.assertEqual(default.tolerances, tolerances.DEFAULT_PROFILE)
+        self.assertEqual(
+            tuning.setting(table, integrators.INTEGRATORS['DOP853'], state),
+            tuning.setting(None, integrators.INTEGRATORS['DOP853'], state))
+        state.time_acc = 100
+        self.assertEqual(tuning.setting(table, rk45, state),
+                         tuning.setting(None, rk45, state))
+        # Tolerances the savefile asks for win over tuned ones.
+        state.time_acc = 1_000
+        state.engine_settings.tolerances = 'precise'
+        self.assertEqual(tuning.setting(table, rk45, state),
+                         tuned._replace(tolerances='precise'))
+
+        # Energy is conserved while nothing is thrusting.
+        y0 = state.y0()
+        result = packed.solve_ivp(dynamics.build_params(state), [0, 1000],
+                                  y0, [], 'DOP853', max_step=100,
+                                  profile=tolerances.PROFILES['precise'])
+        end = PhysicsState(result.y[:, -1], state._proto_state)
+        masses = np.array([entity.mass for entity in state])
+        start_energy = calc.total_energy(state.X, state.Y, state.VX,
+                                         state.VY, masses, state.Fuel)
+        self.assertAlmostEqual(
+            calc.total_energy(end.X, end.Y, end.VX, end.VY, masses,
+                              end.Fuel) / start_energy, 1, places=12)
+
+    def test_pacing(self):
+        """Test that chunks are as long as they can be without the
+        simthread falling behind or any chunk taking too long."""
+        pacer = pacing.Pacer(time_acc=100)
+        # Nothing's been measured yet.
+        self.assertEqual(pacer.chunk(default=100, shortest=10,
+                                     longest=np.inf), 100)
+        self.assertEqual(pacer.chunk(default=100, shortest=10, longest=50),
+                         50)
+
+        # Cheap to simulate, so keep LOOKAHEAD wall seconds ahead of the main
+        # thread, which is assumed to be running in real time.
+        pacer.simulated(duration=1000, wall_time=0.001)
+        self.assertEqual(pacer.chunk(default=100, shortest=10,
+                                     longest=np.inf),
+                         100 * pacing.LOOKAHEAD)
+        pacer.consumed(simtime=0, monotime=0)
+        pacer.consumed(simtime=5_000, monotime=1)
+        self.assertEqual(pacer.consumption, 5_000)
+        self.assertEqual(pacer.chunk(default=100, shortest=10,
+                                     longest=np.inf),
+                         5_000 * pacing.LOOKAHEAD)
+        # A quick second measurement isn't enough to go on.
+        pacer.consumed(simtime=5_000, monotime=1.01)
+        self.assertEqual(pacer.consumption, 5_000)
+
+        # Expensive to simulate, so chunks are short, but not too short.
+        pacer = pacing.Pacer(time_acc=100)
+        pacer.simulated(duration=1, wall_time=0.1)
+        self.assertAlmostEqual(
+            pacer.chunk(default=100, shortest=0.1, longest=np.inf),
+            pacing.MAX_CHUNK_WALL_TIME / 0.1)
+        self.assertEqual(pacer.chunk(default=100, shortest=10,
+                                     longest=np.inf), 10)
+
+        # The engine still agrees with itself with chunks picked this way.
+        with PhysicsEngine('OCESS.json') as physics_engine:
+            physics_engine.handle_requests([network.Request(
+                ident=network.Request.TIME_ACC_SET, time_acc_set=10_000)])
+            state = physics_engine.get_state()
+            later = physics_engine.get_state(state.timestamp + 50_000)
+            self.assertIsNotNone(physics_engine._pacer.cost)
+            self.assertGreater(later.timestamp, state.timestamp)
+
+    def test_persistent_simthread(self):
+        """Test that commands hand the same simthread new initial conditions,
+        that commands that change nothing don't interrupt it, and that the
+        simulation before a command can still be looked up, unless it's from
+        before a savefile was loaded."""
+        with PhysicsEngine('LEO.json') as physics_engine:
+            state = physics_engine.get_state()
+            t = state.timestamp + 10
+            before = physics_engine.get_state(t)
+            simthread = physics_engine._simthread
+            # Holding this stops the simthread from handing over solutions
+            # while we look at them. The engine can still take it too, since
+            # it's reentrant.
+            with physics_engine._solutions_cond:
+                generation = physics_engine._generation
+                solutions = list(physics_engine._solutions)
+                current = next(solution for solution in solutions
+                               if solution.t_min <= t <= solution.t_max)
+
+                physics_engine.handle_requests([network.Request(
+                    ident=network.Request.HAB_THROTTLE_SET,
+                    throttle_set=before.craft_entity().throttle)],
+                    requested_t=t)
+                self.assertEqual(physics_engine._generation, generation)
+                self.assertEqual(list(physics_engine._solutions), solutions)
+
+                physics_engine.handle_requests([network.Request(
+                    ident=network.Request.HAB_SPIN_CHANGE, spin_change=0.1)],
+                    requested_t=t)
+                self.assertIs(physics_engine._simthread, simthread)
+                self.assertEqual(physics_engine._generation, generation + 1)
+                self.assertTrue(physics_engine._solutions)
+                for solution in physics_engine._solutions:
+                    self.assertLess(solution.t_max, t)
+                earlier = (current.t_min + t) / 2
+                np.testing.assert_array_equal(
+                    physics_engine.get_state(earlier).y0(), current(earlier))
+
+            after = physics_engine.get_state(t)
+            self.assertAlmostEqual(after.craft_entity().spin,
+                                   before.craft_entity().spin + 0.1)
+            later = physics_engine.get_state(t + 10)
+            self.assertIs(physics_engine._simthread, simthread)
+            self.assertAlmostEqual(
+                later.craft_entity().heading,
+                after.craft_entity().heading +
+                10 * after.craft_entity().spin, delta=1e-6)
+
+            with physics_engine._solutions_cond:
+                physics_engine.handle_requests([network.Request(
+                    ident=network.Request.LOAD_SAVEFILE,
+                    loadfile='LEO.json')], requested_t=t + 10)
+                self.assertEqual(len(physics_engine._solutions), 0)
+            self.assertIs(physics_engine._simthread, simthread)
+
+    def test_simthread_recovers(self):
+        """Test that a crash in the simthread is only reported until it's
+        given new initial conditions, that the simthread survives it, and
+        that a chunk stops once it's superseded by them."""
+        with PhysicsEngine('LEO.json') as physics_engine:
+            state = physics_engine.get_state()
+            simthread = physics_engine._simthread
+            with unittest.mock.patch.object(
+                    pacing.Pacer, 'chunk',
+                    side_effect=RuntimeError('simthread crashed')):
+                physics_engine.set_state(state)
+                with self.assertRaises(RuntimeError):
+                    physics_engine.get_state(state.timestamp + 100)
+            self.assertTrue(simthread.is_alive())
+            physics_engine.set_state(state)
+            later = physics_engine.get_state(state.timestamp + 100)
+            self.assertAlmostEqual(later.timestamp, state.timestamp + 100)
+            self.assertIs(physics_engine._simthread, simthread)
+
+            superseded = physics.engine._SupersededEvent(
+                physics_engine, physics_engine._generation)
+            self.assertEqual(superseded(10, state.y0()), np.inf)
+            physics_engine.set_state(state)
+            # The event happens at the first time it's called at after
+            # set_state, and not before.
+            self.assertEqual(superseded(20, state.y0()), 0)
+            self.assertEqual(superseded(15, state.y0()), 5)
+            self.assertEqual(superseded(25, state.y0()), -5)
+
+    def test_compiled_rk45(self):
+        """Test that the compiled RK45 takes the same steps as scipy's, and
+        finds the same events as the engine's event classes, and that the
+        engine's compiled events agree with them too."""
+        # Respectively: a collision, no events, and HighAccEvent right away.
+        for savefile, time_acc in [('lithobraking.json', 1),
+                                   ('LEO.json', 100),
+                                   ('LEO.json', 1_000)]:
+            state = physics.engine._reconcile_entity_dynamics(
+                common.load_savefile(common.savefile(savefile)))
+            state.time_acc = time_acc
+            params = dynamics.build_params(state)
+            derive = functools.partial(dynamics.derive, params=params)
+            acc_bound = physics.engine.TIME_ACC_TO_BOUND[time_acc]
+            events = [
+                physics.engine.CollisionEvent(
+                    state, np.array([entity.r for entity in state])),
+                HabFuelEvent(state),
+                LiftoffEvent(state),
+                SrbFuelEvent(),
+                HighAccEvent(
+                    derive, [i for i, entity in enumerate(state)
+                             if entity.artificial], acc_bound,
+                    time_acc, len(state)),
+                AtmosphereEvent(state)]
+            event_params = dynamics.build_event_params(state, acc_bound)
+
+            compiled = physics.engine.CompiledEvents(params, event_params)
+            compiled_events = compiled.events
+
+            y0 = state.y0()
+            dy = derive(0, y0)
+            for index, event in enumerate(events):
+                self.assertAlmostEqual(
+                    dynamics.event_value(index, y0, dy, params,
+                                         event_params),
+                    event(0, y0), msg=f'{savefile} {event}')
+                self.assertAlmostEqual(
+                    compiled_events[index](0, y0), event(0, y0),
+                    msg=f'{savefile} {event}')
+
+            expected = packed.solve_ivp(
+                params, [0, 1000], y0, events, 'RK45', max_step=100)
+            # Reusing the integrator's derivatives for HighAccEvent doesn't
+            # change anything.
+            with_compiled_events = packed.solve_ivp(
+                params, [0, 1000], y0, compiled_events, 'RK45',
+                max_step=100, derivatives=compiled.derivatives)
+            np.testing.assert_array_equal(with_compiled_events.t,
+                                          expected.t)
+            for compiled_t, expected_t in zip(with_compiled_events.t_events,
+                                              expected.t_events):
+                np.testing.assert_array_equal(compiled_t, expected_t)
+            actual = rk.solve_ivp(
+                params, event_params, [0, 1000], y0, max_step=100)
+            self.assertEqual(actual.status, expected.status, msg=savefile)
+            self.assertEqual(actual.nfev, expected.nfev, msg=savefile)
+            # scipy repeats t0 if an event happens right away, we don't.
+            np.testing.assert_allclose(actual.t, np.unique(expected.t),
+                                       rtol=1e-12)
+            np.testing.assert_allclose(actual.y[:, -1], expected.y[:, -1],
+                                       rtol=1e-12)
+            for actual_t, expected_t in zip(actual.t_events,
+                                            expected.t_events):
+                np.testing.assert_allclose(actual_t, expected_t,
+                                           rtol=1e-12)
+            t = actual.t[-1] / 3
+            np.testing.assert_allclose(actual.sol(t), expected.sol(t),
+                                       rtol=1e-12)
+
+        # The craft gets close enough to Earth for HIGH_ACC_EVENT to happen,
+        # at the same time whether or not derivatives are reused.
+        state = common.load_savefile(common.savefile('earth-flyby.json'))
+        state.time_acc = 100_000
+        params = dynamics.build_params(state)
+        acc_bound = physics.engine.TIME_ACC_TO_BOUND[state.time_acc]
+        compiled = physics.engine.CompiledEvents(
+            params, dynamics.build_event_params(state, acc_bound))
+        high_acc = HighAccEvent(
+            functools.partial(dynamics.derive, params=params),
+            [i for i, entity in enumerate(state) if entity.artificial],
+            acc_bound, state.time_acc, len(state))
+        expected = packed.solve_ivp(params, [0, 40_000], state.y0(),
+                                    [high_acc], 'RK45', max_step=100)
+        actual = packed.solve_ivp(
+            params, [0, 40_000], state.y0(), compiled.events, 'RK45',
+            max_step=100, derivatives=compiled.derivatives)
+        self.assertEqual(len(expected.t_events[0]), 1)
+        np.testing.assert_allclose(
+            actual.t_events[dynamics.HIGH_ACC_EVENT], expected.t_events[0],
+            rtol=1e-12)
+
+    def test_high_acc_event(self):
+        """Test that HIGH_ACC_EVENT measures how much slower the craft is
+        accelerating than the time acc can accurately simulate."""
+        # The craft in HEO.json is far enough from Earth for 100,000x, and
+        # the craft in LEO.json is too close for 100x, but not for 50x.
+        # Before HIGH_ACC_EVENT measured the craft itself, it slowed LEO.json
+        # down to 100x instead of 50x.
+        for savefile, fast_enough, too_fast in [('HEO.json', 100_000, None),
+                                                ('LEO.json', 50, 100)]:
+            state = physics.engine._reconcile_entity_dynamics(
+                common.load_savefile(common.savefile(savefile)))
+            params = dynamics.build_params(state)
+            y0 = state.y0()
+            dy = dynamics.derive(0, y0, params)
+            n = len(state)
+            craft = state._name_to_index(state.craft)
+            craft_acc = np.hypot(dy[dynamics._VX * n + craft],
+                                 dy[dynamics._VY * n + craft])
+            for time_acc in [5, 1_000, 10_000, 100_000]:
+                state.time_acc = time_acc
+                acc_bound = physics.engine.TIME_ACC_TO_BOUND[time_acc]
+                event_params = dynamics.build_event_params(state, acc_bound)
+                self.assertAlmostEqual(
+                    dynamics.event_value(dynamics.HIGH_ACC_EVENT, y0, dy,
+                                         params, event_params),
+                    max(acc_bound - craft_acc, 0),
+                    msg=f'{savefile} {time_acc}')
+            self.assertLess(craft_acc,
+                            physics.engine.TIME_ACC_TO_BOUND[fast_enough])
+            if too_fast is not None:
+                self.assertGreater(
+                    craft_acc, physics.engine.TIME_ACC_TO_BOUND[too_fast])
+
     def test_landing(self):
         with PhysicsEngine('tests/artificial-collision.json') \
                 as physics_engine:
@@ -250,7 +1185,7 @@ class PhysicsEngineTestCase(unittest.TestCase):
             initial = physics_engine.get_state(initial_t + 10)
             physics_engine.handle_requests(
                 [network.Request(ident=network.Request.TIME_ACC_SET,
-                                 time_acc_set=common.TIME_ACCS[-1].value)],
+                                 time_acc_set=100_000)],
                 requested_t=initial_t + 10)
             final = physics_engine.get_state(initial_t + 100_000)
             self.assertAlmostEqual(
@@ -275,6 +1210,84 @@ class PhysicsEngineTestCase(unittest.TestCase):
         self.assertLess(59, drag)
         self.assertGreater(60, drag)
 
+    def test_compiled_derivative(self):
+        """Test the compiled derivative agrees with the Python calculations."""
+        state = common.load_savefile(common.savefile('tests/atmosphere.json'))
+        state.target = state.reference
+        state.navmode = Navmode['CCW Prograde']
+        hab = state.craft_entity()
+        hab.landed_on = ''
+        hab.vy += 10
+        hab.spin = 0
+        craft_i = state._name_to_index(state.craft)
+
+        dy = PhysicsState(
+            dynamics.derive(0, state.y0(), dynamics.build_params(state)),
+            state._proto_state)
+
+        # Gravity and drag are the only things accelerating the craft.
+        expected_acc = (
+            calc.grav_acc(state.X, state.Y,
+                          np.array([entity.mass for entity in state]),
+                          state.Fuel)[craft_i] -
+            calc.drag(state))
+        self.assertAlmostEqual(dy.VX[craft_i], expected_acc[0])
+        self.assertAlmostEqual(dy.VY[craft_i], expected_acc[1])
+        # The craft is turning according to its navmode.
+        self.assertAlmostEqual(dy.Heading[craft_i], calc.navmode_spin(state))
+        # Nothing about the original state has changed.
+        self.assertEqual(state.craft_entity().spin, 0)
+
+    def test_flight_regime(self):
+        """Test that the derivative only skips work that doesn't apply, and
+        that a craft falling into an atmosphere ends the chunk."""
+        state = common.load_savefile(common.savefile('LEO.json'))
+        params = dynamics.build_params(state)
+        self.assertEqual(params.regime, 0)
+        everything = params._replace(
+            regime=dynamics.POWERED | dynamics.ATMOSPHERIC)
+        np.testing.assert_array_equal(
+            dynamics.derive(0, state.y0(), params),
+            dynamics.derive(0, state.y0(), everything))
+        # Burning fuel doesn't change params, which the whole chunk shares.
+        GM = params.GM.copy()
+        y_1d = state.y0().copy()
+        y_1d[dynamics._FUEL * len(state) + params.craft] /= 2
+        dynamics.derive(0, y_1d, everything)
+        np.testing.assert_array_equal(params.GM, GM)
+        # Nor does it leave anything behind for the next derivative.
+        np.testing.assert_array_equal(
+            dynamics.derive(0, state.y0(), everything),
+            dynamics.derive(0, state.y0(), params))
+        state.craft_entity().throttle = 1
+        self.assertEqual(dynamics.build_params(state).regime,
+                         dynamics.POWERED)
+
+        # The Habitat starts 1 km above the Earth. Put it 200 km up,
+        # falling at 1 km/s, so it gets to where drag starts, 134 km up,
+        # in under a minute.
+        state = common.load_savefile(common.savefile('tests/atmosphere.json'))
+        self.assertEqual(dynamics.build_params(state).regime,
+                         dynamics.ATMOSPHERIC)
+        hab = state.craft_entity()
+        earth = state['Earth']
+        down = (earth.pos - hab.pos) / calc.fastnorm(earth.pos - hab.pos)
+        hab.pos = hab.pos - down * 199e3
+        hab.v = earth.v + down * 1e3
+        params = dynamics.build_params(state)
+        self.assertEqual(params.regime, 0)
+        event_params = dynamics.build_event_params(state, np.inf)
+        result = rk.solve_ivp(params, event_params, [0, 1000], state.y0(),
+                              10)
+        self.assertEqual(len(result.t_events[dynamics.ATMOSPHERE_EVENT]), 1)
+        self.assertLess(result.t[-1], 60)
+        final = PhysicsState(result.y[:, -1], state._proto_state)
+        self.assertAlmostEqual(
+            dynamics.atmosphere_margin(final.X, final.Y, params), 0,
+            delta=1e-6)
+        self.assertEqual(dynamics.build_params(final).regime,
+                         dynamics.ATMOSPHERIC)
+
 
 class EntityTestCase(unittest.TestCase):
     """Tests that state.Entity properly proxies underlying proto."""
@@ -389,7 +1402,8 @@ class PhysicsStateTestCase(unittest.TestCase):
 
 
 class CalculationsTestCase(unittest.TestCase):
-    """Tests instantaneous orbit parameter calculations.
+    """Tests instantaneous orbit parameter calculations, and the gravity and
+    collision kernels.
 
     The file tests/gui-test.json encodes the position of the Earth and the
     ISS, with all possitions offset by a billion metres along the x and y axes.
@@ -459,6 +1473,198 @@ class CalculationsTestCase(unittest.TestCase):
         self.assertAlmostEqual(calc.h_speed(iss, earth), 7665, delta=10)
         self.assertAlmostEqual(calc.v_speed(iss, earth), -0.1, delta=0.1)
 
+    def test_grav_acc(self):
+        """Test the gravity kernel against a simple all-pairs calculation."""
+        X, Y, M, Fuel = random_system(50)
+
+        posns = np.column_stack((X, Y))
+        displacements = posns.reshape((1, -1, 2)) - posns.reshape((-1, 1, 2))
+        dist_matrix = np.linalg.norm(displacements, axis=2)
+        np.fill_diagonal(dist_matrix, np.inf)
+        expected = (
+            common.G * (M + Fuel).reshape((1, -1, 1)) * displacements /
+            np.expand_dims(dist_matrix, 2)**3
+        ).sum(axis=1)
+
+        np.testing.assert_allclose(
+            calc.grav_acc(X, Y, M, Fuel), expected, rtol=1e-9)
+
+    def test_barnes_hut(self):
+        """Test the Barnes-Hut gravity solver against the exact one."""
+        n = 300
+        X, Y, M, _ = random_system(n)
+        GM = common.G * M
+        expected = np.empty((2, n))
+        actual = np.empty((2, n))
+        calc.grav_acc_into(X, Y, GM, expected[0], expected[1])
+
+        # With a tiny opening angle, nothing is approximated.
+        barnes_hut.grav_acc_into(X, Y, GM, actual[0], actual[1], 1e-9)
+        np.testing.assert_allclose(actual, expected, rtol=1e-9)
+
+        # With the default opening angle, the error should still be small,
+        # although a few entities always do a lot worse than the median.
+        barnes_hut.grav_acc_into(X, Y, GM, actual[0], actual[1],
+                                 barnes_hut.DEFAULT_OPENING_ANGLE)
+        error = (np.linalg.norm(actual - expected, axis=0) /
+                 np.linalg.norm(expected, axis=0))
+        self.assertLess(np.median(error), 1e-3)
+        self.assertLess(np.max(error), 5e-2)
+
+        # Savefiles can ask for the Barnes-Hut solver, and the derivative
+        # should then agree with the exact solver.
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        self.assertEqual(dynamics.gravity_solver(state),
+                         protos.EngineSettings.DIRECT)
+        exact = dynamics.derive(0, state.y0(), dynamics.build_params(state))
+        state.engine_settings.gravity_solver = \
+            protos.EngineSettings.BARNES_HUT
+        state.engine_settings.opening_angle = 1e-9
+        self.assertEqual(dynamics.gravity_solver(state),
+                         protos.EngineSettings.BARNES_HUT)
+        approximate = dynamics.derive(
+            0, state.y0(), dynamics.build_params(state))
+        np.testing.assert_allclose(approximate, exact, rtol=1e-9)
+
+    def test_interactions(self):
+        """Test the interaction list gravity solver against the exact one,
+        and its error bound."""
+        n = 300
+        X, Y, M, _ = random_system(n)
+        GM = common.G * M
+        expected = np.empty((2, n))
+        actual = np.empty((2, n))
+        calc.grav_acc_into(X, Y, GM, expected[0], expected[1])
+
+        # With no threshold, every pull is kept.
+        start, interaction_list, error = interactions.build(X, Y, GM, 0)
+        self.assertEqual(len(interaction_list), n * (n - 1))
+        self.assertEqual(error, 0)
+        interactions.grav_acc_into(X, Y, GM, start, interaction_list,
+                                   actual[0], actual[1])
+        np.testing.assert_allclose(actual, expected, rtol=1e-9)
+
+        # Otherwise, no entity is off by more than the error bound, and
+        # every list is sorted.
+        start, interaction_list, error = interactions.build(X, Y, GM, 1e-6)
+        self.assertLess(len(interaction_list), n * (n - 1) / 2)
+        interactions.grav_acc_into(X, Y, GM, start, interaction_list,
+                                   actual[0], actual[1])
+        self.assertLessEqual(
+            np.max(np.linalg.norm(actual - expected, axis=0)), error)
+        for i in range(n):
+            self.assertTrue(np.all(
+                np.diff(interaction_list[start[i]:start[i + 1]]) > 0))
+
+        # Savefiles can ask for the interaction list solver, and the
+        # derivative should then agree with the exact solver.
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        exact = dynamics.derive(0, state.y0(), dynamics.build_params(state))
+        state.engine_settings.gravity_solver = \
+            protos.EngineSettings.INTERACTION_LIST
+        params = dynamics.build_params(state)
+        self.assertLess(len(params.interactions),
+                        len(state) * (len(state) - 1) / 2)
+        approximate = PhysicsState(
+            dynamics.derive(0, state.y0(), params), state._proto_state)
+        exact = PhysicsState(exact, state._proto_state)
+        self.assertLessEqual(
+            np.max(np.hypot(approximate.VX - exact.VX,
+                            approximate.VY - exact.VY)),
+            params.interaction_error)
+
+    def test_parallel_kernels(self):
+        """Test the parallel kernels give the same results as the serial
+        ones. This runs with however many threads numba gives us."""
+        n = 300
+        X, Y, M, _ = random_system(n)
+        R = 10 ** np.random.default_rng(1).uniform(3, 9, n)
+        GM = common.G * M
+        serial = np.empty((2, n))
+        parallel = np.empty((2, n))
+
+        calc.grav_acc_into(X, Y, GM, serial[0], serial[1])
+        calc.grav_acc_into_parallel(X, Y, GM, parallel[0], parallel[1])
+        np.testing.assert_allclose(parallel, serial, rtol=1e-9)
+
+        barnes_hut.grav_acc_into(X, Y, GM, serial[0], serial[1], 0.5)
+        barnes_hut.grav_acc_into_parallel(
+            X, Y, GM, parallel[0], parallel[1], 0.5)
+        np.testing.assert_array_equal(parallel, serial)
+
+        # Land the closest pair on each other, then the next-closest pair
+        # should be found instead. Also make some entities test particles,
+        # to exercise both halves of the collision kernels.
+        landed_on = np.full(n, PhysicsState.NO_INDEX)
+        groups = np.full(n, PhysicsState.NO_INDEX)
+        sources = np.arange(0, n, 3)
+        particles = np.setdiff1d(np.arange(n), sources)
+        altitude, i, j = calc.closest_approach(
+            X, Y, R, landed_on, groups, sources, particles)
+        self.assertEqual(
+            calc.closest_approach_parallel(
+                X, Y, R, landed_on, groups, sources, particles),
+            (altitude, i, j))
+        landed_on[j] = i
+        next_altitude, next_i, next_j = calc.closest_approach(
+            X, Y, R, landed_on, groups, sources, particles)
+        self.assertNotEqual((next_i, next_j), (i, j))
+        self.assertGreaterEqual(next_altitude, altitude)
+        self.assertEqual(
+            calc.closest_approach_parallel(
+                X, Y, R, landed_on, groups, sources, particles),
+            (next_altitude, next_i, next_j))
+
+    def test_broad_phase(self):
+        """Test that the sweep-and-prune collision kernel finds the same
+        closest pair as calc.closest_approach, and respects collision
+        groups."""
+        n = 300
+        initial_X, initial_Y, _, _ = random_system(n, size=1e5)
+        rng = np.random.default_rng(1)
+        R = 10 ** rng.uniform(0, 3, n)
+        landed_on = np.full(n, PhysicsState.NO_INDEX)
+        groups = np.full(n, PhysicsState.NO_INDEX)
+        groups[:n // 2] = rng.integers(0, 5, n // 2)
+        particle = rng.random(n) < 0.3
+        sources = np.flatnonzero(~particle)
+        particles = np.flatnonzero(particle)
+        order = broad_phase.sweep_order(initial_X, R)
+        for spread in [1, 1.01, 10, 1000]:
+            # Spread the entities out more each time, so that eventually no
+            # pair is within CUTOFF. The same order is reused throughout.
+            X = initial_X * spread
+            Y = initial_Y * spread
+            altitude, i, j = calc.closest_approach(
+                X, Y, R, landed_on, groups, sources, particles)
+            sweep = broad_phase.closest_approach(
+                X, Y, R, landed_on, groups, particle, order)
+            self.assertAlmostEqual(
+                sweep[0], min(altitude, broad_phase.CUTOFF), delta=1e-6)
+            if altitude < broad_phase.CUTOFF:
+                self.assertEqual(sweep[1:], (i, j))
+            np.testing.assert_array_equal(
+                np.diff((X - R)[order]) >= 0, True)
+
+        # Two touching planets don't collide if they're in the same group.
+        proto_state = protos.PhysicalState()
+        proto_state.entities.add(name='A', r=10, collision_group='planets')
+        proto_state.entities.add(name='B', r=10, x=15,
+                                 collision_group='planets')
+        proto_state.entities.add(name='C', r=10, x=1e6)
+        proto_state.entities.add(name='D', r=10, x=-1e6,
+                                 collision_group='moons')
+        state = PhysicsState(None, proto_state)
+        np.testing.assert_array_equal(
+            state.CollisionGroups, [0, 0, PhysicsState.NO_INDEX, 1])
+        collision = physics.engine.CollisionEvent(state, np.full(4, 10))
+        self.assertGreater(collision(0, state.y0()), 0)
+        state[2].x = 25
+        state[2].collision_group = 'moons'
+        collision = physics.engine.CollisionEvent(state, np.full(4, 10))
+        self.assertLess(collision(0, state.y0()), 0)
+        self.assertEqual(collision(0, state.y0(), return_pair=True), (1, 2))
+
 
 def test_performance():
     # This just runs for 10 seconds and collects profiling data.
@@ -467,7 +1673,7 @@ def test_performance():
     with PhysicsEngine('OCESS.json') as physics_engine:
         physics_engine.handle_requests([
             network.Request(ident=network.Request.TIME_ACC_SET,
-                            time_acc_set=common.TIME_ACCS[-2].value)])
+                            time_acc_set=10_000)])
 
         end_time = time.time() + 10
         print(f"Profiling performance for {end_time - time.time()} seconds.")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Tunes how the physics engine simulates a savefile at each time acc.
+
+The physics engine can look up the max step, tolerance profile and chunk
+length it uses at each time acc in a tuning table, see
+orbitx/physics/tuning.py. For example,
+
+    python tune.py OCESS.json --position-budget 100
+
+finds the fastest settings for RK45 that keep every entity of OCESS.json
+within 100 m of a very accurate reference integration after 10,000
+simulated seconds, and writes data/tuning/OCESS.json. To use it, add
+"engineSettings": {"tuning": "OCESS.json"} to the savefile, or run e.g.
+`python orbitx.py flight_training --tuning OCESS.json`.
+
+Tuning tables aren't checked in, since the fastest settings depend on the
+machine. Tuning measures how long each setting takes, so don't run anything
+else at the same time."""
+
+import argparse
+import logging
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from orbitx import common
+from orbitx import logs
+from orbitx.physics import calc, dynamics, engine, integrators, packed, \
+    relative, rk, tolerances, tuning
+from orbitx.data_structures import PhysicsState
+
+log = logging.getLogger()
+
+# Max steps to try, in simulated seconds. For each tolerance profile, these
+# are tried from shortest to longest, until one goes over the budget.
+MAX_STEPS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+# Chunk lengths to try, in max steps.
+CHUNK_STEPS = [tuning.CHUNK_STEPS, 30, 100]
+
+
+class Measurement(NamedTuple):
+    setting: tuning.Setting
+    wall_time: float
+    evaluations: int
+    # How far the furthest entity ended up from the reference, in metres,
+    # and how far the total energy is from the reference's, relative to it.
+    position_error: float
+    energy_error: float
+
+
+def integrate(state: PhysicsState, integrator: integrators.Integrator,
+              max_step: float, profile: tolerances.Profile, chunk: float,
+              duration: float) -> Tuple[PhysicsState, int]:
+    """Integrates state for duration simulated seconds, in chunks of chunk
+    simulated seconds like PhysicsEngine._run_simulation does, and returns
+    the final state and how many times the derivative was evaluated.
+    Collisions are handled like the physics engine does, but there are no
+    other events."""
+    y = state
+    t = 0.0
+    radii = np.array([entity.r for entity in state])
+    evaluations = 0
+    while t < duration:
+        collision = engine.CollisionEvent(y, radii)
+        params = dynamics.build_params(y)
+        t_span = [t, t + min(chunk, duration - t)]
+        if integrator.backend == integrators.COMPILED:
+            ivp_out = rk.solve_ivp(
+                params, dynamics.build_event_params(y, np.inf), t_span,
+                y.y0(), max_step, profile)
+        else:
+            ivp_out = packed.solve_ivp(
+                params, t_span, y.y0(), [collision], integrator.method,
+                max_step, profile, orbits=relative.orbits(y, params))
+        assert ivp_out.success, ivp_out.message
+        evaluations += ivp_out.nfev
+        y = PhysicsState(ivp_out.y[:, -1], state._proto_state)
+        t = ivp_out.t[-1]
+        if len(ivp_out.t_events[dynamics.COLLISION_EVENT]) > 0:
+            y = engine._collision_decision(t, y, collision)
+            y = engine._reconcile_entity_dynamics(y)
+    return y, evaluations
+
+
+def energy(state: PhysicsState) -> float:
+    return calc.total_energy(
+        state.X, state.Y, state.VX, state.VY,
+        np.array([entity.mass for entity in state]), state.Fuel)
+
+
+def measure(state: PhysicsState, integrator: integrators.Integrator,
+            setting: tuning.Setting, time_acc: int, duration: float,
+            reference: PhysicsState) -> Measurement:
+    start = time.perf_counter()
+    result, evaluations = integrate(
+        state, integrator, setting.max_step,
+        tolerances.by_name(setting.tolerances),
+        min(time_acc, setting.chunk), duration)
+    wall_time = time.perf_counter() - start
+    reference_energy = energy(reference)
+    return Measurement(
+        setting=setting, wall_time=wall_time, evaluations=evaluations,
+        position_error=np.max(np.hypot(result.X - reference.X,
+                                       result.Y - reference.Y)),
+        energy_error=abs((energy(result) - reference_energy) /
+                         reference_energy))
+
+
+def tune_time_acc(state: PhysicsState, integrator: integrators.Integrator,
+                  time_acc: int, duration: float, reference: PhysicsState,
+                  position_budget: float,
+                  energy_budget: float) -> Optional[Measurement]:
+    """Returns the fastest setting at time_acc that's within budget, or None
+    if none of them are."""
+    def within_budget(measurement: Measurement) -> bool:
+        return measurement.position_error <= position_budget and \
+            measurement.energy_error <= energy_budget
+
+    passing: List[Measurement] = []
+    for profile in tolerances.PROFILES:
+        for max_step in MAX_STEPS:
+            if max_step > time_acc and max_step != MAX_STEPS[0]:
+                # Steps can't be longer than chunks, which are never longer
+                # than the time acc.
+                break
+            measurement = measure(
+                state, integrator,
+                tuning.Setting(max_step=max_step, tolerances=profile,
+                               chunk=tuning.CHUNK_STEPS * max_step),
+                time_acc, duration, reference)
+            log.info(f'{time_acc:,}x: {measurement}')
+            if not within_budget(measurement):
+                # Longer steps would only be less accurate.
+                break
+            passing.append(measurement)
+    if len(passing) == 0:
+        return None
+
+    best = min(passing, key=lambda measurement: measurement.wall_time)
+    for steps in CHUNK_STEPS[1:]:
+        chunk = steps * best.setting.max_step
+        if chunk > time_acc:
+            break
+        measurement = measure(
+            state, integrator, best.setting._replace(chunk=chunk), time_acc,
+            duration, reference)
+        log.info(f'{time_acc:,}x: {measurement}')
+        if within_budget(measurement) and \
+                measurement.wall_time < best.wall_time:
+            best = measurement
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Logs everything to both logfile and output.')
+    parser.add_argument(
+        'savefile',
+        help=f'Savefile to tune with, relative to {common.savefile(".")}.')
+    parser.add_argument(
+        '--integrator', default=integrators.DEFAULT_INTEGRATOR,
+        choices=[integrator.method
+                 for integrator in integrators.INTEGRATORS.values()
+                 if integrator.backend in [integrators.SCIPY,
+                                           integrators.COMPILED]],
+        help='Integrator to tune for.')
+    parser.add_argument(
+        '--duration', type=float, default=10_000,
+        help='How many seconds to simulate each setting for. The budgets '
+             'are for the errors at the end.')
+    parser.add_argument(
+        '--position-budget', type=float, default=100,
+        help='Largest distance allowed between any entity and where the '
+             'reference integration puts it, in metres.')
+    parser.add_argument(
+        '--energy-budget', type=float, default=1e-12,
+        help='Largest difference allowed between the total energy and the '
+             "reference integration's, relative to it.")
+    parser.add_argument(
+        '--time-accs', type=int, nargs='+',
+        default=[time_acc.value for time_acc in common.TIME_ACCS
+                 if time_acc.value > 0],
+        help='Time accs to tune. Other time accs use the defaults.')
+    parser.add_argument(
+        '--output',
+        help='File to write, relative to data/tuning/. Defaults to the name '
+             'of the savefile, ending in .json.')
+    args = parser.parse_args()
+
+    logs.make_program_logfile('tune')
+    if args.verbose:
+        logs.enable_verbose_logging()
+
+    state = engine._reconcile_entity_dynamics(
+        common.load_savefile(common.savefile(args.savefile)))
+    integrator = integrators.INTEGRATORS[args.integrator]
+    output = tuning.path(args.output or Path(args.savefile).stem + '.json')
+
+    reference, _ = integrate(
+        state, integrators.INTEGRATORS['DOP853'], 100, tolerances.REFERENCE,
+        args.duration, args.duration)
+    # Warm up the JIT, so it doesn't count towards the first measurement.
+    integrate(state, integrator, 1, tolerances.PROFILES[
+        tolerances.DEFAULT_PROFILE], 1, 1)
+    settings = {}
+    print(f'{"time acc":>10}  {"max step":>8}  {"tolerances":>10}  '
+          f'{"chunk":>8}  {"sim s/wall s":>12}  {"position error":>14}  '
+          f'{"energy error":>12}')
+    for time_acc in args.time_accs:
+        best = tune_time_acc(state, integrator, time_acc, args.duration,
+                             reference, args.position_budget,
+                             args.energy_budget)
+        if best is None:
+            print(f'{time_acc:>10,}  nothing is within budget, using the '
+                  'defaults')
+            continue
+        settings[time_acc] = best.setting
+        print(f'{time_acc:>10,}  {best.setting.max_step:>8g}  '
+              f'{best.setting.tolerances:>10}  {best.setting.chunk:>8g}  '
+              f'{args.duration / best.wall_time:>12,.0f}  '
+              f'{best.position_error:>14.1e}  {best.energy_error:>12.1e}')
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tuning.save(tuning.Table(
+        integrator=integrator.method, savefile=args.savefile,
+        duration=args.duration, position_budget=args.position_budget,
+        energy_budget=args.energy_budget, settings=settings), output)
+    print(f'Wrote {output}.')
+
+
+if __name__ == '__main__':
+    main()